@@ -0,0 +1,121 @@
+import argparse
+import logging
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import masst_utils
+import usi_utils
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+def create_analog_payload(n_matches: int, n_files: int, n_datasets: int = 500, seed: int = 0) -> dict:
+    """
+    Synthetic fastMASST analog response with many matches per file and a wide delta mass range
+    :param n_matches: number of matches
+    :param n_files: number of distinct files the matches fall into
+    :param n_datasets: number of distinct datasets
+    :return: results dict like the fastMASST API response
+    """
+    rng = np.random.default_rng(seed)
+    file_ids = rng.integers(0, n_files, n_matches)
+    datasets = ["MSV{:09d}".format(i % n_datasets) for i in file_ids]
+    usis = [
+        "mzspec:{}:peak/sample_{}.mzML:scan:{}".format(dataset, file_id, scan)
+        for dataset, file_id, scan in zip(datasets, file_ids, rng.integers(1, 5000, n_matches))
+    ]
+    results = pd.DataFrame(
+        {
+            "USI": usis,
+            "Cosine": rng.uniform(0.5, 1, n_matches),
+            "Matching Peaks": rng.integers(2, 30, n_matches),
+            "Delta Mass": rng.normal(0, 60, n_matches),
+            "Status": "OK",
+            "Dataset": datasets,
+            "Unit Delta Mass": 0,
+            "Query Scan": 1,
+        }
+    )
+    return {"results": results.to_dict(orient="records"), "grouped_by_dataset": []}
+
+
+def extract_matches_with_copies(results_dict, precursor_mz_tol, min_matched_signals, analog):
+    """
+    Reference of the previous extraction that copied and sorted every result table on its own
+    """
+    masst_df = pd.DataFrame(results_dict["results"])
+    masst_df.drop(columns=["Unit Delta Mass", "Query Scan"], inplace=True, errors="ignore")
+    unfiltered_masst_df = masst_df.copy()
+    unfiltered_masst_df["file_usi"] = unfiltered_masst_df["USI"].apply(usi_utils.ensure_simple_file_usi)
+    filtered_masst_df = masst_utils.filter_matches(
+        unfiltered_masst_df, precursor_mz_tol, min_matched_signals, analog
+    ).copy()
+    analog_masst_df = None
+    if analog:
+        analog_masst_df = filtered_masst_df.copy()
+        analog_masst_df["rounded_delta"] = analog_masst_df["Delta Mass"].apply(lambda x: round(x, 0))
+        analog_masst_df = analog_masst_df.sort_values(
+            by=["Cosine", "Matching Peaks"], ascending=[False, False]
+        ).drop_duplicates(["file_usi", "rounded_delta"])
+    unfiltered_masst_df = unfiltered_masst_df.sort_values(by=["Cosine", "Matching Peaks"], ascending=[False, False])
+    filtered_masst_df = filtered_masst_df.sort_values(
+        by=["Cosine", "Matching Peaks"], ascending=[False, False]
+    ).drop_duplicates("file_usi")
+    return filtered_masst_df, unfiltered_masst_df, analog_masst_df
+
+
+def measure(name, fn, *args):
+    """
+    Runs fn and logs the wall time and the peak of the traced python memory
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    took = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    logger.info("%s took %.2f s with a peak of %.1f MB", name, took, peak / 1e6)
+    return result
+
+
+def run_benchmark(n_matches: int, n_files: int, repeats: int = 1):
+    payload = create_analog_payload(n_matches, n_files)
+    for _ in range(repeats):
+        # different file usis are parsed on every repeat otherwise
+        usi_utils._file_usi_cache.clear()
+        reference = measure("copying extraction", extract_matches_with_copies, payload, 0.05, 3, True)
+        usi_utils._file_usi_cache.clear()
+        results = measure(
+            "shared frame extraction",
+            masst_utils.extract_matches_from_masst_results,
+            payload,
+            0.05,
+            3,
+            True,
+            True,
+        )
+    # both need to find the same matches
+    assert len(results.filtered_masst_df) == len(reference[0])
+    assert len(results.analog_masst_df) == len(reference[2])
+    logger.info(
+        "%d matches, %d best per file, %d analogs",
+        len(results.unfiltered_masst_df),
+        len(results.filtered_masst_df),
+        len(results.analog_masst_df),
+    )
+
+
+if __name__ == "__main__":
+    # parsing the input arguments for the benchmark
+    parser = argparse.ArgumentParser(description="Memory and time of the MASST match extraction on an analog payload")
+    parser.add_argument("--matches", type=int, help="number of matches in the payload", default=500_000)
+    parser.add_argument("--files", type=int, help="number of distinct files", default=50_000)
+    parser.add_argument("--repeats", type=int, help="repeat the measurement", default=1)
+
+    args = parser.parse_args()
+
+    run_benchmark(args.matches, args.files, args.repeats)
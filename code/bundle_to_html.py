@@ -1,12 +1,22 @@
 from bs4 import BeautifulSoup
 from pathlib import Path
+from dataclasses import dataclass, asdict, field
+from typing import Dict, List
 import base64
+import hashlib
+import json
+import os
+import threading
 import requests
 import sys
 import argparse
 from distutils.util import strtobool
 import logging
 
+import compressed_files
+from output_writer import OutputWriter
+from output_writer import write_output
+
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
@@ -30,48 +40,103 @@ def replace_by_local_file(path):
     return path
 
 
-def replace_data_in_file(data_json_file, text, placeholder_str):
+@dataclass
+class HtmlShell:
+    """
+    A bundled (and optionally minified) HTML file split at its placeholders. Rendering a report only splices the
+    data between the static segments.
     """
 
-    :param data_json_file: data might be passed as file or other data structure like json
-    :param text: the text to search and replace in
-    :param placeholder_str: the placeholder string to replace
-    :return: the final text
+    # static text around the placeholders, always one more segment than placeholders
+    segments: List[str]
+    placeholders: List[str]
+    # the quote character if the placeholder sits inside a JS string literal, otherwise empty
+    quotes: List[str]
+    # placeholders did not survive minification, the whole report is minified after splicing the data
+    minify_after_render: bool = False
+    # linked CSS and JS files by name and their original path
+    assets: Dict[str, str] = field(default_factory=dict)
+
+    def render(self, replace_dict) -> str:
+        parts = [self.segments[0]]
+        for placeholder, quote, segment in zip(
+            self.placeholders, self.quotes, self.segments[1:]
+        ):
+            replace_data = replace_dict.get(placeholder)
+            text = read_replace_data("" if replace_data is None else replace_data)
+            parts.append(escape_js_string(text, quote) if quote else text)
+            parts.append(segment)
+        return "".join(parts)
+
+
+# compiled shells of this process by input html, compression, and placeholders
+_html_shells = {}
+_html_shells_lock = threading.Lock()
+# assets directories that were already exported by this process
+_exported_assets = set()
+
+
+def read_replace_data(data_json_file):
+    """
+    :param data_json_file: data might be passed as file (also compressed, see compressed_files) or other data
+    structure like json
+    :return: the file content or the input as string
     """
     try:
-        tree_data = Path(data_json_file).read_text()
+        return compressed_files.read_text(data_json_file)
     except:
-        tree_data = data_json_file
-        pass
-    text = text.replace(placeholder_str, tree_data, 1)
+        return str(data_json_file)
 
+
+def escape_js_string(text, quote):
+    text = text.replace("\\", "\\\\").replace(quote, "\\" + quote)
+    text = text.replace("\n", "\\n").replace("\r", "\\r")
+    if quote == "`":
+        text = text.replace("${", "\\${")
     return text
 
 
-def build_dist_html(input_html, output_html, replace_dict=None, compress=False):
+def read_resource(path) -> str:
     """
-    Creates a single distributable HTML file.
-    Reads the input_html and internalizes all CSS, JS, and data files into the output html. For web ressources: First
-    try to load a local file, else try to download file.
-    :param replace_dict: dict of key (placeholder string in HTML) and the value to insert either from a file or as a
-    string
+    :param path: local file or URL, web ressources are replaced by local files if possible
+    :return: the text content
+    """
+    path = replace_by_local_file(path)
+    if path.startswith("http"):
+        response = requests.get(path)
+        response.raise_for_status()
+        return response.text
+    return Path(path).read_text(encoding="utf-8")
+
+
+def bundle_html(input_html, placeholders=(), assets_href=None, assets=None) -> str:
+    """
+    Reads the input_html and internalizes all CSS, JS, and image files. For web ressources: First try to load a
+    local file, else try to download file.
     :param input_html: the input html file that defines all dependencies
-    :param output_html: the bundled HTML file
-    :param data_json_file: data as a file or as json (or dictionary / array)
-    :param placeholder_str: the placeholder is replaced with the data
-    :return: None
+    :param placeholders: CSS and JS files that contain a placeholder are always internalized
+    :param assets_href: if set, all other CSS and JS files are linked relative to this path instead
+    :param assets: dict that collects the linked asset names and their original paths
+    :return: the bundled html text
     """
-    if replace_dict is None:
-        replace_dict = {}
     original_html_text = Path(input_html).read_text(encoding="utf-8")
     soup = BeautifulSoup(original_html_text, "html.parser")
 
+    def link_as_asset(tag, attribute, file_text):
+        if assets_href is None or any(p in file_text for p in placeholders):
+            return False
+        name = Path(tag[attribute]).name
+        if assets is not None:
+            assets[name] = tag[attribute]
+        tag[attribute] = "{}/{}".format(assets_href, name)
+        return True
+
     # Find link tags. example: <link rel="stylesheet" href="css/somestyle.css">
     for tag in soup.find_all("link", href=True):
         if tag.has_attr("href"):
-            path = tag["href"]
-            path = replace_by_local_file(path)
-            file_text = Path(path).read_text(encoding="utf-8")
+            file_text = read_resource(tag["href"])
+            if link_as_asset(tag, "href", file_text):
+                continue
 
             # remove the tag from soup
             tag.extract()
@@ -84,22 +149,20 @@ def build_dist_html(input_html, output_html, replace_dict=None, compress=False):
     # Find script tags. example: <script src="js/somescript.js"></script>
     for tag in soup.find_all("script", src=True):
         if tag.has_attr("src"):
-            path = tag["src"]
-            path = replace_by_local_file(path)
-            if path.startswith("http"):
-                response = requests.get(path)
-                response.raise_for_status()
-                file_text = response.text
-            else:
-                file_text = Path(path).read_text()
-
-            # remove the tag from soup
-            tag.extract()
+            file_text = read_resource(tag["src"])
+            if link_as_asset(tag, "src", file_text):
+                continue
 
             # insert script element
             new_script = soup.new_tag("script")
             new_script.string = file_text
-            soup.body.append(new_script)
+            if assets_href is None:
+                # remove the tag from soup
+                tag.extract()
+                soup.body.append(new_script)
+            else:
+                # keep the order relative to the linked scripts
+                tag.replace_with(new_script)
 
     # Find image tags.
     for tag in soup.find_all("img", src=True):
@@ -112,34 +175,227 @@ def build_dist_html(input_html, output_html, replace_dict=None, compress=False):
                 base64_file_content.decode("ascii")
             )
 
-    out_text = str(soup)
+    return str(soup)
+
+
+def export_assets(shell: HtmlShell, assets_dir):
+    """
+    Writes the linked CSS and JS files of the shell once to the assets directory, unchanged files are kept
+    """
+    key = (str(Path(assets_dir).resolve()), tuple(sorted(shell.assets.items())))
+    if key in _exported_assets:
+        return
+    with _html_shells_lock:
+        if key in _exported_assets:
+            return
+        Path(assets_dir).mkdir(parents=True, exist_ok=True)
+        for name, path in shell.assets.items():
+            content = read_resource(path).encode("utf-8")
+            asset_file = Path(assets_dir) / name
+            try:
+                if asset_file.read_bytes() == content:
+                    continue
+            except FileNotFoundError:
+                pass
+            # other processes might export or read the same assets
+            tmp_file = asset_file.with_name("{}.{}.tmp".format(name, os.getpid()))
+            tmp_file.write_bytes(content)
+            os.replace(tmp_file, asset_file)
+        _exported_assets.add(key)
+
+
+def minify(text) -> str:
+    try:
+        import minify_html
+
+        try:
+            return minify_html.minify(text, minify_js=True, minify_css=True)
+        except BaseException:
+            # Fallback: minify without JS if JS minification causes a panic
+            logger.warning("JS minification failed, retrying without JS minification.")
+            return minify_html.minify(text, minify_js=False, minify_css=True)
+
+    except Exception as e:
+        logger.warning("Error during output compression.")
+        logger.exception(e)
+    return text
 
-    # try to replace data with PLACEHOLDER_JSON_DATA
-    for placeholder, replace_data in replace_dict.items():
-        if replace_data is not None:
-            out_text = replace_data_in_file(replace_data, out_text, placeholder)
-        else:
-            out_text = replace_data_in_file("", out_text, placeholder)
 
+def html_shell_fingerprint(input_html, placeholders, compress, assets_href=None) -> str:
+    """
+    Hash of the template, all its local dependencies, and the settings
+    """
+    sha = hashlib.sha256()
+    sha.update(repr((sorted(placeholders), compress, assets_href)).encode("utf-8"))
     if compress:
         try:
             import minify_html
 
-            try:
-                out_text = minify_html.minify(out_text, minify_js=True, minify_css=True)
-            except BaseException:
-                # Fallback: minify without JS if JS minification causes a panic
-                logger.warning("JS minification failed, retrying without JS minification.")
-                out_text = minify_html.minify(out_text, minify_js=False, minify_css=True)
+            sha.update(str(getattr(minify_html, "__version__", "")).encode("utf-8"))
+        except Exception:
+            pass
+    original_html_text = Path(input_html).read_text(encoding="utf-8")
+    sha.update(original_html_text.encode("utf-8"))
+    soup = BeautifulSoup(original_html_text, "html.parser")
+    paths = [tag["href"] for tag in soup.find_all("link", href=True)]
+    paths += [tag["src"] for tag in soup.find_all(["script", "img"], src=True)]
+    for path in paths:
+        path = replace_by_local_file(path)
+        sha.update(path.encode("utf-8"))
+        if not path.startswith("http"):
+            sha.update(Path(path).read_bytes())
+    return sha.hexdigest()
+
+
+def split_html_shell(
+    text, placeholders, minify_after_render=False, assets=None
+) -> HtmlShell | None:
+    """
+    Splits the bundled text at the first occurrence of each placeholder
+    :return: the shell or None if a placeholder is missing
+    """
+    positions = []
+    for placeholder in placeholders:
+        position = text.find(placeholder)
+        if position < 0:
+            return None
+        positions.append((position, placeholder))
+    positions.sort()
+
+    segments, ordered, quotes = [], [], []
+    start = 0
+    for position, placeholder in positions:
+        end = position + len(placeholder)
+        if position < start:
+            # overlapping placeholders cannot be spliced
+            return None
+        before = text[position - 1 : position]
+        quote = before if before in ("\"", "'", "`") and text[end : end + 1] == before else ""
+        segments.append(text[start:position])
+        ordered.append(placeholder)
+        quotes.append(quote)
+        start = end
+    segments.append(text[start:])
+    return HtmlShell(segments, ordered, quotes, minify_after_render, dict(assets or {}))
 
+
+def compile_html_shell(
+    input_html, placeholders, compress=False, cache_dir=None, assets_href=None
+) -> HtmlShell:
+    """
+    Bundles and minifies the input html once. The placeholders are later replaced by data.
+    :param input_html: the input html file that defines all dependencies
+    :param placeholders: all placeholder strings that are replaced by data
+    :param compress: minify the shell
+    :param cache_dir: optional directory that caches the compiled shell on disk, keyed by the hash of the
+    template and all its dependencies
+    :param assets_href: link CSS and JS files without placeholders relative to this path instead of
+    internalizing them
+    :return: the compiled shell
+    """
+    cache_file = None
+    if cache_dir is not None:
+        fingerprint = html_shell_fingerprint(input_html, placeholders, compress, assets_href)
+        cache_file = Path(cache_dir) / "html_shell_{}.json".format(fingerprint)
+        try:
+            with open(cache_file, "r", encoding="utf-8") as file:
+                return HtmlShell(**json.load(file))
+        except FileNotFoundError:
+            pass
         except Exception as e:
-            logger.warning("Error during output compression.")
+            logger.warning("Cannot read cached html shell %s", cache_file)
             logger.exception(e)
 
-    # Save onefile
+    assets = {}
+    text = bundle_html(input_html, placeholders, assets_href, assets)
+    shell = None
+    if compress:
+        shell = split_html_shell(minify(text), placeholders, assets=assets)
+        if shell is None:
+            logger.warning("Placeholders changed during minification, minifying every report instead.")
+    if shell is None:
+        shell = split_html_shell(text, placeholders, minify_after_render=compress, assets=assets)
+    if shell is None:
+        raise ValueError("Placeholder missing or overlapping in {}".format(input_html))
+
+    if cache_file is not None:
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            # write to temp file first as other processes might read the cache concurrently
+            tmp_file = cache_file.with_suffix(".{}.tmp".format(os.getpid()))
+            with open(tmp_file, "w", encoding="utf-8") as file:
+                json.dump(asdict(shell), file)
+            os.replace(tmp_file, cache_file)
+        except Exception as e:
+            logger.warning("Cannot cache html shell %s", cache_file)
+            logger.exception(e)
+    return shell
+
+
+def get_html_shell(
+    input_html, placeholders, compress=False, cache_dir=None, assets_href=None
+) -> HtmlShell:
+    """
+    The compiled shell is kept for the lifetime of the process
+    """
+    key = (str(Path(input_html).resolve()), tuple(placeholders), bool(compress), assets_href)
+    shell = _html_shells.get(key)
+    if shell is None:
+        with _html_shells_lock:
+            shell = _html_shells.get(key)
+            if shell is None:
+                shell = compile_html_shell(
+                    input_html, placeholders, compress, cache_dir, assets_href
+                )
+                _html_shells[key] = shell
+    return shell
+
 
-    with open(output_html, "w", encoding="utf-8") as outfile:
-        outfile.write(out_text)
+def build_dist_html(
+    input_html,
+    output_html,
+    replace_dict=None,
+    compress=False,
+    shell_cache_dir=None,
+    assets_dir=None,
+    output_writer: OutputWriter = None,
+    compression: str | None = None,
+):
+    """
+    Creates a single distributable HTML file.
+    The input_html with all CSS, JS, and image files internalized is compiled once per process (see
+    compile_html_shell), then only the data of the replace_dict is spliced into the shell.
+    With an assets_dir, all CSS and JS files without data are written once to the assets_dir and linked relative to
+    the output_html, so that the report only contains the data.
+    :param replace_dict: dict of key (placeholder string in HTML) and the value to insert either from a file or as a
+    string
+    :param input_html: the input html file that defines all dependencies
+    :param output_html: the bundled HTML file
+    :param compress: minify the html (needs minify_html)
+    :param shell_cache_dir: optional directory to cache the compiled shell across processes
+    :param assets_dir: optional directory for shared CSS and JS files, None creates a single file
+    :param output_writer: writes the file in the background, None writes it directly
+    :param compression: gzip or zstd writes output_html with the suffix .gz or .zst, shared assets stay plain
+    :return: True
+    """
+    if replace_dict is None:
+        replace_dict = {}
+    assets_href = None
+    if assets_dir is not None:
+        assets_href = Path(
+            os.path.relpath(assets_dir, Path(output_html).parent)
+        ).as_posix()
+    shell = get_html_shell(
+        input_html, list(replace_dict.keys()), compress, shell_cache_dir, assets_href
+    )
+    if assets_dir is not None:
+        export_assets(shell, assets_dir)
+    out_text = shell.render(replace_dict)
+    if shell.minify_after_render:
+        out_text = minify(out_text)
+
+    # Save onefile
+    write_output(output_html, out_text, output_writer, compression)
 
     return True
 
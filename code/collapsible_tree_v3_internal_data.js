@@ -29,12 +29,25 @@ EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.*/
  project (GFOP), foodMASST, and microbeMASST
  */
 
-// tree data internalized
-// const treeData = [];
+// tree data internalized in report_data.js as root
 
-const root = PLACEHOLDER_JSON_DATA;
-
-visitAll(root, node => node.originalChildren = node.children);
+visitAll(root, node => {
+    // compact trees omit all fields that can be derived
+    node.matched_size = node.matched_size ?? 0;
+    if (node.occurrence_fraction == null) {
+        node.occurrence_fraction = node.group_size > 0 ? node.matched_size / node.group_size : 0;
+    }
+    if (node.pie_data == null) {
+        node.pie_data = [0, 1].map(index => ({
+            occurrence_fraction: index === 0 ? node.occurrence_fraction : 1.0 - node.occurrence_fraction,
+            index: index,
+            group_size: node.group_size,
+            matched_size: node.matched_size,
+            masst_type: node.masst_type,
+        }));
+    }
+    node.originalChildren = node.children;
+});
 
 // turn off node dragging
 const isNodeDragActive = false;
@@ -267,12 +280,9 @@ dropdownTree.on("change", function (d) {
 });
 
 
-// add label for input
-var inputLabel = "INPUT_LABEL_PLACEHOLDER";
-var inputUsi = "USI_LABEL_PLACEHOLDER";
+// add label for input (inputLabel, inputUsi, and paramsLabel are set in report_data.js)
 d3.select("#titleDiv").append('label').text(inputLabel)
 
-var paramsLabel = "PARAMS_PLACEHOLDER";
 d3.select("#paramsDiv").append('label').text(paramsLabel)
 
 // initialize drop down style menu
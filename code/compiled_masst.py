@@ -0,0 +1,248 @@
+import json
+import logging
+import os
+import shutil
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+import fingerprints
+from masst_utils import SpecialMasst
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# changes of the artefact layout invalidate all compiled artefacts
+FORMAT_VERSION = 3
+COMPILED_DIR = "../data/compiled"
+MANIFEST_FILE = "manifest.json"
+
+
+@dataclass
+class CompiledMasst:
+    """
+    A special MASST compiled from its tree json and metadata table. The arrays are memory-mapped, nodes are in
+    pre-order of the tree
+    """
+
+    # fields of each node, children is an empty list for nodes with children
+    nodes: list
+    # node id of each node as string, empty for nodes without id
+    node_ids: np.ndarray
+    # position of the parent node, -1 for the root
+    parents: np.ndarray
+    # group_size of each node in the tree json, -1 if it is missing
+    group_sizes: np.ndarray
+    # position of the next node with the same id, -1 for the last one
+    next_nodes: np.ndarray
+    # the metadata table as parquet sorted by file_usi, None if the file_usi is missing or not unique
+    metadata_table: str | None = None
+    # sorted file usis of the metadata table
+    file_usis: np.ndarray | None = None
+    # position of the first node of the metadata key of each file, -1 if the key is not in the tree
+    file_nodes: np.ndarray | None = None
+
+    def tree_nodes(self) -> list:
+        """
+        Builds a new tree from the parent array, the root is the first node
+        :return: new nodes in pre-order that the caller may modify, the values of the fields are shared
+        """
+        nodes = [dict(fields) for fields in self.nodes]
+        for node in nodes:
+            if "children" in node:
+                node["children"] = []
+        for node, parent in zip(nodes[1:], self.parents[1:].tolist()):
+            nodes[parent]["children"].append(node)
+        return nodes
+
+    def tree_root(self) -> dict:
+        """
+        :return: a new tree that the caller may modify
+        """
+        return self.tree_nodes()[0]
+
+    def file_usi_nodes(self, file_usis) -> np.ndarray:
+        """
+        :param file_usis: the file usis of matches
+        :return: the position of the first node of each file usi, -1 if it is not in the metadata or the tree
+        """
+        keys = np.asarray(pd.Series(file_usis).astype(str).to_numpy(), dtype=str)
+        if len(self.file_usis) == 0:
+            return np.full(len(keys), -1, dtype=np.int32)
+        positions = np.minimum(np.searchsorted(self.file_usis, keys), len(self.file_usis) - 1)
+        return np.where(self.file_usis[positions] == keys, self.file_nodes[positions], -1)
+
+    def same_id_nodes(self, position) -> list:
+        """
+        :return: the position and the positions of all later nodes with the same id
+        """
+        positions = []
+        while position >= 0:
+            positions.append(position)
+            position = int(self.next_nodes[position])
+        return positions
+
+
+def compiled_dir(special_masst: SpecialMasst, out_dir=COMPILED_DIR) -> str:
+    return os.path.join(out_dir, special_masst.prefix)
+
+
+def source_hashes(special_masst: SpecialMasst) -> dict:
+    """
+    :return: the format version and the hashes of the tree and metadata file that a compiled artefact was built from
+    """
+    return {
+        "format_version": FORMAT_VERSION,
+        "tree_hash": fingerprints.file_hash(special_masst.tree_file),
+        "metadata_hash": fingerprints.file_hash(special_masst.metadata_file),
+        "tree_node_key": special_masst.tree_node_key,
+        "metadata_key": special_masst.metadata_key,
+    }
+
+
+def compile_special_masst(special_masst: SpecialMasst, out_dir=COMPILED_DIR) -> str:
+    """
+    Compiles the tree json and metadata table of a special MASST into a directory of memory-mappable arrays, the
+    node fields without the tree structure, and the metadata as parquet sorted by file_usi
+    :return: the directory of the artefact
+    """
+    with open(special_masst.tree_file) as file:
+        root = json.load(file)
+    nodes, node_ids, parents, group_sizes = [], [], [], []
+    stack = [(root, -1)]
+    while stack:
+        node, parent = stack.pop()
+        position = len(nodes)
+        nodes.append({field: [] if field == "children" else value for field, value in node.items()})
+        node_id = node.get(special_masst.tree_node_key)
+        node_ids.append("" if node_id is None else str(node_id))
+        parents.append(parent)
+        group_size = node.get("group_size")
+        group_sizes.append(-1 if group_size is None else group_size)
+        stack.extend((child, position) for child in reversed(node.get("children", [])))
+
+    next_nodes = np.full(len(node_ids), -1, dtype=np.int32)
+    last_nodes = {}
+    for position in range(len(node_ids) - 1, -1, -1):
+        if node_ids[position]:
+            next_nodes[position] = last_nodes.get(node_ids[position], -1)
+            last_nodes[node_ids[position]] = position
+
+    directory = compiled_dir(special_masst, out_dir)
+    tmp_dir = "{}.{}.tmp".format(directory, threading.get_ident())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    with open(os.path.join(tmp_dir, "nodes.json"), "w", encoding="utf-8") as file:
+        json.dump(nodes, file, separators=(",", ":"))
+    np.save(os.path.join(tmp_dir, "node_ids.npy"), np.array(node_ids, dtype=str))
+    np.save(os.path.join(tmp_dir, "parents.npy"), np.array(parents, dtype=np.int32))
+    np.save(os.path.join(tmp_dir, "group_sizes.npy"), np.array(group_sizes, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, "next_nodes.npy"), next_nodes)
+
+    manifest = source_hashes(special_masst)
+    manifest["nodes"] = len(nodes)
+    manifest["metadata"] = compile_metadata(special_masst, last_nodes, tmp_dir)
+
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), "w") as file:
+        json.dump(manifest, file, indent=1)
+    # replaces an existing artefact. Between the two renames the directory is missing and loaders fall back to the
+    # source files
+    old_dir = tmp_dir + ".old"
+    if os.path.exists(directory):
+        os.replace(directory, old_dir)
+    os.replace(tmp_dir, directory)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    logger.info("Compiled %s with %d nodes to %s", special_masst.prefix, len(nodes), directory)
+    return directory
+
+
+def compile_metadata(special_masst: SpecialMasst, first_nodes: dict, out_dir) -> bool:
+    """
+    Writes the metadata table sorted by file_usi, its file usis, and the file_usi to node index
+    :param first_nodes: node id to the position of its first node
+    :return: False if the metadata table is missing or its file_usi is not unique
+    """
+    # imported here as masst_tree loads the compiled artefacts
+    from masst_tree import read_metadata
+
+    try:
+        metadata_df = read_metadata(special_masst.metadata_file)
+    except FileNotFoundError:
+        logger.warning("No metadata table %s", special_masst.metadata_file)
+        return False
+    if "file_usi" not in metadata_df.columns or not metadata_df["file_usi"].is_unique:
+        logger.warning("The file_usi of %s is missing or not unique", special_masst.metadata_file)
+        return False
+
+    metadata_df = metadata_df.sort_values("file_usi", kind="stable", ignore_index=True)
+    metadata_df.to_parquet(os.path.join(out_dir, "metadata.parquet"), index=False)
+    np.save(os.path.join(out_dir, "file_usis.npy"), metadata_df["file_usi"].to_numpy(dtype=str))
+    keys = metadata_df[special_masst.metadata_key]
+    file_nodes = keys.astype(str).map(first_nodes).where(keys.notna()).fillna(-1)
+    np.save(os.path.join(out_dir, "file_nodes.npy"), file_nodes.to_numpy(dtype=np.int32))
+    return True
+
+
+def load_compiled(special_masst: SpecialMasst, out_dir=COMPILED_DIR) -> CompiledMasst | None:
+    """
+    The compiled artefact of a special MASST, loaded once per process
+    :return: None if there is no artefact or it was built from other source files, the callers fall back to the
+    tree json and metadata table
+    """
+    directory = compiled_dir(special_masst, out_dir)
+    if not os.path.exists(os.path.join(directory, MANIFEST_FILE)):
+        return None
+    try:
+        return read_compiled(directory, json.dumps(source_hashes(special_masst), sort_keys=True))
+    except Exception as e:
+        # not cached, e.g., while the artefact is replaced
+        logger.warning("Cannot read compiled artefact %s: %s", directory, e)
+        return None
+
+
+@lru_cache(maxsize=None)
+def read_compiled(directory, expected_sources: str) -> CompiledMasst | None:
+    with open(os.path.join(directory, MANIFEST_FILE)) as file:
+        manifest = json.load(file)
+    expected = json.loads(expected_sources)
+    if any(manifest.get(key) != value for key, value in expected.items()):
+        logger.info("Compiled artefact %s is stale, using the source files", directory)
+        return None
+
+    def array(name):
+        return np.load(os.path.join(directory, name), mmap_mode="r")
+
+    with open(os.path.join(directory, "nodes.json"), "rb") as file:
+        nodes_json = file.read()
+    compiled = CompiledMasst(
+        nodes=orjson.loads(nodes_json) if orjson is not None else json.loads(nodes_json),
+        node_ids=array("node_ids.npy"),
+        parents=array("parents.npy"),
+        group_sizes=array("group_sizes.npy"),
+        next_nodes=array("next_nodes.npy"),
+    )
+    if manifest.get("metadata"):
+        compiled.metadata_table = os.path.join(directory, "metadata.parquet")
+        compiled.file_usis = array("file_usis.npy")
+        compiled.file_nodes = array("file_nodes.npy")
+    return compiled
+
+
+def load_tree(special_masst: SpecialMasst, out_dir=COMPILED_DIR) -> dict:
+    """
+    :return: a new tree of the special MASST that the caller may modify, from the compiled artefact if it is up to
+    date or from the tree json
+    """
+    compiled = load_compiled(special_masst, out_dir)
+    if compiled is not None:
+        return compiled.tree_root()
+    with open(special_masst.tree_file) as file:
+        return json.load(file)
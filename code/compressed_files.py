@@ -0,0 +1,102 @@
+import gzip
+import logging
+from pathlib import Path
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# file suffix of each compression
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# fast levels, the outputs are written once per compound
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+
+
+def check_compression(compression: str | None) -> str | None:
+    """
+    :return: the compression or None
+    :raises ValueError: for unknown compressions or if zstandard is not installed for zstd
+    """
+    if not compression or compression == "none":
+        return None
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError(
+            "Unknown compression {}, use one of {}".format(compression, list(COMPRESSION_SUFFIXES.keys()))
+        )
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard package")
+    return compression
+
+
+def compressed_file_name(path, compression: str | None) -> str:
+    """
+    :return: the path with the suffix of the compression, e.g., .json.gz
+    """
+    if compression is None:
+        return str(path)
+    return str(path) + COMPRESSION_SUFFIXES[compression]
+
+
+def strip_compression_suffix(path) -> str:
+    path = str(path)
+    for suffix in COMPRESSION_SUFFIXES.values():
+        if path.endswith(suffix):
+            return path[: -len(suffix)]
+    return path
+
+
+def compress(data: str | bytes, compression: str | None) -> bytes:
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    if compression == "gzip":
+        # mtime=0 keeps the output identical for identical input
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return data
+
+
+def decompress(data: bytes) -> bytes:
+    """
+    Detects gzip and zstd by their magic bytes, other data is returned unchanged
+    """
+    if data.startswith(GZIP_MAGIC):
+        return gzip.decompress(data)
+    if data.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError("Reading zstd compressed files needs the zstandard package")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def find_file(path, prefer_compression: str | None = None) -> str | None:
+    """
+    :param prefer_compression: checks this version first, e.g., the compression of the current run
+    :return: the existing plain or compressed version of path, None if none exists
+    """
+    candidates = [str(path)] + [str(path) + suffix for suffix in COMPRESSION_SUFFIXES.values()]
+    if prefer_compression is not None:
+        candidates.insert(0, compressed_file_name(path, prefer_compression))
+    for candidate in candidates:
+        if Path(candidate).is_file():
+            return candidate
+    return None
+
+
+def read_text(path, prefer_compression: str | None = None) -> str:
+    """
+    Reads a plain or compressed text file. The compressed versions path.gz and path.zst are found as well
+    :param prefer_compression: reads this version first if it exists
+    :raises FileNotFoundError: if no version exists
+    """
+    existing = find_file(path, prefer_compression)
+    if existing is None:
+        raise FileNotFoundError(path)
+    return decompress(Path(existing).read_bytes()).decode("utf-8")
@@ -0,0 +1,352 @@
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+import compressed_files
+import lineages
+from masst_utils import SpecialMasst
+from masst_utils import SPECIAL_MASSTS
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+COMPOUNDS_FILE = "compounds.json"
+# lineage ranks of the compound × rank matrices written on close
+LINEAGE_RANKS = ["phylum", "family", "genus", "species"]
+
+
+@dataclass
+class TreeRollup:
+    """
+    The node ids of a special MASST tree and how their counts roll up to the ancestors like matched_size in the tree
+    json: a node counts its own matches and those of all nodes in its subtree. A node id that occurs several times in
+    the tree is one column that counts the subtrees of all its occurrences, each node id once
+    """
+
+    # unique node ids in the order of their first occurrence in the tree
+    node_ids: list
+    # node id to column
+    positions: dict
+    # node × node matrix: 1 if a node id is in the subtree of any occurrence of another node id or is the same id
+    descendants: sparse.csr_matrix
+
+
+def tree_rollup(special_masst: SpecialMasst) -> TreeRollup:
+    return read_tree_rollup(special_masst.tree_file, special_masst.tree_node_key)
+
+
+@lru_cache(maxsize=None)
+def read_tree_rollup(tree_file, tree_node_key) -> TreeRollup:
+    with open(tree_file) as file:
+        tree_root = json.load(file)
+
+    positions = {}
+    rows, columns = [], []
+    # iterative pre-order walk with the node ids of all occurrences on the path to the root
+    stack = [(tree_root, ())]
+    while stack:
+        node, ancestors = stack.pop()
+        # nodes without id are matched by name, see json_ontology_extender.field_missing
+        node_id = str(node.get(tree_node_key, node.get("name")))
+        position = positions.setdefault(node_id, len(positions))
+        if position not in ancestors:
+            ancestors = ancestors + (position,)
+        rows.extend(ancestors)
+        columns.extend([position] * len(ancestors))
+        for child in reversed(node.get("children", [])):
+            stack.append((child, ancestors))
+
+    n = len(positions)
+    descendants = sparse.coo_matrix(
+        (np.ones(len(rows), dtype=np.int64), (np.array(rows), np.array(columns))), shape=(n, n)
+    ).tocsr()
+    # a node id that is several times in the subtrees of another counts once
+    descendants.data[:] = 1
+    return TreeRollup(node_ids=list(positions.keys()), positions=positions, descendants=descendants)
+
+
+class CooccurrenceAccumulator:
+    """
+    Sparse compound × node match counts of all special MASSTs that grow while a batch runs. Each compound adds the
+    matches per metadata key, the roll-up to the ancestor nodes is one sparse product when the matrix is requested.
+    Thread safe, checkpoints to a directory in intervals and on close
+    """
+
+    def __init__(
+        self, out_dir=None, special_massts: list[SpecialMasst] = None, checkpoint_seconds=300, ranks=LINEAGE_RANKS
+    ):
+        """
+        :param out_dir: directory of the checkpoints and final matrices, None keeps them in memory
+        :param checkpoint_seconds: minimum time between checkpoints
+        :param ranks: lineage ranks of the compound × rank matrices of the special MASSTs with a lineage table
+        """
+        self.out_dir = out_dir
+        self.special_massts = special_massts if special_massts is not None else SPECIAL_MASSTS
+        self.checkpoint_seconds = checkpoint_seconds
+        self.ranks = list(ranks)
+        self._lock = threading.Lock()
+        self._compounds = {}
+        # per special MASST: compound row, node columns, and counts of each added compound
+        self._entries = {special_masst.prefix: [] for special_masst in self.special_massts}
+        self._last_checkpoint = time.monotonic()
+        self._dirty = False
+        if out_dir:
+            self._load_checkpoint()
+
+    def add_compound(self, compound: str, special_masst_hits: list[tuple[SpecialMasst, pd.DataFrame]] = ()):
+        """
+        Replaces the counts of a compound
+        :param special_masst_hits: the matches joined with the metadata of each special MASST, see
+        masst_tree.metadata_matches
+        """
+        self.add_compound_counts(
+            compound,
+            [
+                (special_masst, hits_df[special_masst.metadata_key].dropna().astype(str).value_counts())
+                for special_masst, hits_df in special_masst_hits
+                if hits_df is not None and len(hits_df) > 0
+            ],
+        )
+
+    def add_compound_counts(
+        self, compound: str, special_masst_counts: list[tuple[SpecialMasst, pd.Series | dict]] = ()
+    ):
+        """
+        Replaces the counts of a compound
+        :param special_masst_counts: the number of matches of each metadata key (as str) of each special MASST as
+        series or dict, e.g., the matched_size of the groups of masst_tree.group_matches
+        """
+        entries = []
+        for special_masst, key_counts in special_masst_counts:
+            if special_masst.prefix not in self._entries or len(key_counts) == 0:
+                continue
+            if isinstance(key_counts, dict):
+                key_counts = pd.Series(key_counts, dtype=np.int64)
+            rollup = tree_rollup(special_masst)
+            columns = key_counts.index.map(rollup.positions)
+            # metadata keys that are not in the tree are not in the tree json either
+            known = columns.notna()
+            entries.append(
+                (
+                    special_masst.prefix,
+                    np.asarray(columns[known], dtype=np.int32),
+                    key_counts.to_numpy(dtype=np.int32)[known],
+                )
+            )
+        with self._lock:
+            row = self._compounds.setdefault(compound, len(self._compounds))
+            for prefix, columns, values in entries:
+                self._entries[prefix].append((row, columns, values))
+            self._dirty = True
+            checkpoint = self.out_dir and time.monotonic() - self._last_checkpoint >= self.checkpoint_seconds
+        if checkpoint:
+            self.checkpoint()
+
+    def add_counts_files(self, compound: str, common_file):
+        """
+        Adds a compound from its counts files, e.g., for compounds that finished after the last checkpoint
+        :return: False if no counts file exists
+        """
+        hits = []
+        for special_masst in self.special_massts:
+            file = compressed_files.find_file("{}_counts_{}.tsv".format(common_file, special_masst.prefix))
+            if file is not None:
+                hits.append(
+                    (special_masst, pd.read_csv(file, sep="\t", usecols=[special_masst.metadata_key], dtype=str))
+                )
+        if len(hits) == 0:
+            return False
+        self.add_compound(compound, hits)
+        return True
+
+    def has_compound(self, compound: str) -> bool:
+        with self._lock:
+            return compound in self._compounds
+
+    def compounds(self) -> list:
+        with self._lock:
+            return list(self._compounds.keys())
+
+    def matrix(self, special_masst: SpecialMasst, rollup=True) -> sparse.csr_matrix:
+        """
+        :param rollup: add the counts of each node to all its ancestors
+        :return: compound × node counts, rows like compounds() and columns like the node_ids of the tree
+        """
+        compounds, entries = self._snapshot()
+        return self._counts_matrix(special_masst, len(compounds), entries[special_masst.prefix], rollup)
+
+    def _snapshot(self) -> tuple[list, dict]:
+        """
+        :return: the compounds and the entries of each special MASST at the same time
+        """
+        with self._lock:
+            return self._snapshot_locked()
+
+    def _snapshot_locked(self) -> tuple[list, dict]:
+        # called with the lock held
+        return list(self._compounds.keys()), {prefix: list(entries) for prefix, entries in self._entries.items()}
+
+    @staticmethod
+    def _counts_matrix(special_masst: SpecialMasst, n_compounds: int, entries: list, rollup=True) -> sparse.csr_matrix:
+        n_nodes = len(tree_rollup(special_masst).node_ids)
+        # the last counts of each compound
+        latest = {}
+        for row, columns, values in entries:
+            latest[row] = (columns, values)
+        rows = np.concatenate([np.full(len(c), row, dtype=np.int32) for row, (c, _) in latest.items()] or [[]])
+        columns = np.concatenate([c for c, _ in latest.values()] or [[]])
+        values = np.concatenate([v for _, v in latest.values()] or [[]])
+        counts = sparse.coo_matrix(
+            (values.astype(np.int64), (rows.astype(np.int64), columns.astype(np.int64))),
+            shape=(n_compounds, n_nodes),
+        ).tocsr()
+        if rollup:
+            counts = counts @ tree_rollup(special_masst).descendants.T
+        return counts.tocsr()
+
+    def to_frame(self, special_masst: SpecialMasst, rollup=True) -> pd.DataFrame:
+        """
+        :return: sparse data frame of compounds × node ids
+        """
+        matrix = self.matrix(special_masst, rollup)
+        return pd.DataFrame.sparse.from_spmatrix(
+            matrix, index=self.compounds()[: matrix.shape[0]], columns=tree_rollup(special_masst).node_ids
+        )
+
+    def rank_frame(self, special_masst: SpecialMasst, rank: str) -> pd.DataFrame | None:
+        """
+        Sums the matches of the taxa at a lineage rank
+        :return: sparse data frame of compounds × rank names, None if the special MASST has no lineage table
+        """
+        index = lineages.lineage_index(special_masst)
+        if index is None:
+            return None
+        matrix, names = lineages.aggregate_matrix(
+            index, self.matrix(special_masst, rollup=False), tree_rollup(special_masst).node_ids, rank
+        )
+        return pd.DataFrame.sparse.from_spmatrix(matrix, index=self.compounds()[: matrix.shape[0]], columns=names)
+
+    def checkpoint(self):
+        """
+        Writes the counts without roll-up of all compounds. A new accumulator on the same directory continues from
+        here
+        """
+        if not self.out_dir:
+            return
+        with self._lock:
+            self._last_checkpoint = time.monotonic()
+            if not self._dirty:
+                return
+            self._dirty = False
+            # compounds added during the checkpoint are in the next one
+            compounds, entries = self._snapshot_locked()
+        checkpoint_dir = os.path.join(self.out_dir, "checkpoint")
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        for special_masst in self.special_massts:
+            save_matrix(
+                self._counts_matrix(special_masst, len(compounds), entries[special_masst.prefix], rollup=False),
+                os.path.join(checkpoint_dir, "{}.npz".format(special_masst.prefix)),
+            )
+            write_json(tree_rollup(special_masst).node_ids, os.path.join(checkpoint_dir, special_masst.prefix + ".json"))
+        # the compounds are written last, a checkpoint is complete once they are written
+        write_json(compounds, os.path.join(checkpoint_dir, COMPOUNDS_FILE))
+        logger.debug("Checkpoint of the co-occurrence of %d compounds", len(compounds))
+
+    def _load_checkpoint(self):
+        checkpoint_dir = os.path.join(self.out_dir, "checkpoint")
+        try:
+            with open(os.path.join(checkpoint_dir, COMPOUNDS_FILE)) as file:
+                compounds = json.load(file)
+        except FileNotFoundError:
+            return
+        self._compounds = {compound: row for row, compound in enumerate(compounds)}
+        for special_masst in self.special_massts:
+            try:
+                counts = sparse.load_npz(os.path.join(checkpoint_dir, "{}.npz".format(special_masst.prefix))).tocsr()
+                with open(os.path.join(checkpoint_dir, special_masst.prefix + ".json")) as file:
+                    node_ids = json.load(file)
+            except FileNotFoundError:
+                continue
+            # the tree may have changed since the checkpoint
+            positions = tree_rollup(special_masst).positions
+            column_map = np.array([positions.get(node_id, -1) for node_id in node_ids], dtype=np.int64)
+            for row in range(min(counts.shape[0], len(compounds))):
+                start, end = counts.indptr[row], counts.indptr[row + 1]
+                columns = column_map[counts.indices[start:end]]
+                known = columns >= 0
+                self._entries[special_masst.prefix].append(
+                    (row, columns[known].astype(np.int32), counts.data[start:end][known].astype(np.int32))
+                )
+        logger.info("Continuing the co-occurrence of %d compounds from the checkpoint", len(compounds))
+
+    def close(self):
+        """
+        Writes the checkpoint, the rolled up compound × node matrix of each special MASST, and the compound × rank
+        matrices of the special MASSTs with a lineage table
+        """
+        if not self.out_dir:
+            return
+        self._dirty = True
+        self.checkpoint()
+        compounds, entries = self._snapshot()
+        write_json(compounds, os.path.join(self.out_dir, COMPOUNDS_FILE))
+        for special_masst in self.special_massts:
+            counts = self._counts_matrix(special_masst, len(compounds), entries[special_masst.prefix], rollup=False)
+            save_matrix(
+                counts @ tree_rollup(special_masst).descendants.T,
+                os.path.join(self.out_dir, "{}_cooccurrence.npz".format(special_masst.prefix)),
+            )
+            write_json(
+                tree_rollup(special_masst).node_ids,
+                os.path.join(self.out_dir, "{}_nodes.json".format(special_masst.prefix)),
+            )
+            index = lineages.lineage_index(special_masst)
+            if index is None:
+                continue
+            for rank in self.ranks:
+                matrix, names = lineages.aggregate_matrix(index, counts, tree_rollup(special_masst).node_ids, rank)
+                save_matrix(
+                    matrix, os.path.join(self.out_dir, "{}_{}_ranks.npz".format(special_masst.prefix, rank))
+                )
+                write_json(names, os.path.join(self.out_dir, "{}_{}_names.json".format(special_masst.prefix, rank)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_cooccurrence(out_dir, special_masst: SpecialMasst) -> pd.DataFrame:
+    """
+    Reads the final matrix of a batch
+    :return: sparse data frame of compounds × node ids with the counts rolled up to the ancestors
+    """
+    with open(os.path.join(out_dir, COMPOUNDS_FILE)) as file:
+        compounds = json.load(file)
+    with open(os.path.join(out_dir, "{}_nodes.json".format(special_masst.prefix))) as file:
+        node_ids = json.load(file)
+    matrix = sparse.load_npz(os.path.join(out_dir, "{}_cooccurrence.npz".format(special_masst.prefix)))
+    return pd.DataFrame.sparse.from_spmatrix(matrix, index=compounds, columns=node_ids)
+
+
+def save_matrix(matrix: sparse.spmatrix, file):
+    # np.savez adds the .npz suffix to other names
+    tmp_file = "{}.{}.tmp.npz".format(file[: -len(".npz")], threading.get_ident())
+    sparse.save_npz(tmp_file, matrix.tocsr())
+    os.replace(tmp_file, file)
+
+
+def write_json(data, file):
+    tmp_file = "{}.{}.tmp".format(file, threading.get_ident())
+    with open(tmp_file, "w") as out:
+        json.dump(data, out)
+    os.replace(tmp_file, file)
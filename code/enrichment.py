@@ -0,0 +1,214 @@
+import json
+import logging
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.special import gammaln
+
+from masst_utils import SpecialMasst
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# node fields of the enrichment in the tree json
+ENRICHMENT_FIELDS = ["fold_enrichment", "enrichment_p", "enrichment_fdr"]
+# relative size of the last term of the tail sums
+TAIL_TOLERANCE = 1e-17
+
+
+def hypergeometric_enrichment(matched_size, group_size, total_matched, total_group) -> tuple[np.ndarray, np.ndarray]:
+    """
+    One-sided enrichment of the matches in a node over all nodes, equal to Fisher's exact test (greater) on the
+    matched and unmatched files in and outside of the node. All arguments broadcast, e.g., compounds × nodes
+    :param matched_size: matches in the node
+    :param group_size: files in the node
+    :param total_matched: matches in the whole tree (root matched_size)
+    :param total_group: files in the whole tree (root group_size)
+    :return: the fold enrichment and the p-value, NaN if the node or tree is empty
+    """
+    matched_size = np.asarray(matched_size, dtype=np.float64)
+    group_size = np.asarray(group_size, dtype=np.float64)
+    total_matched = np.asarray(total_matched, dtype=np.float64)
+    total_group = np.asarray(total_group, dtype=np.float64)
+
+    # multiple matches per file can exceed the files of a node or tree
+    population = np.maximum(total_group, total_matched)
+    draws = np.minimum(group_size, population)
+    successes = np.minimum(total_matched, population)
+    k = np.minimum(matched_size, np.minimum(draws, successes))
+    valid = (draws > 0) & (population > 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fold = np.where(valid & (successes > 0), (k / draws) / (successes / population), np.nan)
+    p = hypergeometric_sf(
+        k, np.where(valid, population, 1), np.where(valid, successes, 0), np.where(valid, draws, 1)
+    )
+    p = np.where(valid, p, np.nan)
+    return fold, p
+
+
+def hypergeometric_sf(k, population, successes, draws) -> np.ndarray:
+    """
+    P(X >= k) of the hypergeometric distribution for arrays of any shape. scipy.stats.hypergeom.sf evaluates each
+    element on its own, this sums all tails at once with the ratio of consecutive terms. Tails above the mode are
+    summed upwards, the others as 1 - P(X < k) downwards, so that the terms always decrease
+    """
+    k, population, successes, draws = np.broadcast_arrays(
+        *(np.asarray(a, dtype=np.float64) for a in (k, population, successes, draws))
+    )
+    shape = k.shape
+    k, population, successes, draws = (a.ravel() for a in (k, population, successes, draws))
+    lowest = np.maximum(0, draws - (population - successes))
+    highest = np.minimum(successes, draws)
+    p = np.where(k <= lowest, 1.0, 0.0)
+
+    inside = np.flatnonzero((k > lowest) & (k <= highest))
+    mode = np.floor((draws[inside] + 1) * (successes[inside] + 1) / (population[inside] + 2))
+    upper = k[inside] > mode
+    # start of each tail: k upwards or k - 1 downwards
+    x = np.where(upper, k[inside], k[inside] - 1)
+    M, n, N = population[inside], successes[inside], draws[inside]
+    low, high = lowest[inside], highest[inside]
+    term = np.exp(log_binomial(n, x) + log_binomial(M - n, N - x) - log_binomial(M, N))
+    tail = term.copy()
+
+    active = np.flatnonzero(term > 0)
+    while len(active) > 0:
+        xa, Ma, na, Na, up = x[active], M[active], n[active], N[active], upper[active]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = np.where(
+                up,
+                (na - xa) * (Na - xa) / ((xa + 1) * (Ma - na - Na + xa + 1)),
+                xa * (Ma - na - Na + xa) / ((na - xa + 1) * (Na - xa + 1)),
+            )
+        xa = np.where(up, xa + 1, xa - 1)
+        in_support = np.where(up, xa <= high[active], xa >= low[active])
+        term_a = np.where(in_support, term[active] * ratio, 0.0)
+        tail[active] += term_a
+        term[active] = term_a
+        x[active] = xa
+        active = active[term_a > tail[active] * TAIL_TOLERANCE]
+
+    p[inside] = np.where(upper, tail, 1.0 - tail)
+    return np.clip(p, 0.0, 1.0).reshape(shape)
+
+
+def log_binomial(n, k):
+    return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+
+
+def fdr_bh(p_values, groups=None, n_tests=None) -> np.ndarray:
+    """
+    Benjamini-Hochberg adjusted p-values, computed within each group in one sort
+    :param p_values: NaN values are not tested and stay NaN
+    :param groups: group code of each p-value, e.g., the compound. None is one group
+    :param n_tests: number of tests of each group (scalar or by group code), None counts the p-values. More tests than
+    p-values treat the missing ones as p=1, e.g., for the nodes without matches
+    :return: the adjusted p-values in the input order
+    """
+    p_values = np.asarray(p_values, dtype=np.float64)
+    groups = np.zeros(len(p_values), dtype=np.int64) if groups is None else np.asarray(groups, dtype=np.int64)
+    q = np.full(len(p_values), np.nan)
+    tested = np.flatnonzero(~np.isnan(p_values))
+    if len(tested) == 0:
+        return q
+
+    order = tested[np.lexsort((p_values[tested], groups[tested]))]
+    sorted_groups = groups[order]
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    sizes = np.diff(np.r_[starts, len(order)])
+    rank = np.arange(len(order)) - np.repeat(starts, sizes) + 1
+    if n_tests is None:
+        m = np.repeat(sizes, sizes)
+    elif np.ndim(n_tests) == 0:
+        m = np.full(len(order), n_tests)
+    else:
+        m = np.asarray(n_tests)[sorted_groups]
+
+    adjusted = np.minimum(p_values[order] * m / rank, 1.0)
+    # cumulative minimum from the largest p-value within each group: the offset keeps groups apart as adjusted <= 1
+    offset = 2.0 * np.repeat(np.arange(len(starts)), sizes)
+    adjusted = np.minimum.accumulate((adjusted + offset)[::-1])[::-1] - offset
+    q[order] = adjusted
+    return q
+
+
+def tree_nodes(root) -> list:
+    """
+    :return: all nodes of a tree in pre-order
+    """
+    nodes = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(reversed(node.get("children", [])))
+    return nodes
+
+
+def add_enrichment_to_tree(root):
+    """
+    Adds the fold enrichment, p-value, and FDR over all nodes to each node. The root needs its group_size and
+    matched_size, see json_ontology_extender.calc_root_stats
+    """
+    nodes = tree_nodes(root)
+    matched = np.array([node.get("matched_size", 0) for node in nodes], dtype=np.float64)
+    group = np.array([node.get("group_size", 0) for node in nodes], dtype=np.float64)
+    fold, p = hypergeometric_enrichment(matched, group, root.get("matched_size", 0), root.get("group_size", 0))
+    q = fdr_bh(p)
+    for node, node_fold, node_p, node_q in zip(nodes, fold.tolist(), p.tolist(), q.tolist()):
+        # json has no NaN
+        node["fold_enrichment"] = None if np.isnan(node_fold) else node_fold
+        node["enrichment_p"] = None if np.isnan(node_p) else node_p
+        node["enrichment_fdr"] = None if np.isnan(node_q) else node_q
+
+
+@lru_cache(maxsize=None)
+def tree_total_group_size(tree_file) -> int:
+    """
+    :return: the files of all nodes like the root group_size of the trees, see json_ontology_extender.calc_root_stats
+    """
+    with open(tree_file) as file:
+        root = json.load(file)
+    return sum(child.get("group_size", 0) for child in root.get("children", []))
+
+
+def summary_enrichment(summary_df: pd.DataFrame, special_masst: SpecialMasst) -> pd.DataFrame:
+    """
+    Enrichment of all matched nodes of all compounds at once. Only the matched entries are evaluated, the other nodes
+    count as tests with p=1 in the FDR of each compound
+
+    :param summary_df: sparse node × compound matched_size with the group_size and Level in the index, see
+    masst_dataset_summary.create_summary_file without binary presence
+    :return: one row per compound and matched node with the node key, matched_size, group_size, fold_enrichment,
+    enrichment_p, and enrichment_fdr
+    """
+    node_key = special_masst.tree_node_key
+    if hasattr(summary_df, "sparse"):
+        matrix = summary_df.sparse.to_coo().tocsc()
+    else:
+        matrix = sparse.csc_matrix(summary_df.fillna(0).to_numpy(dtype=np.float64))
+    matrix.eliminate_zeros()
+    coo = matrix.tocoo()
+
+    group_sizes = summary_df.index.get_level_values("group_size").to_numpy(dtype=np.float64)
+    levels = summary_df.index.get_level_values("Level").to_numpy()
+    # the root matched_size is the sum of its children
+    total_matched = np.asarray(matrix[levels == 1].sum(axis=0)).ravel()
+    total_group = tree_total_group_size(special_masst.tree_file)
+
+    fold, p = hypergeometric_enrichment(coo.data, group_sizes[coo.row], total_matched[coo.col], total_group)
+    q = fdr_bh(p, groups=coo.col, n_tests=len(summary_df))
+    return pd.DataFrame(
+        {
+            "Compound": summary_df.columns.to_numpy()[coo.col],
+            node_key: summary_df.index.get_level_values(node_key).to_numpy()[coo.row],
+            "matched_size": coo.data.astype(np.int64),
+            "group_size": group_sizes[coo.row].astype(np.int64),
+            "fold_enrichment": fold,
+            "enrichment_p": p,
+            "enrichment_fdr": q,
+        }
+    ).sort_values(["Compound", "enrichment_p"], kind="stable", ignore_index=True)
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+import compressed_files
+from masst_utils import SpecialMasst
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# the columns of the matches that end up in the trees
+TREE_INPUT_COLUMNS = ["USI", "file_usi", "Cosine", "Matching Peaks", "Delta Mass"]
+# placeholders of the report template
+REPORT_PLACEHOLDERS = [
+    "PLACEHOLDER_JSON_DATA",
+    "LIBRARY_JSON_DATA_PLACEHOLDER",
+    "INPUT_LABEL_PLACEHOLDER",
+    "USI_LABEL_PLACEHOLDER",
+    "PARAMS_PLACEHOLDER",
+]
+
+# file hashes by path, size, and modification time
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+def file_hash(path) -> str:
+    """
+    sha256 of a file, cached until its size or modification time changes
+    :return: the hex digest or an empty string if the file does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return ""
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _file_hashes_lock:
+        if key in _file_hashes:
+            return _file_hashes[key]
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            sha.update(block)
+    digest = sha.hexdigest()
+    with _file_hashes_lock:
+        _file_hashes[key] = digest
+    return digest
+
+
+def special_masst_data_hash(special_masst: SpecialMasst) -> str:
+    """
+    :return: hash of the tree and metadata files of a special MASST
+    """
+    return text_hash(file_hash(special_masst.tree_file) + file_hash(special_masst.metadata_file))
+
+
+@lru_cache(maxsize=None)
+def template_hash(in_html="../code/collapsible_tree_v3.html") -> str:
+    """
+    :return: hash of the report template and all its local dependencies, once per process
+    """
+    # imported here as the bundling pulls in bs4
+    import bundle_to_html
+
+    return bundle_to_html.html_shell_fingerprint(in_html, REPORT_PLACEHOLDERS, True)
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def matches_hash(matches_df: pd.DataFrame | None) -> str:
+    """
+    Hash of the tree input columns of the matches. The same matches give the same hash whether they come from the
+    fastMASST response or were read back from the match table
+    """
+    if matches_df is None or len(matches_df) == 0:
+        return ""
+    columns = [c for c in TREE_INPUT_COLUMNS if c in matches_df.columns]
+    df = matches_df[columns].reset_index(drop=True)
+    for c in columns:
+        if pd.api.types.is_numeric_dtype(df[c]):
+            df[c] = df[c].astype(np.float64)
+        else:
+            df[c] = df[c].astype(str)
+    values = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return hashlib.sha256(repr(columns).encode("utf-8") + values.tobytes()).hexdigest()
+
+
+def artefact_fingerprint(*inputs) -> str:
+    """
+    :param inputs: json serializable inputs of an artefact, e.g., hashes, labels, and options
+    :return: the fingerprint of the artefact
+    """
+    return text_hash(json.dumps(inputs, sort_keys=True, default=str))
+
+
+def manifest_file(common_file) -> str:
+    return "{}_fingerprints.json".format(common_file)
+
+
+def read_manifest(common_file) -> dict:
+    """
+    :return: the manifest of the compound outputs or an empty dict
+    """
+    try:
+        return json.loads(compressed_files.read_text(manifest_file(common_file)))
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning("Cannot read fingerprints of %s: %s", common_file, e)
+        return {}
+
+
+def write_manifest(common_file, manifest: dict):
+    """
+    Writes the manifest of the compound outputs atomically
+    """
+    file = manifest_file(common_file)
+    os.makedirs(os.path.dirname(file) or ".", exist_ok=True)
+    tmp_file = "{}.{}.tmp".format(file, threading.get_ident())
+    with open(tmp_file, "w", encoding="utf-8") as out:
+        json.dump(manifest, out, indent=1, sort_keys=True)
+    os.replace(tmp_file, file)
+
+
+def tree_fingerprints(
+    matches_df: pd.DataFrame | None,
+    variant_key: str,
+    labels: dict,
+    render_options: dict,
+    special_massts: list[SpecialMasst],
+) -> dict:
+    """
+    Fingerprints of the tree json and report of each special MASST for one match variant
+    :param variant_key: prefix of the artefact keys, e.g., "" for the matches or "analog_" for the analog matches
+    :param labels: the library matches json and the labels of the report
+    :param render_options: options that change the outputs, e.g., prune_depth or compression
+    :return: dict of artefact key, e.g., analog_food, and fingerprint
+    """
+    shared_inputs = [matches_hash(matches_df), labels, render_options, template_hash()]
+    return {
+        variant_key + special_masst.prefix: artefact_fingerprint(
+            shared_inputs, special_masst_data_hash(special_masst)
+        )
+        for special_masst in special_massts
+    }
+
+
+def combined_fingerprint(artefacts: dict, variant_key: str, special_massts: list[SpecialMasst]) -> str:
+    """
+    The combined tree depends on the trees of all special MASSTs of the variant
+    :param artefacts: fingerprints of the trees, see tree_fingerprints
+    """
+    return artefact_fingerprint(
+        [artefacts.get(variant_key + special_masst.prefix, "") for special_masst in special_massts]
+    )
@@ -1,4 +1,4 @@
-var library_data = LIBRARY_JSON_DATA_PLACEHOLDER;
+// library_data is set in report_data.js
 var table_plot = makeTable("libTable")
   .datum(library_data)
   .sortBy('Cosine', false)
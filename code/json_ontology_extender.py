@@ -6,12 +6,31 @@ import numpy as np
 from distutils.util import strtobool
 import logging
 
+import compiled_masst
+import enrichment
 from masst_utils import SpecialMasst
+from output_writer import write_output
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# fields that the report derives itself or that are implicit in the tree structure
+REDUNDANT_NODE_FIELDS = [
+    "pie_data",
+    "occurrence_fraction",
+    "duplication",
+    "type",
+    "parent_id",
+    "parent_name",
+]
+
+
 class NpEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.integer):
@@ -24,28 +43,44 @@ class NpEncoder(json.JSONEncoder):
             return super(NpEncoder, self).default(obj)
 
 
-def add_data_to_node(node, meta_matched_df: pd.DataFrame, node_field, data_field):
+def add_data_to_node(
+    node,
+    meta_matched_df: pd.DataFrame | dict,
+    node_field,
+    data_field,
+    compiled: compiled_masst.CompiledMasst = None,
+    nodes: list = None,
+):
     """
     Merge data into node and apply to all children
     :param node: the current node in a tree structure with ["children"] property
-    :param meta_matched_df: the data frame with additional data
+    :param meta_matched_df: the data frame with additional data or a dict of node id (as str) to node data
     :param node_field: node[field] determines the key to align tree and additional data
     :param data_field: data[field] determines the key to align tree and additional data
+    :param compiled: the compiled special MASST of the tree. The data goes to the nodes at the positions of the node
+    column of meta_matched_df (see masst_tree.group_matches) and all nodes with the same id without walking the tree
+    :param nodes: the nodes of the compiled tree in pre-order, see CompiledMasst.tree_nodes
     """
+    if compiled is not None:
+        meta_matched_df = meta_matched_df.drop_duplicates("node")
+        positions = meta_matched_df["node"].tolist()
+        records = meta_matched_df.drop(columns=[data_field, "node"]).to_dict(orient="records")
+        for position, node_data in zip(positions, records):
+            for same_id_position in compiled.same_id_nodes(position):
+                set_node_data(nodes[same_id_position], node_data)
+        return
+
+    if isinstance(meta_matched_df, pd.DataFrame):
+        meta_matched_df = create_node_data_lookup(meta_matched_df, data_field)
     try:
         ncbi = node.get(node_field)
         if ncbi is None:
             logger.warning("node has no id {}".format(node.get("name", "NONAME")))
         else:
             # use string for comparison of IDs
-            filtered = meta_matched_df[meta_matched_df[data_field] == str(ncbi)]
-            if len(filtered) > 0:
-                rowi = filtered.index[0]
-                for col, value in meta_matched_df.items():
-                    if col == "matches_json":
-                        node["matches"] = json.loads(value[rowi])
-                    elif col != data_field:
-                        node[col] = value[rowi]
+            node_data = meta_matched_df.get(str(ncbi))
+            if node_data is not None:
+                set_node_data(node, node_data)
     except Exception as ex:
         logger.exception(ex)
     # apply to all children
@@ -54,6 +89,23 @@ def add_data_to_node(node, meta_matched_df: pd.DataFrame, node_field, data_field
             add_data_to_node(child, meta_matched_df, node_field, data_field)
 
 
+def set_node_data(node, node_data: dict):
+    for col, value in node_data.items():
+        if col == "matches_json":
+            node["matches"] = json.loads(value)
+        else:
+            node[col] = value
+
+
+def create_node_data_lookup(meta_matched_df: pd.DataFrame, data_field) -> dict:
+    """
+    :return: dict of the data_field value as string to a dict of all other columns (first row per value)
+    """
+    df = meta_matched_df.drop_duplicates(data_field)
+    keys = df[data_field].astype(str)
+    return dict(zip(keys, df.drop(columns=[data_field]).to_dict(orient="records")))
+
+
 def accumulate_field_in_parents(node, field):
     """
     check count and group size fields and accumulate over tree
@@ -69,11 +121,49 @@ def accumulate_field_in_parents(node, field):
     return node_value
 
 
+def accumulate_field_in_compiled_parents(nodes: list, parents: list, field, values: list):
+    """
+    accumulate_field_in_parents on the parent positions of a compiled tree
+    :param nodes: the nodes in pre-order, a parent is before its children
+    :param values: the value of each node, 0 for missing values
+    """
+    totals = list(values)
+    for position in range(len(nodes) - 1, 0, -1):
+        totals[parents[position]] += totals[position]
+    for node, total in zip(nodes, totals):
+        node[field] = total
+
+
+def calc_compiled_node_sizes(nodes: list, compiled: compiled_masst.CompiledMasst, node_key):
+    """
+    The id check and group_size and matched_size propagation of add_data_to_ontology_file on the arrays of a
+    compiled tree
+    :param nodes: the nodes of the compiled tree in pre-order with the added data, see CompiledMasst.tree_nodes
+    """
+    missing_ids = int(np.count_nonzero(compiled.node_ids == ""))
+    if missing_ids > 0:
+        logger.warning("{} nodes have no id".format(missing_ids))
+        # like field_missing, only the root gets the name as id
+        if compiled.node_ids[0] == "":
+            logger.error("Missing: {}".format(nodes[0].get("name", "NONAME")))
+            nodes[0][node_key] = nodes[0].get("name", "")
+        logger.error("{} id is missing in a node".format(node_key))
+
+    parents = compiled.parents.tolist()
+    if np.any(compiled.group_sizes < 0):
+        accumulate_field_in_compiled_parents(nodes, parents, "group_size", np.maximum(compiled.group_sizes, 0).tolist())
+    matched_sizes = [node.get("matched_size") for node in nodes]
+    if any(matched_size is None for matched_size in matched_sizes):
+        accumulate_field_in_compiled_parents(
+            nodes, parents, "matched_size", [matched_size or 0 for matched_size in matched_sizes]
+        )
+
+
 def set_field_in_all_nodes(node, field, value, in_pie_data=True):
     """
-    set field to value in all nodes
+    set field to value in all nodes. Compact nodes without pie data get the field directly
     """
-    if in_pie_data:
+    if in_pie_data and "pie_data" in node:
         node["pie_data"][0][field] = value
         node["pie_data"][1][field] = value
     else:
@@ -123,21 +213,112 @@ def add_pie_data_to_node_and_children(node, apply_to_children=True):
             add_pie_data_to_node_and_children(child)
 
 
+def prune_unmatched_nodes(node, prune_depth, depth=0):
+    """
+    removes all subtrees without matches below the prune_depth. The group_size of the remaining nodes still
+    includes the removed subtrees
+    :param node: the current node in a tree structure with ["children"] property
+    :param prune_depth: children at this depth or deeper are removed if they have no matches, the root is depth 0
+    """
+    children = node.get("children")
+    if not children:
+        return
+    if depth + 1 >= prune_depth:
+        children = [child for child in children if child.get("matched_size", 0) > 0]
+        node["children"] = children
+    for child in children:
+        prune_unmatched_nodes(child, prune_depth, depth + 1)
+
+
+def compact_node_fields(node):
+    """
+    removes redundant fields, empty values, and empty children lists from all nodes
+    """
+    for field in REDUNDANT_NODE_FIELDS:
+        node.pop(field, None)
+    for field in [field for field, value in node.items() if value is None]:
+        del node[field]
+    if "children" in node:
+        if len(node["children"]) == 0:
+            del node["children"]
+        else:
+            for child in node["children"]:
+                compact_node_fields(child)
+
+
+def dumps_tree(tree, format_out_json=False, compact_json=False) -> str:
+    """
+    serializes a tree to json
+    :param format_out_json: indented output
+    :param compact_json: without spaces between the items, uses orjson if available. NaN and infinite values are
+    written as null with both orjson and json
+    """
+    if not compact_json:
+        if format_out_json:
+            return json.dumps(tree, indent=2, cls=NpEncoder)
+        return json.dumps(tree, cls=NpEncoder)
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if format_out_json:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(tree, option=option).decode("utf-8")
+    if format_out_json:
+        return json.dumps(non_finite_to_none(tree), indent=2, cls=NpEncoder)
+    return json.dumps(non_finite_to_none(tree), separators=(",", ":"), cls=NpEncoder)
+
+
+def non_finite_to_none(value):
+    """
+    :return: a copy with None for all NaN and infinite floats in nested dicts and lists, like orjson writes them
+    """
+    if isinstance(value, dict):
+        return {key: non_finite_to_none(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [non_finite_to_none(item) for item in value]
+    if isinstance(value, (float, np.floating)) and not np.isfinite(value):
+        return None
+    return value
+
+
 def add_data_to_ontology_file(
     special_masst: SpecialMasst,
     output="../output/merged_ontology_data.json",
     in_data="../examples/caffeic_acid.tsv",
     meta_matched_df: pd.DataFrame = None,
     format_out_json=False,
+    prune_depth: int = None,
+    compact_json=False,
+    compression: str | None = None,
+    add_enrichment=False,
 ):
+    """
+    Adds the matches to the special MASST tree and exports the tree as json
+    :param prune_depth: removes subtrees without matches at this depth or deeper (root is depth 0), None keeps the
+    full tree
+    :param compact_json: removes all node fields that the report derives itself (see REDUNDANT_NODE_FIELDS)
+    :param compression: gzip or zstd writes output with the suffix .gz or .zst, None writes plain json
+    :param add_enrichment: adds the fold enrichment, p-value, and FDR of the matches to each node, see
+    enrichment.add_enrichment_to_tree
+    """
     data_key = special_masst.metadata_key
     node_key = special_masst.tree_node_key
-    with open(special_masst.tree_file) as json_file:
-        treeRoot = json.load(json_file)
 
-        # read the additional data
-        if meta_matched_df is None:
-            meta_matched_df = pd.read_csv(in_data, sep="\t")
+    # read the additional data
+    if meta_matched_df is None:
+        meta_matched_df = pd.read_csv(in_data, sep="\t")
+
+    compiled = compiled_masst.load_compiled(special_masst)
+    if compiled is not None and "node" in meta_matched_df.columns:
+        # the matches go to their node positions and the sizes are propagated on the parent array
+        nodes = compiled.tree_nodes()
+        treeRoot = nodes[0]
+        add_data_to_node(treeRoot, meta_matched_df, node_key, data_key, compiled, nodes)
+        calc_compiled_node_sizes(nodes, compiled, node_key)
+        for node in nodes:
+            calc_node_stats(node)
+    else:
+        # a new tree from the compiled artefact or the tree json
+        treeRoot = compiled.tree_root() if compiled is not None else compiled_masst.load_tree(special_masst)
         # ensure that the grouping columns are strings as we usually match string ids
         meta_matched_df[data_key] = meta_matched_df[data_key].astype(str)
 
@@ -159,23 +340,29 @@ def add_data_to_ontology_file(
 
         calc_stats(treeRoot)
 
-        # calc gfop specific data for root
-        calc_root_stats(treeRoot)
+    # calc gfop specific data for root
+    calc_root_stats(treeRoot)
+    if add_enrichment:
+        enrichment.add_enrichment_to_tree(treeRoot)
+    if prune_depth is not None:
+        prune_unmatched_nodes(treeRoot, prune_depth)
+    if compact_json:
+        compact_node_fields(treeRoot)
+    else:
         # add data in format for pie charts
         add_pie_data_to_node_and_children(treeRoot)
 
-        with open(output, "w") as file:
-            if format_out_json:
-                out_tree = json.dumps(treeRoot, indent=2, cls=NpEncoder)
-            else:
-                out_tree = json.dumps(treeRoot, cls=NpEncoder)
-            print(out_tree, file=file)
+    write_output(output, dumps_tree(treeRoot, format_out_json, compact_json) + "\n", compression=compression)
 
 
 def calc_stats(node):
     if "children" in node:
         for child in node["children"]:
             calc_stats(child)
+    calc_node_stats(node)
+
+
+def calc_node_stats(node):
     if node["group_size"] == 0:
         node["occurrence_fraction"] = 0
     else:
@@ -0,0 +1,143 @@
+import logging
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from masst_utils import SpecialMasst
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# lineage tables of the special MASSTs with NCBI taxonomy
+LINEAGE_FILES = {
+    "microbe": "../lineages/microbe_masst_lineages.csv",
+    "plant": "../lineages/plant_masst_lineages.csv",
+}
+LINEAGE_KEY = "Taxa_NCBI"
+
+
+@dataclass
+class LineageIndex:
+    """
+    The lineage of each taxon as integer codes per rank. Taxa are sorted for vectorized lookups, code -1 marks
+    taxa without a name at a rank
+    """
+
+    # sorted NCBI taxon ids
+    taxa: np.ndarray
+    ranks: list
+    # rank to the code of each taxon
+    codes: dict
+    # rank to the name of each code
+    names: dict
+
+    def taxon_positions(self, taxa) -> np.ndarray:
+        """
+        :param taxa: NCBI taxon ids, numbers or strings
+        :return: position of each taxon in the index, -1 for unknown taxa
+        """
+        taxa = pd.to_numeric(pd.Series(np.asarray(taxa)), errors="coerce").to_numpy(dtype=np.float64)
+        known = ~np.isnan(taxa)
+        taxa = np.where(known, taxa, -1).astype(np.int64)
+        positions = np.searchsorted(self.taxa, taxa)
+        positions = np.minimum(positions, len(self.taxa) - 1)
+        return np.where(known & (self.taxa[positions] == taxa), positions, -1)
+
+    def rank_codes(self, taxa, rank: str) -> np.ndarray:
+        """
+        :return: code of the rank name of each taxon, -1 for unknown taxa and taxa without this rank
+        """
+        positions = self.taxon_positions(taxa)
+        codes = self.codes[rank][np.maximum(positions, 0)]
+        return np.where(positions >= 0, codes, -1)
+
+    def rank_matrix(self, taxa, rank: str) -> sparse.csr_matrix:
+        """
+        :return: taxa × rank names indicator matrix to sum taxon counts at a rank
+        """
+        codes = self.rank_codes(taxa, rank)
+        rows = np.flatnonzero(codes >= 0)
+        return sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int64), (rows, codes[rows])), shape=(len(codes), len(self.names[rank]))
+        )
+
+
+@lru_cache(maxsize=None)
+def read_lineage_index(lineage_file) -> LineageIndex:
+    lineage_df = pd.read_csv(lineage_file).sort_values(LINEAGE_KEY)
+    ranks = [column for column in lineage_df.columns if column != LINEAGE_KEY]
+    codes, names = {}, {}
+    for rank in ranks:
+        rank_codes, rank_names = pd.factorize(lineage_df[rank], sort=True)
+        codes[rank] = rank_codes.astype(np.int32)
+        names[rank] = np.asarray(rank_names, dtype=object)
+    return LineageIndex(
+        taxa=lineage_df[LINEAGE_KEY].to_numpy(dtype=np.int64), ranks=ranks, codes=codes, names=names
+    )
+
+
+def lineage_index(special_masst: SpecialMasst) -> LineageIndex | None:
+    """
+    :return: the lineage index of a special MASST, loaded once per process. None if it has no lineage table
+    """
+    lineage_file = LINEAGE_FILES.get(special_masst.prefix)
+    if lineage_file is None or special_masst.metadata_key != LINEAGE_KEY:
+        return None
+    return read_lineage_index(lineage_file)
+
+
+def aggregate_ranks(
+    index: LineageIndex,
+    hits_df: pd.DataFrame,
+    rank: str,
+    group_columns=("Compound",),
+    taxon_column=LINEAGE_KEY,
+    file_column="file_usi",
+) -> pd.DataFrame:
+    """
+    Sums the matches of the taxa at a rank and counts the distinct files
+    :param hits_df: one row per match with the taxon and file, e.g., the counts files or tables of the result store
+    :param group_columns: e.g., the compound, empty for the hits of one compound
+    :return: the group columns, the rank name, matches, and files (if the file column exists)
+    """
+    group_columns = [column for column in group_columns if column in hits_df.columns]
+    codes = index.rank_codes(hits_df[taxon_column], rank)
+    known = codes >= 0
+    df = hits_df.loc[known, group_columns + ([file_column] if file_column in hits_df.columns else [])]
+    df = df.assign(_code=codes[known])
+    keys = group_columns + ["_code"]
+
+    result_df = df.groupby(keys, sort=False, observed=True).size().rename("matches").reset_index()
+    if file_column in df.columns:
+        files = df.drop_duplicates(keys + [file_column]).groupby(keys, sort=False, observed=True).size()
+        result_df = result_df.merge(files.rename("files").reset_index(), on=keys, how="left")
+    result_df.insert(len(group_columns), rank, index.names[rank][result_df["_code"].to_numpy()])
+    return result_df.drop(columns=["_code"])
+
+
+def rank_matrix(rank_df: pd.DataFrame, rank: str, value="matches", compound_column="Compound") -> pd.DataFrame:
+    """
+    :param rank_df: see aggregate_ranks
+    :param value: matches or files
+    :return: sparse data frame of compounds × rank names
+    """
+    compound_codes, compounds = pd.factorize(rank_df[compound_column].astype(str))
+    name_codes, names = pd.factorize(rank_df[rank])
+    matrix = sparse.coo_matrix(
+        (rank_df[value].to_numpy(dtype=np.float64), (compound_codes, name_codes)),
+        shape=(len(compounds), len(names)),
+    ).tocsr()
+    return pd.DataFrame.sparse.from_spmatrix(matrix, index=list(compounds), columns=list(names))
+
+
+def aggregate_matrix(index: LineageIndex, matrix: sparse.spmatrix, taxa, rank: str) -> tuple[sparse.csr_matrix, list]:
+    """
+    Sums the columns of a compound × taxon matrix at a rank, e.g., the counts of the co-occurrence accumulator
+    without roll-up
+    :param taxa: the taxon id of each column
+    :return: compound × rank name matrix and the rank names
+    """
+    return (sparse.csr_matrix(matrix) @ index.rank_matrix(taxa, rank)).tocsr(), list(index.names[rank])
@@ -1,3 +1,4 @@
+import os
 import sys
 import logging
 import pandas as pd
@@ -6,13 +7,24 @@ import re
 import argparse
 from distutils.util import strtobool
 import pyteomics.mgf
-from pathlib import Path
 
 from concurrent.futures import ThreadPoolExecutor
 from concurrent.futures import wait
+from contextlib import ExitStack
 
 import masst_client
+import parquet_sink
+from parquet_sink import ParquetResultSink
+from results_db import ResultsIndex
+from cooccurrence import CooccurrenceAccumulator
+from output_writer import OutputWriter
 from masst_utils import DataBase
+from utils import OutputOptions
+from utils import scan_output_files
+from compressed_files import COMPRESSION_SUFFIXES
+from compressed_files import check_compression
+from compressed_files import compressed_file_name
+from compressed_files import strip_compression_suffix
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -25,6 +37,72 @@ def path_safe(file):
     return re.sub("[^-a-zA-Z0-9_.() ]+", "_", file)
 
 
+def finished_jobs(compound_names, out_filename_no_ext, result_store=None, shard=False) -> list:
+    """
+    A job is finished if its matches file exists or the result store marked the compound as finished. The
+    existing matches files are listed in one directory sweep instead of checking each file
+    :param shard: the outputs are in hashed subdirectories
+    :return: list of bool for each compound
+    """
+    if result_store:
+        finished = parquet_sink.finished_compounds(result_store)
+        return [compound_name in finished for compound_name in compound_names]
+
+    # plain or compressed matches files
+    suffixes = tuple(compressed_file_name("_matches.tsv", c) for c in [None, *COMPRESSION_SUFFIXES.keys()])
+    existing_files = {
+        strip_compression_suffix(file)
+        for file in scan_output_files(out_filename_no_ext, suffixes, shard)
+    }
+    return [
+        os.path.normpath(
+            "{}_matches.tsv".format(
+                masst_client.common_base_file_name(compound_name, out_filename_no_ext, shard)
+            )
+        )
+        in existing_files
+        for compound_name in compound_names
+    ]
+
+
+def enter_output(outputs: ExitStack, output):
+    """
+    :param outputs: stack that closes the outputs of a batch
+    :param output: sink, index, writer or executor, None if disabled
+    :return: the output
+    """
+    if output is None:
+        return None
+    return outputs.enter_context(output)
+
+
+def create_cooccurrence(
+    cooccurrence_dir, finished_compounds, out_filename_no_ext, output_options: OutputOptions = None
+) -> CooccurrenceAccumulator | None:
+    """
+    Continues the co-occurrence from its checkpoint. Skipped compounds that finished after the checkpoint are added
+    from their counts files
+    """
+    if not cooccurrence_dir:
+        return None
+    cooccurrence = CooccurrenceAccumulator(cooccurrence_dir)
+    shard = output_options is not None and output_options.shard_outputs
+    missing = [compound for compound in finished_compounds if not cooccurrence.has_compound(compound)]
+    not_found = [
+        compound
+        for compound in missing
+        if not cooccurrence.add_counts_files(
+            compound, masst_client.common_base_file_name(compound, out_filename_no_ext, shard)
+        )
+    ]
+    if len(not_found) > 0:
+        logger.warning(
+            "%d finished compounds are missing in the co-occurrence checkpoint and have no counts files",
+            len(not_found),
+        )
+    return cooccurrence
+
+
 def run_on_usi_list_or_mgf_file(
     in_file,
     out_file_no_extension="../output/fastMASST",
@@ -44,6 +122,12 @@ def run_on_usi_list_or_mgf_file(
     library: str | DataBase = None,
     parallel_queries=10,
     skip_existing=False,
+    render_workers=1,
+    output_options: OutputOptions = None,
+    result_store=None,
+    results_db=None,
+    writer_threads=0,
+    cooccurrence_dir=None,
 ):
     """
 
@@ -61,6 +145,15 @@ def run_on_usi_list_or_mgf_file(
     :param analog_mass_above: analog search window above precursor mz
     :param parallel_queries: perform queries in parallel
     :param skip_existing: skip existing files
+    :param render_workers: processes that render the trees of all compounds, 1 renders in the query threads
+    :param output_options: options for the trees and reports of each compound
+    :param result_store: directory of a parquet result store that gets all tables instead of TSV files per
+    compound, None writes TSV files
+    :param results_db: SQLite database file that indexes the matches in special MASST nodes of all compounds
+    :param writer_threads: threads that write the output files in the background, 0 writes them in the query
+    threads
+    :param cooccurrence_dir: directory of the compound × node matrices of all special MASSTs that are updated with
+    each compound and checkpointed during the batch, None creates no matrices
     :return: success rate between 0-1 (skipped existing files excluded)
     """
     if str(in_file).endswith(".mgf"):
@@ -78,6 +171,12 @@ def run_on_usi_list_or_mgf_file(
             library=library,
             parallel_queries=parallel_queries,
             skip_existing=skip_existing,
+            render_workers=render_workers,
+            output_options=output_options,
+            result_store=result_store,
+            results_db=results_db,
+            writer_threads=writer_threads,
+            cooccurrence_dir=cooccurrence_dir,
         )
     else:
         return run_on_usi_and_id_list(
@@ -97,6 +196,12 @@ def run_on_usi_list_or_mgf_file(
             library=library,
             parallel_queries=parallel_queries,
             skip_existing=skip_existing,
+            render_workers=render_workers,
+            output_options=output_options,
+            result_store=result_store,
+            results_db=results_db,
+            writer_threads=writer_threads,
+            cooccurrence_dir=cooccurrence_dir,
         )
 
 
@@ -117,6 +222,12 @@ def run_on_usi_and_id_list(
     library: str = None,
     parallel_queries=100,
     skip_existing=False,
+    render_workers=1,
+    output_options: OutputOptions = None,
+    result_store=None,
+    results_db=None,
+    writer_threads=0,
+    cooccurrence_dir=None,
 ):
     jobs_df = pd.read_csv(input_file, sep=sep)
     jobs_df.rename(
@@ -129,13 +240,13 @@ def run_on_usi_and_id_list(
 
     if skip_existing:
         all_len = len(jobs_df)
-        jobs_df["file_path"] = [
-            "{}_matches.tsv".format(
-                masst_client.common_base_file_name(compound_name, out_filename_no_ext)
-            )
-            for compound_name in jobs_df["Compound"]
-        ]
-        jobs_df["finished"] = [Path(file).is_file() for file in jobs_df["file_path"]]
+        jobs_df["finished"] = finished_jobs(
+            jobs_df["Compound"],
+            out_filename_no_ext,
+            result_store,
+            shard=output_options is not None and output_options.shard_outputs,
+        )
+        finished_compounds = jobs_df["Compound"][jobs_df["finished"]].tolist()
         jobs_df = jobs_df[~jobs_df["finished"]]
         logger.info(
             "Running fast microbe masst on input n={} spectra (total with already finished was {} spectra)".format(
@@ -143,32 +254,49 @@ def run_on_usi_and_id_list(
             )
         )
     else:
+        finished_compounds = []
         logger.info(
             "Running fast microbe masst on input n={} spectra".format(len(jobs_df))
         )
 
-    with ThreadPoolExecutor(parallel_queries) as executor:
-        futures = [
-            executor.submit(
-                masst_client.query_usi_or_id,
-                out_filename_no_ext,
-                compound_id,
-                name,
-                precursor_mz_tol=precursor_mz_tol,
-                mz_tol=mz_tol,
-                min_cos=min_cos,
-                min_matched_signals=min_matched_signals,
-                analog=analog,
-                analog_mass_below=analog_mass_below,
-                analog_mass_above=analog_mass_above,
-                database=database,
-                library=library,
-            )
-            for compound_id, name in zip(jobs_df["input_id"], jobs_df["Compound"])
-        ]
+    # closed in reverse order, also when a query fails. The output writer closes last as it raises failed writes
+    with ExitStack() as outputs:
+        output_writer = enter_output(outputs, OutputWriter(writer_threads) if writer_threads > 0 else None)
+        cooccurrence = enter_output(
+            outputs, create_cooccurrence(cooccurrence_dir, finished_compounds, out_filename_no_ext, output_options)
+        )
+        results_index = enter_output(outputs, ResultsIndex(results_db) if results_db else None)
+        result_sink = enter_output(outputs, ParquetResultSink(result_store) if result_store else None)
+        render_executor = enter_output(outputs, masst_client.create_render_executor(render_workers))
+
+        with ThreadPoolExecutor(parallel_queries) as executor:
+            futures = [
+                executor.submit(
+                    masst_client.query_usi_or_id,
+                    out_filename_no_ext,
+                    compound_id,
+                    name,
+                    precursor_mz_tol=precursor_mz_tol,
+                    mz_tol=mz_tol,
+                    min_cos=min_cos,
+                    min_matched_signals=min_matched_signals,
+                    analog=analog,
+                    analog_mass_below=analog_mass_below,
+                    analog_mass_above=analog_mass_above,
+                    database=database,
+                    library=library,
+                    render_executor=render_executor,
+                    output_options=output_options,
+                    result_sink=result_sink,
+                    results_index=results_index,
+                    output_writer=output_writer,
+                    cooccurrence=cooccurrence,
+                )
+                for compound_id, name in zip(jobs_df["input_id"], jobs_df["Compound"])
+            ]
 
-        wait(futures)
-        jobs_df["success"] = [f.result() for f in futures]
+            wait(futures)
+            jobs_df["success"] = [f.result() for f in futures]
 
     # return success rate
     total_jobs = len(jobs_df)
@@ -191,6 +319,12 @@ def run_on_mgf(
     library: str = None,
     parallel_queries=100,
     skip_existing=False,
+    render_workers=1,
+    output_options: OutputOptions = None,
+    result_store=None,
+    results_db=None,
+    writer_threads=0,
+    cooccurrence_dir=None,
 ):
     ids, precursor_mzs, precursor_charges, lib_ids = [], [], [], []
     mzs, intensities = [], []
@@ -227,13 +361,13 @@ def run_on_mgf(
 
     if skip_existing:
         all_len = len(jobs_df)
-        jobs_df["file_path"] = [
-            "{}_matches.tsv".format(
-                masst_client.common_base_file_name(compound_name, out_filename_no_ext)
-            )
-            for compound_name in ids
-        ]
-        jobs_df["finished"] = [Path(file).is_file() for file in jobs_df["file_path"]]
+        jobs_df["finished"] = finished_jobs(
+            jobs_df["Compound"],
+            out_filename_no_ext,
+            result_store,
+            shard=output_options is not None and output_options.shard_outputs,
+        )
+        finished_compounds = jobs_df["Compound"][jobs_df["finished"]].tolist()
         jobs_df = jobs_df[~jobs_df["finished"]]
         logger.info(
             "Running fast microbe masst on input n={} spectra (total with already finished was {} spectra)".format(
@@ -241,45 +375,25 @@ def run_on_mgf(
             )
         )
     else:
+        finished_compounds = []
         logger.info(
             "Running fast microbe masst on input n={} spectra".format(len(jobs_df))
         )
 
-    total_jobs = len(jobs_df)
-    if total_jobs <= 1:
-        jobs_df["success"] = [
-            masst_client.query_spectrum(
-                out_filename_no_ext,
-                name,
-                prec_mz,
-                prec_charge,
-                mz_array,
-                intensity_array,
-                precursor_mz_tol=precursor_mz_tol,
-                mz_tol=mz_tol,
-                min_cos=min_cos,
-                min_matched_signals=min_matched_signals,
-                analog=analog,
-                analog_mass_below=analog_mass_below,
-                analog_mass_above=analog_mass_above,
-                database=database,
-                library=library,
-                lib_id=lib_id,
-            )
-            for name, lib_id, prec_mz, prec_charge, mz_array, intensity_array in zip(
-                jobs_df["Compound"],
-                jobs_df["lib_id"],
-                jobs_df["precursor_mz"],
-                jobs_df["precursor_charge"],
-                jobs_df["mzs"],
-                jobs_df["intensities"],
-            )
-        ]
-    else:
-        with ThreadPoolExecutor(parallel_queries) as executor:
-            futures = [
-                executor.submit(
-                    masst_client.query_spectrum,
+    # closed in reverse order, also when a query fails. The output writer closes last as it raises failed writes
+    with ExitStack() as outputs:
+        output_writer = enter_output(outputs, OutputWriter(writer_threads) if writer_threads > 0 else None)
+        cooccurrence = enter_output(
+            outputs, create_cooccurrence(cooccurrence_dir, finished_compounds, out_filename_no_ext, output_options)
+        )
+        results_index = enter_output(outputs, ResultsIndex(results_db) if results_db else None)
+        result_sink = enter_output(outputs, ParquetResultSink(result_store) if result_store else None)
+        render_executor = enter_output(outputs, masst_client.create_render_executor(render_workers))
+
+        total_jobs = len(jobs_df)
+        if total_jobs <= 1:
+            jobs_df["success"] = [
+                masst_client.query_spectrum(
                     out_filename_no_ext,
                     name,
                     prec_mz,
@@ -296,6 +410,12 @@ def run_on_mgf(
                     database=database,
                     library=library,
                     lib_id=lib_id,
+                    render_executor=render_executor,
+                    output_options=output_options,
+                    result_sink=result_sink,
+                    results_index=results_index,
+                    output_writer=output_writer,
+                    cooccurrence=cooccurrence,
                 )
                 for name, lib_id, prec_mz, prec_charge, mz_array, intensity_array in zip(
                     jobs_df["Compound"],
@@ -306,9 +426,46 @@ def run_on_mgf(
                     jobs_df["intensities"],
                 )
             ]
-
-            wait(futures)
-            jobs_df["success"] = [f.result() for f in futures]
+        else:
+            with ThreadPoolExecutor(parallel_queries) as executor:
+                futures = [
+                    executor.submit(
+                        masst_client.query_spectrum,
+                        out_filename_no_ext,
+                        name,
+                        prec_mz,
+                        prec_charge,
+                        mz_array,
+                        intensity_array,
+                        precursor_mz_tol=precursor_mz_tol,
+                        mz_tol=mz_tol,
+                        min_cos=min_cos,
+                        min_matched_signals=min_matched_signals,
+                        analog=analog,
+                        analog_mass_below=analog_mass_below,
+                        analog_mass_above=analog_mass_above,
+                        database=database,
+                        library=library,
+                        lib_id=lib_id,
+                        render_executor=render_executor,
+                        output_options=output_options,
+                        result_sink=result_sink,
+                        results_index=results_index,
+                        output_writer=output_writer,
+                        cooccurrence=cooccurrence,
+                    )
+                    for name, lib_id, prec_mz, prec_charge, mz_array, intensity_array in zip(
+                        jobs_df["Compound"],
+                        jobs_df["lib_id"],
+                        jobs_df["precursor_mz"],
+                        jobs_df["precursor_charge"],
+                        jobs_df["mzs"],
+                        jobs_df["intensities"],
+                    )
+                ]
+
+                wait(futures)
+                jobs_df["success"] = [f.result() for f in futures]
 
     # return success rate
     total_jobs = len(jobs_df)
@@ -430,6 +587,96 @@ if __name__ == "__main__":
         help="skip existing already processed entries",
         default=True,
     )
+    parser.add_argument(
+        "--render_workers",
+        type=int,
+        help="the number of processes that render trees and HTML reports. Rendering is CPU bound, 1 renders "
+        "within the query threads",
+        default="1",
+    )
+
+    parser.add_argument(
+        "--shared_assets",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="write the JS and CSS libraries once into an assets folder next to the reports instead of into "
+        "every report",
+        default=False,
+    )
+    parser.add_argument(
+        "--prune_depth",
+        type=int,
+        help="remove subtrees without matches at this depth or deeper from the trees (root is depth 0). Default "
+        "keeps the full trees",
+        default=None,
+    )
+    parser.add_argument(
+        "--compact_json",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="remove node fields from the tree json that the reports derive themselves",
+        default=False,
+    )
+    parser.add_argument(
+        "--top_mass_shift_trees",
+        type=int,
+        help="for analog searches, also render the trees of this many nominal mass shifts found in the most files",
+        default=0,
+    )
+    parser.add_argument(
+        "--shard_outputs",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="write the outputs of each compound into a hashed subdirectory of the output directory, keeps "
+        "directories small for large batches",
+        default=False,
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        help="gzip or zstd compresses the tree json, TSV, and HTML files of each compound (suffix .gz or .zst). "
+        "Default none writes plain files",
+        default="none",
+    )
+    parser.add_argument(
+        "--skip_unchanged",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="keep existing trees and reports whose matches, labels, options, template, and special MASST files did "
+        "not change. False renders all trees",
+        default=True,
+    )
+    parser.add_argument(
+        "--enrichment",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="add the hypergeometric enrichment p-value, FDR, and fold enrichment of the matches to each node of "
+        "the special MASST trees",
+        default=False,
+    )
+    parser.add_argument(
+        "--result_store",
+        type=str,
+        help="directory of a parquet result store that gets the tables of all compounds instead of TSV files per "
+        "compound. Default writes TSV files",
+        default=None,
+    )
+    parser.add_argument(
+        "--cooccurrence_dir",
+        type=str,
+        help="directory of the compound × node matrices of all special MASSTs that are updated with each compound "
+        "and checkpointed during the batch. Default creates no matrices",
+        default=None,
+    )
+    parser.add_argument(
+        "--results_db",
+        type=str,
+        help="SQLite database file that indexes the matches in special MASST nodes of all compounds for queries "
+        "with results_db.py. Default creates no database",
+        default=None,
+    )
+    parser.add_argument(
+        "--writer_threads",
+        type=int,
+        help="threads that write the output files atomically in the background with batched fsync. Default 0 "
+        "writes them in the query threads",
+        default=0,
+    )
 
     args = parser.parse_args()
 
@@ -453,6 +700,21 @@ if __name__ == "__main__":
             library=args.library,
             parallel_queries=args.parallel_queries,
             skip_existing=args.skip_existing,
+            render_workers=args.render_workers,
+            output_options=OutputOptions(
+                shared_assets=args.shared_assets,
+                prune_depth=args.prune_depth,
+                compact_json=args.compact_json,
+                top_mass_shift_trees=args.top_mass_shift_trees,
+                shard_outputs=args.shard_outputs,
+                compression=check_compression(args.compression),
+                skip_unchanged=args.skip_unchanged,
+                enrichment=args.enrichment,
+            ),
+            result_store=args.result_store,
+            results_db=args.results_db,
+            cooccurrence_dir=args.cooccurrence_dir,
+            writer_threads=args.writer_threads,
         )
         logger.info(
             "Batch microbe MASST success rate (fastMASST query success) was %.3f",
@@ -1,20 +1,43 @@
+import os
 import sys
 import logging
 from tqdm import tqdm
 import re
 import argparse
 from distutils.util import strtobool
+from concurrent.futures import Executor
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
 
 import masst_utils
 from masst_utils import DataBase
+from masst_utils import SPECIAL_MASSTS
 from utils import prepare_paths
+from utils import shard_file_name
+from utils import OutputOptions
+from utils import render_option_values
 from masst_tree import create_enriched_masst_tree
 from masst_tree import create_combined_masst_tree
+from masst_tree import metadata_matches
+from compressed_files import check_compression
+from compressed_files import find_file
+from compressed_files import compressed_file_name
+from compressed_files import COMPRESSION_SUFFIXES
+from output_writer import OutputWriter
+from output_writer import write_output
+from parquet_sink import ParquetResultSink
+from results_db import ResultsIndex
+from cooccurrence import CooccurrenceAccumulator
 import masst_utils as masst
+import fingerprints
 import usi_utils
 
 MATCH_COLUMNS = ["Delta Mass", "USI", "Cosine", "Matching Peaks", "Status"]
 
+# additional match columns in the parquet result store
+STORE_MATCH_COLUMNS = ["Dataset", "file_usi"]
+
 LIB_COLUMNS = [
     "USI",
     "GNPSLibraryAccession",
@@ -43,8 +66,32 @@ def process_matches(
     input_label,
     params_label,
     usi=None,
+    render_executor: Executor = None,
+    output_options: OutputOptions = None,
+    result_sink: ParquetResultSink = None,
+    results_index: ResultsIndex = None,
+    output_writer: OutputWriter = None,
+    cooccurrence: CooccurrenceAccumulator = None,
 ):
-    common_file = common_base_file_name(compound_name, file_name)
+    """
+    Exports all match tables and renders the special MASST trees of one compound
+
+    :param render_executor: runs the independent tree renderings in parallel. None renders them one after
+    another in the calling thread
+    :param output_options: options for the trees and reports, None uses the defaults
+    :param result_sink: appends the tables to the parquet result store instead of writing TSV files
+    :param results_index: adds the matches in special MASST nodes to the results database
+    :param output_writer: writes the output files in background threads, None writes them directly
+    :param cooccurrence: adds the matches per special MASST node to the compound × node matrix of the batch
+    :return: the unfiltered matches
+    """
+    if output_options is None:
+        output_options = OutputOptions()
+    common_file = common_base_file_name(compound_name, file_name, output_options.shard_outputs)
+    compression = output_options.compression
+    # the compound is only marked as done after all its files are written
+    if output_writer is not None:
+        output_writer = output_writer.group()
 
     # extract results
     extracted_results = masst.extract_matches_from_masst_results(
@@ -59,29 +106,54 @@ def process_matches(
     analog_matches_df = extracted_results.analog_masst_df
     filtered_matches_df = extracted_results.filtered_masst_df
     unfiltered_matches_df = extracted_results.unfiltered_masst_df
+    # the result store also keeps the dataset and file of each match
+    match_columns = MATCH_COLUMNS if result_sink is None else MATCH_COLUMNS + STORE_MATCH_COLUMNS
     # Save analog results separately
     if analog:
-        analog_file = "{}_analog_matches.tsv".format(common_file)
-        prepare_paths(file=analog_file)
-        analog_matches_df[MATCH_COLUMNS + ["rounded_delta"]].to_csv(analog_file, index=False, sep="\t")
+        export_table(
+            analog_matches_df[match_columns + ["rounded_delta"]],
+            "analog_matches",
+            common_file,
+            compound_name,
+            result_sink,
+            output_writer,
+            compression,
+        )
+        if extracted_results.delta_mass_histogram_df is not None:
+            export_table(
+                extracted_results.delta_mass_histogram_df,
+                "analog_delta_mass",
+                common_file,
+                compound_name,
+                result_sink,
+                output_writer,
+                compression,
+            )
 
         # Here we want to export all FasstMASST results
-        unfiltered_masst_file = "{}_unfiltered_matches.tsv".format(common_file)
-        prepare_paths(file=unfiltered_masst_file)
-        unfiltered_matches_df[MATCH_COLUMNS].to_csv(unfiltered_masst_file, index=False, sep="\t")
-
-    # always export match table even with 0 matches to mark that it was successful
-    masst_file = "{}_matches.tsv".format(common_file)
-    prepare_paths(file=masst_file)
-    filtered_matches_df[MATCH_COLUMNS].to_csv(masst_file, index=False, sep="\t")
+        export_table(
+            unfiltered_matches_df[match_columns],
+            "unfiltered_matches",
+            common_file,
+            compound_name,
+            result_sink,
+            output_writer,
+            compression,
+        )
 
     lib_matches_df = masst.extract_matches_from_masst_results(
         library_matches, precursor_mz_tol, min_matched_signals, analog, False
     ).unfiltered_masst_df
 
     if len(lib_matches_df) > 0:
-        lib_matches_df[LIB_COLUMNS].to_csv(
-            "{}_library.tsv".format(common_file), index=False, sep="\t"
+        export_table(
+            lib_matches_df[LIB_COLUMNS],
+            "library",
+            common_file,
+            compound_name,
+            result_sink,
+            output_writer,
+            compression,
         )
 
     if "grouped_by_dataset" not in matches:
@@ -90,211 +162,401 @@ def process_matches(
     try:
         datasets_df = masst.extract_datasets_from_masst_results(matches, filtered_matches_df)
         if len(datasets_df) > 0:
-            datasets_df.to_csv("{}_datasets.tsv".format(common_file), index=False, sep="\t")
+            export_table(
+                datasets_df,
+                "datasets",
+                common_file,
+                compound_name,
+                result_sink,
+                output_writer,
+                compression,
+            )
     except:
         pass
 
+    if result_sink is not None or results_index is not None:
+        # the render tasks only write the counts files, the store and index get the same tables here
+        for matches_df, analog_hits in [(filtered_matches_df, False), (analog_matches_df, True)]:
+            if matches_df is None:
+                continue
+            special_masst_hits = []
+            for special_masst in SPECIAL_MASSTS:
+                try:
+                    special_masst_hits.append((special_masst, metadata_matches(special_masst, matches_df)))
+                except Exception as e:
+                    logger.exception(e)
+            if result_sink is not None:
+                for special_masst, hits_df in special_masst_hits:
+                    result_sink.append(
+                        "{}counts_{}".format("analog_" if analog_hits else "", special_masst.prefix),
+                        compound_name,
+                        hits_df,
+                    )
+            if results_index is not None:
+                results_index.add_compound(
+                    compound_name, len(filtered_matches_df), special_masst_hits, analog_hits
+                )
+
     # add library matches to table
     lib_match_json = lib_matches_df.to_json(orient="records")
 
-    # microbeMASST
-    logger.debug("Exporting microbeMASST %s", compound_name)
-    create_enriched_masst_tree(
+    variants = match_variants(
+        common_file,
         filtered_matches_df,
-        masst.MICROBE_MASST,
-        common_file=common_file,
-        lib_match_json=lib_match_json,
-        input_str=input_label,
-        parameter_str=params_label,
-        usi=usi,
-        format_out_json=False,
-        compress_out_html=True,
+        analog_matches_df if analog else None,
+        extracted_results.delta_mass_histogram_df,
+        output_options.top_mass_shift_trees,
     )
 
-    if analog:
-        logger.debug("Exporting microbeMASST analog %s", compound_name)
-        create_enriched_masst_tree(
-            analog_matches_df,
-            masst.MICROBE_MASST,
-            common_file=common_file + "_analog",
-            lib_match_json=lib_match_json,
-            input_str=input_label,
-            parameter_str=params_label,
-            usi=usi,
-            format_out_json=False,
-            compress_out_html=True,
+    labels = {
+        "input_label": input_label,
+        "params_label": params_label,
+        "usi": usi,
+        "lib_match_json": lib_match_json,
+    }
+    # the co-occurrence gets the matched sizes of the rendered trees
+    matched_sizes = {} if cooccurrence is not None else None
+    try:
+        manifest = render_trees(
+            variants,
+            labels,
+            output_options,
+            render_executor=render_executor,
+            export_counts=result_sink is None,
+            # the writer threads only live in this process
+            output_writer=output_writer if render_executor is None else None,
+            manifest=fingerprints.read_manifest(common_file),
+            force=not output_options.skip_unchanged,
+            matched_sizes=matched_sizes,
         )
-
-    # plantMASST
-    logger.debug("Exporting plantMASST %s", compound_name)
-    create_enriched_masst_tree(
-        filtered_matches_df,
-        masst.PLANT_MASST,
-        common_file=common_file,
-        lib_match_json=lib_match_json,
-        input_str=input_label,
-        parameter_str=params_label,
-        usi=usi,
-        format_out_json=False,
-        compress_out_html=True,
+    except RenderError as e:
+        fingerprints.write_manifest(common_file, e.manifest)
+        raise
+    fingerprints.write_manifest(common_file, manifest)
+    if cooccurrence is not None:
+        add_cooccurrence(cooccurrence, compound_name, filtered_matches_df, matched_sizes)
+    if output_writer is not None:
+        output_writer.wait()
+
+    # always export match table even with 0 matches to mark that it was successful, written last as resuming
+    # skips compounds with a match table
+    export_table(
+        filtered_matches_df[match_columns],
+        "matches",
+        common_file,
+        compound_name,
+        result_sink,
+        output_writer,
+        compression,
     )
+    if result_sink is not None:
+        result_sink.mark_finished(compound_name, len(filtered_matches_df))
+    return unfiltered_matches_df
 
-    if analog:
-        logger.debug("Exporting plantMASST analog %s", compound_name)
-        create_enriched_masst_tree(
-            analog_matches_df,
-            masst.PLANT_MASST,
-            common_file=common_file + "_analog",
-            lib_match_json=lib_match_json,
-            input_str=input_label,
-            parameter_str=params_label,
-            usi=usi,
-            format_out_json=False,
-            compress_out_html=True,
-        )
 
-    # tissueMASST
-    logger.debug("Exporting tissueMASST %s", compound_name)
-    create_enriched_masst_tree(
-        filtered_matches_df,
-        masst.TISSUE_MASST,
-        common_file=common_file,
-        lib_match_json=lib_match_json,
-        input_str=input_label,
-        parameter_str=params_label,
-        usi=usi,
-        format_out_json=False,
-        compress_out_html=True,
-    )
+def add_cooccurrence(cooccurrence: CooccurrenceAccumulator, compound_name, matches_df, matched_sizes: dict):
+    """
+    Adds the matched sizes of the special MASST trees to the co-occurrence. Trees that were skipped as unchanged
+    have no matched sizes, their matches are joined with the metadata again
+    :param matched_sizes: the matched sizes of the rendered trees by special MASST prefix, see render_trees
+    """
+    special_masst_counts = []
+    for special_masst in cooccurrence.special_massts:
+        key_counts = matched_sizes.get(special_masst.prefix)
+        if key_counts is None and len(matches_df) > 0:
+            try:
+                hits_df = metadata_matches(special_masst, matches_df)
+                key_counts = hits_df[special_masst.metadata_key].dropna().astype(str).value_counts()
+            except Exception as e:
+                logger.exception(e)
+        if key_counts is not None:
+            special_masst_counts.append((special_masst, key_counts))
+    cooccurrence.add_compound_counts(compound_name, special_masst_counts)
+
+
+def match_variants(
+    common_file,
+    matches_df,
+    analog_matches_df=None,
+    delta_mass_histogram_df=None,
+    top_mass_shift_trees=0,
+) -> list:
+    """
+    The filtered and analog matches are rendered separately, the analog matches of the most common nominal mass
+    shifts as trees of their own
+    :param analog_matches_df: the analog matches with rounded_delta, None without analog search
+    :param delta_mass_histogram_df: the nominal mass shifts of the analog matches, see
+    masst_utils.create_delta_mass_histogram
+    :return: the variants of render_trees
+    """
+    variants = [(matches_df, common_file, "")]
+    if analog_matches_df is None:
+        return variants
+    variants.append((analog_matches_df, common_file + "_analog", "analog_"))
+    for shift in masst.top_mass_shifts(delta_mass_histogram_df, top_mass_shift_trees):
+        shift_matches_df = analog_matches_df[analog_matches_df["rounded_delta"] == shift]
+        shift_key = "analog_shift_{:+d}".format(int(shift))
+        variants.append((shift_matches_df, "{}_{}".format(common_file, shift_key), shift_key + "_"))
+    return variants
+
+
+def render_trees(
+    variants,
+    labels: dict,
+    output_options: OutputOptions,
+    render_executor: Executor = None,
+    special_massts=None,
+    export_counts=True,
+    output_writer: OutputWriter = None,
+    manifest: dict = None,
+    force=False,
+    matched_sizes: dict = None,
+) -> dict:
+    """
+    Renders the tree json and report of each special MASST and the combined tree of each match variant. Each special
+    MASST tree is an independent task. The combined tree reads all their json files and joins them last.
+    Trees are skipped if the manifest of the last rendering has the same fingerprint and their outputs still exist or
+    they had no outputs.
+
+    :param variants: list of matches_df, variant_file (common file of the outputs), and variant_key (prefix of the
+    artefact keys, e.g., "" or "analog_")
+    :param labels: input_label, params_label, usi, and lib_match_json of the reports
+    :param special_massts: only renders these special MASSTs, None renders all
+    :param manifest: the manifest of the existing outputs, None renders all trees
+    :param force: renders all trees and keeps the fingerprints of the other special MASSTs in the manifest
+    :param matched_sizes: gets the matched_size of each metadata key of the rendered special MASST trees of the first
+    variant by special MASST prefix, empty for trees without matches or that failed. Trees that were skipped as
+    unchanged are missing
+    :return: the manifest after rendering with the labels, the render options, the fingerprints of all trees
+    (artefacts), and the trees without outputs (empty)
+    :raises RenderError: if any tree failed, its manifest only has the fingerprints of the successful trees
+    """
+    render_options = {
+        "shared_assets": output_options.shared_assets,
+        "prune_depth": output_options.prune_depth,
+        "compact_json": output_options.compact_json,
+        "compression": output_options.compression,
+    }
+    # only when enabled, the fingerprints of existing outputs stay valid
+    if output_options.enrichment:
+        render_options["enrichment"] = True
+    if special_massts is None:
+        special_massts = SPECIAL_MASSTS
+    force = force or manifest is None
+    artefacts = dict(manifest.get("artefacts", {})) if manifest else {}
+    empty = set(manifest.get("empty", [])) if manifest else set()
+
+    def is_unchanged(key, fingerprint, out_file):
+        if force or artefacts.get(key) != fingerprint:
+            return False
+        return key in empty or tree_outputs_exist(out_file, output_options.compression)
+
+    futures = []
+    rendered = []
+    # the render tasks that return their matched sizes
+    size_tasks = []
+    changed_variants = []
+    for variant, (matches_df, variant_file, variant_key) in enumerate(variants):
+        tree_fingerprints = fingerprints.tree_fingerprints(
+            matches_df, variant_key, labels, render_options, special_massts
+        )
+        changed = [
+            special_masst
+            for special_masst in special_massts
+            if not is_unchanged(
+                variant_key + special_masst.prefix,
+                tree_fingerprints[variant_key + special_masst.prefix],
+                "{}_{}".format(variant_file, special_masst.prefix),
+            )
+        ]
+        artefacts.update(tree_fingerprints)
+        combined_key = variant_key + "combined"
+        combined = fingerprints.combined_fingerprint(artefacts, variant_key, SPECIAL_MASSTS)
+        if changed or not is_unchanged(combined_key, combined, "{}_combined".format(variant_file)):
+            changed_variants.append((matches_df, variant_file, combined_key))
+        artefacts[combined_key] = combined
+
+        for special_masst in changed:
+            logger.debug("Exporting %s %s", special_masst.prefix, variant_file)
+            rendered.append(
+                (variant_key + special_masst.prefix, "{}_{}".format(variant_file, special_masst.prefix))
+            )
+            futures.append(
+                submit_render_task(
+                    render_executor,
+                    create_enriched_masst_tree,
+                    matches_df,
+                    special_masst,
+                    common_file=variant_file,
+                    lib_match_json=labels["lib_match_json"],
+                    input_str=labels["input_label"],
+                    parameter_str=labels["params_label"],
+                    usi=labels["usi"],
+                    format_out_json=False,
+                    compress_out_html=True,
+                    shared_assets=output_options.shared_assets,
+                    prune_depth=output_options.prune_depth,
+                    compact_json=output_options.compact_json,
+                    export_counts=export_counts,
+                    output_writer=output_writer,
+                    compression=output_options.compression,
+                    enrichment=output_options.enrichment,
+                    matched_sizes=matched_sizes is not None and variant == 0,
+                )
+            )
+            if matched_sizes is not None and variant == 0:
+                size_tasks.append((special_masst, futures[-1]))
+    wait(futures)
+    errors = check_render_tasks(futures, rendered, artefacts, empty, output_options.compression)
+    for special_masst, future in size_tasks:
+        sizes = future.result() if future.exception() is None else None
+        matched_sizes[special_masst.prefix] = sizes if isinstance(sizes, dict) else {}
 
-    if analog:
-        logger.debug("Exporting tissueMASST analog %s", compound_name)
-        create_enriched_masst_tree(
-            analog_matches_df,
-            masst.TISSUE_MASST,
-            common_file=common_file + "_analog",
-            lib_match_json=lib_match_json,
-            input_str=input_label,
-            parameter_str=params_label,
-            usi=usi,
-            format_out_json=False,
-            compress_out_html=True,
+    # combined from all
+    futures = []
+    combined_rendered = []
+    for matches_df, variant_file, combined_key in changed_variants:
+        logger.debug("Exporting combined tree %s", variant_file)
+        combined_rendered.append((combined_key, "{}_combined".format(variant_file)))
+        futures.append(
+            submit_render_task(
+                render_executor,
+                create_combined_masst_tree,
+                matches_df,
+                common_file=variant_file,
+                lib_match_json=labels["lib_match_json"],
+                input_str=labels["input_label"],
+                parameter_str=labels["params_label"],
+                usi=labels["usi"],
+                format_out_json=False,
+                compress_out_html=True,
+                shared_assets=output_options.shared_assets,
+                compact_json=output_options.compact_json,
+                output_writer=output_writer,
+                compression=output_options.compression,
+            )
         )
+    wait(futures)
+    errors += check_render_tasks(futures, combined_rendered, artefacts, empty, output_options.compression)
 
-    # foodMASST
-    logger.debug("Exporting foodMASST %s", compound_name)
-    create_enriched_masst_tree(
-        filtered_matches_df,
-        masst.FOOD_MASST,
-        common_file=common_file,
-        lib_match_json=lib_match_json,
-        input_str=input_label,
-        parameter_str=params_label,
-        usi=usi,
-        format_out_json=False,
-        compress_out_html=True,
-    )
+    manifest = {
+        "labels": labels,
+        "options": render_option_values(output_options),
+        "artefacts": artefacts,
+        "empty": sorted(empty),
+    }
+    if errors:
+        raise RenderError(manifest) from errors[0]
+    return manifest
 
-    if analog:
-        logger.debug("Exporting foodMASST analog %s", compound_name)
-        create_enriched_masst_tree(
-            analog_matches_df,
-            masst.FOOD_MASST,
-            common_file=common_file + "_analog",
-            lib_match_json=lib_match_json,
-            input_str=input_label,
-            parameter_str=params_label,
-            usi=usi,
-            format_out_json=False,
-            compress_out_html=True,
-        )
 
-    # personalCareProductMASST
-    logger.debug("Exporting personalCareProductMASST %s", compound_name)
-    create_enriched_masst_tree(
-        filtered_matches_df,
-        masst.PERSONALCAREPRODUCT_MASST,
-        common_file=common_file,
-        lib_match_json=lib_match_json,
-        input_str=input_label,
-        parameter_str=params_label,
-        usi=usi,
-        format_out_json=False,
-        compress_out_html=True,
-    )
+class RenderError(Exception):
+    """
+    Raised after all render tasks finished if any failed. The manifest keeps the successful trees so that only the
+    failed trees are rendered again
+    """
 
-    if analog:
-        logger.debug("Exporting personalCareProductMASST analog %s", compound_name)
-        create_enriched_masst_tree(
-            analog_matches_df,
-            masst.PERSONALCAREPRODUCT_MASST,
-            common_file=common_file + "_analog",
-            lib_match_json=lib_match_json,
-            input_str=input_label,
-            parameter_str=params_label,
-            usi=usi,
-            format_out_json=False,
-            compress_out_html=True,
-        )
+    def __init__(self, manifest: dict):
+        super().__init__("Rendering of the trees failed")
+        self.manifest = manifest
 
-    # microbiomeMASST
-    logger.debug("Exporting microbiomeMASST %s", compound_name)
-    create_enriched_masst_tree(
-        filtered_matches_df,
-        masst.MICROBIOME_MASST,
-        common_file=common_file,
-        lib_match_json=lib_match_json,
-        input_str=input_label,
-        parameter_str=params_label,
-        usi=usi,
-        format_out_json=False,
-        compress_out_html=True,
+
+def check_render_tasks(futures, rendered, artefacts: dict, empty: set, compression: str | None = None) -> list:
+    """
+    Trees without match in the metadata are empty. Failed trees lose their fingerprint, so they are neither empty
+    nor unchanged in the next rendering
+
+    :param futures: the finished render tasks
+    :param rendered: the artefact key and output file of each task
+    :param artefacts: the fingerprints of the trees, updated
+    :param empty: the keys of the trees without outputs, updated
+    :return: the exceptions of the failed tasks, each is logged with its output file
+    """
+    errors = []
+    for future, (key, out_file) in zip(futures, rendered):
+        error = future.exception()
+        if error is not None:
+            logger.error("Rendering %s failed", out_file, exc_info=error)
+            errors.append(error)
+        if error is None and future.result() is False:
+            empty.add(key)
+            continue
+        empty.discard(key)
+        # the tree json is written directly by the tasks, reports may still be queued on the output writer
+        if error is not None or find_file(out_file + ".json", compression) is None:
+            # the tree functions log their own errors and return None without output
+            artefacts.pop(key, None)
+    return errors
+
+
+def tree_outputs_exist(out_file, compression: str | None = None) -> bool:
+    """
+    :param out_file: the tree outputs without extension, e.g., {common_file}_food
+    :return: True if the tree json and report exist, plain or compressed
+    """
+    return (
+        find_file(out_file + ".json", compression) is not None
+        and find_file(out_file + ".html", compression) is not None
     )
 
-    if analog:
-        logger.debug("Exporting microbiomeMASST analog %s", compound_name)
-        create_enriched_masst_tree(
-            analog_matches_df,
-            masst.MICROBIOME_MASST,
-            common_file=common_file + "_analog",
-            lib_match_json=lib_match_json,
-            input_str=input_label,
-            parameter_str=params_label,
-            usi=usi,
-            format_out_json=False,
-            compress_out_html=True,
-        )
 
-    # combined from all
-    logger.debug("Exporting combined tree %s", compound_name)
-    create_combined_masst_tree(
-        filtered_matches_df,
-        common_file=common_file,
-        lib_match_json=lib_match_json,
-        input_str=input_label,
-        parameter_str=params_label,
-        usi=usi,
-        format_out_json=False,
-        compress_out_html=True,
-    )
+def export_table(
+    df,
+    table,
+    common_file,
+    compound_name,
+    result_sink: ParquetResultSink = None,
+    output_writer: OutputWriter = None,
+    compression: str | None = None,
+):
+    """
+    Writes a table of one compound to {common_file}_{table}.tsv or appends it to the result store
+    :param compression: gzip or zstd adds the suffix .gz or .zst to the TSV file
+    """
+    if result_sink is not None:
+        result_sink.append(table, compound_name, df)
+    else:
+        file = "{}_{}.tsv".format(common_file, table)
+        write_output(file, df.to_csv(index=False, sep="\t"), output_writer, compression)
 
-    if analog:
-        logger.debug("Exporting combined tree analog %s", compound_name)
-        create_combined_masst_tree(
-            analog_matches_df,
-            common_file=common_file + "_analog",
-            lib_match_json=lib_match_json,
-            input_str=input_label,
-            parameter_str=params_label,
-            usi=usi,
-            format_out_json=False,
-            compress_out_html=True,
-        )
 
-    return unfiltered_matches_df
+def submit_render_task(executor: Executor, fn, *args, **kwargs) -> Future:
+    """
+    Submits a rendering task to the executor or runs it directly if there is no executor
+    :return: the future of the task
+    """
+    if executor is not None:
+        return executor.submit(fn, *args, **kwargs)
+
+    future = Future()
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def create_render_executor(render_workers=None) -> Executor | None:
+    """
+    Tree and HTML rendering is CPU bound, so the tasks run in separate processes.
+
+    :param render_workers: number of processes, None uses one per CPU up to one per special MASST tree and
+    analog variant. 1 or less renders serially
+    :return: the executor or None for serial rendering
+    """
+    if render_workers is None:
+        render_workers = min(os.cpu_count() or 1, len(SPECIAL_MASSTS) * 2)
+    if render_workers <= 1:
+        return None
+    return ProcessPoolExecutor(render_workers)
 
 
-def common_base_file_name(compound_name, file_name):
+def common_base_file_name(compound_name, file_name, shard=False):
+    """
+    :param shard: place the outputs of the compound in its hashed subdirectory
+    """
+    if shard and compound_name:
+        file_name = shard_file_name(file_name, compound_name)
     if compound_name:
         return "{}_{}".format(file_name, compound_name.replace(" ", "_"))
     else:
@@ -314,10 +576,22 @@ def query_usi_or_id(
     analog_mass_above=200,
     database: str | DataBase = None,
     library: str | DataBase = None,
+    render_executor: Executor = None,
+    output_options: OutputOptions = None,
+    result_sink: ParquetResultSink = None,
+    results_index: ResultsIndex = None,
+    output_writer: OutputWriter = None,
+    cooccurrence: CooccurrenceAccumulator = None,
 ):
     """
     NOTE: database and library are the fasst database, if None, we fall back on defaults provided by the system, otherwise we can set a string
 
+    :param render_executor: renders the trees in parallel, None renders serially
+    :param output_options: options for the trees and reports
+    :param result_sink: appends the tables to the parquet result store instead of writing TSV files
+    :param results_index: adds the matches in special MASST nodes to the results database
+    :param output_writer: writes the output files in background threads, None writes them directly
+    :param cooccurrence: adds the matches per special MASST node to the compound × node matrix of the batch
     :return: True if fastmasst query was successful otherwise False
     """
     # might raise exception for service
@@ -347,7 +621,14 @@ def query_usi_or_id(
             return False
 
         if len(matches["results"]) == 0:
-            export_empty_masst_results(compound_name, file_name)
+            export_empty_masst_results(
+                compound_name,
+                file_name,
+                result_sink,
+                results_index,
+                shard=output_options is not None and output_options.shard_outputs,
+                cooccurrence=cooccurrence,
+            )
             # succeeded with 0 matches. fastMASST returns the regular payload with
             # every list empty, [results] included, so this is a valid empty search
             # and not a failed one
@@ -387,6 +668,12 @@ def query_usi_or_id(
             input_label,
             params_label,
             usi_utils.ensure_usi(usi_or_lib_id),
+            render_executor=render_executor,
+            output_options=output_options,
+            result_sink=result_sink,
+            results_index=results_index,
+            output_writer=output_writer,
+            cooccurrence=cooccurrence,
         )
         return True
     except Exception as e:
@@ -411,10 +698,22 @@ def query_spectrum(
     lib_id=None,
     database: str | DataBase = None,
     library: str | DataBase = None,
+    render_executor: Executor = None,
+    output_options: OutputOptions = None,
+    result_sink: ParquetResultSink = None,
+    results_index: ResultsIndex = None,
+    output_writer: OutputWriter = None,
+    cooccurrence: CooccurrenceAccumulator = None,
 ):
     """
     NOTE: database and library are the fasst database, if None, we fall back on defaults provided by the system, otherwise we can set a string
 
+    :param render_executor: renders the trees in parallel, None renders serially
+    :param output_options: options for the trees and reports
+    :param result_sink: appends the tables to the parquet result store instead of writing TSV files
+    :param results_index: adds the matches in special MASST nodes to the results database
+    :param output_writer: writes the output files in background threads, None writes them directly
+    :param cooccurrence: adds the matches per special MASST node to the compound × node matrix of the batch
     :return: True if fast masst query was successful otherwise False
     """
     # might raise exception for service
@@ -441,7 +740,14 @@ def query_spectrum(
             return False
 
         if len(matches["results"]) == 0:
-            export_empty_masst_results(compound_name, file_name)
+            export_empty_masst_results(
+                compound_name,
+                file_name,
+                result_sink,
+                results_index,
+                shard=output_options is not None and output_options.shard_outputs,
+                cooccurrence=cooccurrence,
+            )
             return True
 
         if library is None:
@@ -485,21 +791,80 @@ def query_spectrum(
             input_label,
             params_label,
             usi,
+            render_executor=render_executor,
+            output_options=output_options,
+            result_sink=result_sink,
+            results_index=results_index,
+            output_writer=output_writer,
+            cooccurrence=cooccurrence,
         )
         return True
     except Exception as e:
         return False
 
 
-def export_empty_masst_results(compound_name, file_name):
+def export_empty_masst_results(
+    compound_name,
+    file_name,
+    result_sink: ParquetResultSink = None,
+    results_index: ResultsIndex = None,
+    shard=False,
+    cooccurrence: CooccurrenceAccumulator = None,
+):
+    common_file = common_base_file_name(compound_name, file_name, shard)
     try:
-        path = "{}_matches.tsv".format(common_base_file_name(compound_name, file_name))
+        remove_analog_outputs(common_file)
+    except Exception as e:
+        logger.exception(e)
+    if results_index is not None:
+        results_index.add_compound(compound_name, 0)
+    if cooccurrence is not None:
+        cooccurrence.add_compound(compound_name)
+    if result_sink is not None:
+        result_sink.mark_finished(compound_name, 0)
+        return
+    try:
+        path = "{}_matches.tsv".format(common_file)
+        prepare_paths(file=path)
         with open(path, "w") as file:
             file.write("USI	Cosine	Matching Peaks	Status\n")
     except:
         pass
 
 
+def remove_analog_outputs(common_file):
+    """
+    Removes the analog tables, trees, reports, and counts files of an earlier run of a compound and their
+    fingerprints, e.g., if the compound has no matches anymore. The mass shift trees are found in the manifest
+    """
+    manifest = fingerprints.read_manifest(common_file)
+    artefact_keys = [*manifest.get("artefacts", {}), *manifest.get("empty", [])]
+    variant_files = {"{}_analog".format(common_file)} | {
+        "{}_{}".format(common_file, shift_key.group(1))
+        for shift_key in (re.match(r"(analog_shift_[+-]\d+)_", key) for key in artefact_keys)
+        if shift_key is not None
+    }
+    files = ["{}_analog_matches.tsv".format(common_file), "{}_analog_delta_mass.tsv".format(common_file)]
+    for variant_file in variant_files:
+        for prefix in [special_masst.prefix for special_masst in SPECIAL_MASSTS] + ["combined"]:
+            files.append("{}_{}.json".format(variant_file, prefix))
+            files.append("{}_{}.html".format(variant_file, prefix))
+            files.append("{}_counts_{}.tsv".format(variant_file, prefix))
+    for file in files:
+        for compression in [None, *COMPRESSION_SUFFIXES.keys()]:
+            try:
+                os.remove(compressed_file_name(file, compression))
+            except FileNotFoundError:
+                pass
+
+    if artefact_keys:
+        manifest["artefacts"] = {
+            key: value for key, value in manifest.get("artefacts", {}).items() if not key.startswith("analog_")
+        }
+        manifest["empty"] = [key for key in manifest.get("empty", []) if not key.startswith("analog_")]
+        fingerprints.write_manifest(common_file, manifest)
+
+
 def path_safe(file):
     return re.sub("[^-a-zA-Z0-9_.() ]+", "_", file)
 
@@ -609,7 +974,72 @@ if __name__ == "__main__":
         default=None,
     )
 
+    parser.add_argument(
+        "--render_workers",
+        type=int,
+        help="number of processes that render the trees in parallel, 1 renders serially. Default is one per CPU",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--shared_assets",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="write the JS and CSS libraries once into an assets folder next to the reports instead of creating "
+        "single file reports",
+        default=False,
+    )
+    parser.add_argument(
+        "--prune_depth",
+        type=int,
+        help="remove subtrees without matches at this depth or deeper from the trees (root is depth 0). Default "
+        "keeps the full trees",
+        default=None,
+    )
+    parser.add_argument(
+        "--compact_json",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="remove node fields from the tree json that the reports derive themselves",
+        default=False,
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        help="gzip or zstd compresses the tree json, TSV, and HTML files (suffix .gz or .zst). Default none writes "
+        "plain files",
+        default="none",
+    )
+    parser.add_argument(
+        "--skip_unchanged",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="keep existing trees and reports whose matches, labels, options, template, and special MASST files did "
+        "not change. False renders all trees",
+        default=True,
+    )
+    parser.add_argument(
+        "--enrichment",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="add the hypergeometric enrichment p-value, FDR, and fold enrichment of the matches to each node of "
+        "the special MASST trees",
+        default=False,
+    )
+    parser.add_argument(
+        "--top_mass_shift_trees",
+        type=int,
+        help="for analog searches, also render the trees of this many nominal mass shifts found in the most files",
+        default=0,
+    )
+
     args = parser.parse_args()
+    render_executor = create_render_executor(args.render_workers)
+    output_options = OutputOptions(
+        shared_assets=args.shared_assets,
+        prune_depth=args.prune_depth,
+        compact_json=args.compact_json,
+        top_mass_shift_trees=args.top_mass_shift_trees,
+        compression=check_compression(args.compression),
+        skip_unchanged=args.skip_unchanged,
+        enrichment=args.enrichment,
+    )
 
     if args.mode == 'query_and_draw':
         logger.info("Running fastMASST query and drawing")
@@ -643,6 +1073,8 @@ if __name__ == "__main__":
                 analog_mass_above=analog_mass_above,
                 database=database,
                 library=library,
+                render_executor=render_executor,
+                output_options=output_options,
             )
         except Exception as e:
             # exit with error
@@ -701,7 +1133,11 @@ if __name__ == "__main__":
             input_label,
             params_label,
             usi_utils.ensure_usi(usi_or_lib_id),
+            render_executor=render_executor,
+            output_options=output_options,
         )
 
+    if render_executor is not None:
+        render_executor.shutdown()
     # exit with OK
     sys.exit(0)
@@ -1,57 +1,129 @@
 import logging
 import glob, re
+import os
 import json
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from dataclasses import field
+from distutils.util import strtobool
+from functools import partial
+from pathlib import Path
+import argparse
+import sys
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from scipy import sparse
 from tqdm import tqdm
 import masst_utils
 from masst_utils import SpecialMasst
+from utils import SHARD_HEX_DIGITS
+from utils import scan_output_files
+import enrichment
+import lineages
+import parquet_sink
+import compressed_files
+from compressed_files import COMPRESSION_SUFFIXES
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# columns of the counts files that filter the matches
+COUNT_FILTER_COLUMNS = ["Cosine", "Dataset", "QC", "Blank"]
+COUNT_FILE_SUFFIXES = tuple(".tsv" + suffix for suffix in ["", *COMPRESSION_SUFFIXES.values()])
+
 
 def create_quant_summary(
         quant_csv,
         summary_df: pd.DataFrame,
         out_file=None,
         sum_as_binary_presence=False,
+        quant_df: pd.DataFrame = None,
 ) -> pd.DataFrame:
     """
     Creates a table of samples (columns) and MASST matches (like NCBI id) as rows. The intensity in the quant table
     is row normalized to the relative intensity in the row. then multiplied and summed for each feature that had a
-    match to a specific MASST metadata entry
+    match to a specific MASST metadata entry. This is one sparse matrix product of the MASST node × feature matches
+    and the feature × sample quant matrix
 
     :param quant_csv: imports the quant table from MZmine
     :param summary_df: summary of MASST matches with the feature id as columns
-    :param out_file: saves the results to csv
+    :param out_file: saves the results to csv or to parquet if the file ends with .parquet
+    :param sum_as_binary_presence: counts features with a relative intensity of at least 0.01 instead of summing
+    the relative intensities
+    :param quant_df: the imported quant table, None imports quant_csv
     :return: the final data frame
     """
-    summary_df.columns = pd.to_numeric(summary_df.columns)
-    quant_df = import_quantdf(quant_csv)
-    quant_df = quant_df[quant_df.index.get_level_values("row ID").isin(summary_df.columns)]
-    if sum_as_binary_presence:
-        quant_df = quant_df.ge(0.01)
+    if quant_df is None:
+        quant_df = import_quantdf(quant_csv)
+    features = pd.to_numeric(summary_df.columns)
+    if all(isinstance(dtype, pd.SparseDtype) for dtype in summary_df.dtypes):
+        summary_matrix = summary_df.sparse.to_coo()
+    else:
+        summary_matrix = sparse.csr_matrix(summary_df.to_numpy(dtype=np.float64))
+    final_matrix = quant_summary_matrix(summary_matrix, features, quant_df, sum_as_binary_presence)
 
-    samples = quant_df.columns
-    final_df = pd.DataFrame(index=summary_df.index, columns=samples).fillna(0)
+    final_df = pd.DataFrame(final_matrix.toarray(), index=summary_df.index, columns=quant_df.columns)
+    if out_file:
+        export_quant_summary(final_df, out_file)
+    return final_df
 
-    summary_df.columns = pd.to_numeric(summary_df.columns)
-    features = summary_df.columns
-    for f in tqdm(features):
-        try:
-            # take first row
-            _, quant_row = next(quant_df[quant_df.index.get_level_values("row ID") == f].iterrows())
-
-            # add MASST matches to samples
-            for sample in samples:
-                final_df[sample] += summary_df[f] * quant_row[sample]
-        except:
-            logger.warning("This error should not happen, every row ID should be available in the table")
-            pass
 
-    if out_file:
+def quant_summary_matrix(
+        summary_matrix: sparse.spmatrix,
+        features,
+        quant_df: pd.DataFrame,
+        sum_as_binary_presence=False,
+) -> sparse.csr_matrix:
+    """
+    :param summary_matrix: MASST node × feature matches
+    :param features: the feature ids (row ID in the quant table) of the summary columns
+    :param quant_df: the imported quant table, only the first row of each feature is used
+    :param sum_as_binary_presence: use the presence of each feature in a sample instead of its relative intensity
+    :return: sparse MASST node × sample matrix
+    """
+    quant_matrix = feature_quant_matrix(quant_df, features, sum_as_binary_presence)
+    return sparse.csr_matrix(summary_matrix) @ quant_matrix
+
+
+def feature_quant_matrix(quant_df: pd.DataFrame, features, sum_as_binary_presence=False) -> sparse.csr_matrix:
+    """
+    :return: sparse feature × sample matrix of the relative intensities or presence, ordered like features. Features
+    missing in the quant table are empty rows
+    """
+    row_ids = pd.Index(quant_df.index.get_level_values("row ID"))
+    first_rows = ~row_ids.duplicated()
+    positions = pd.Index(row_ids[first_rows]).get_indexer(features)
+    missing = positions < 0
+    if missing.any():
+        logger.warning(
+            "%d features are missing in the quant table, every row ID should be available in the table",
+            missing.sum(),
+        )
+
+    values = quant_df.to_numpy(dtype=np.float64)[first_rows]
+    # rows without intensity have no relative intensity
+    values = np.nan_to_num(values, nan=0.0)
+    if sum_as_binary_presence:
+        values = (values >= 0.01).astype(np.float64)
+    # missing features point to an appended empty row
+    values = np.vstack([values, np.zeros((1, values.shape[1]))])
+    positions[missing] = len(values) - 1
+    return sparse.csr_matrix(values[positions])
+
+
+def export_quant_summary(final_df: pd.DataFrame, out_file):
+    """
+    Saves the sample summary to csv or to parquet if the file ends with .parquet
+    """
+    if str(out_file).endswith(".parquet"):
+        out_df = final_df.reset_index()
+        out_df.columns = [str(c) for c in out_df.columns]
+        out_df.to_parquet(out_file, index=False)
+    else:
         final_df.to_csv(out_file)
-    return final_df
 
 
 def import_quantdf(quant_csv):
@@ -72,42 +144,266 @@ def import_quantdf(quant_csv):
     return quant_df
 
 
+@dataclass
+class SummaryState:
+    """
+    Sparse node × compound summary of all tree files ingested so far. Entries reference the row positions of nodes
+    and files
+    """
+
+    # node_key, min_matches of the ingested files
+    params: dict
+    # tuples of the node columns by node code
+    nodes: list
+    # file, size, mtime_ns, and compound of each ingested file
+    files: pd.DataFrame
+    # file, node, and matched_size of each match as COO entries
+    entries: pd.DataFrame
+    node_codes: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.node_codes = {node: code for code, node in enumerate(self.nodes)}
+
+
 def create_summary_file(
         parent_directory,
         special_masst: SpecialMasst,
         out_file=None,
         min_matches=1,
         matches_to_binary_presence=True,
+        workers=None,
+        state_dir=None,
 ) -> pd.DataFrame | None:
-    dfs = []
-    node_id = special_masst.tree_node_key
-    for file in tqdm(glob.glob(parent_directory + f"*{special_masst.prefix}.json")):
-        comp_id = re.search(r"_(\d+)_"+special_masst.prefix, file).group(1)
-        df = json_to_dataframe(file, node_key=node_id, min_matches=min_matches)
-        if df is None:
+    """
+    Summarises the tree json files of all compounds in a sparse node × compound table. The files are parsed in
+    parallel processes
+
+    :param parent_directory: the output prefix of the tree files
+    :param out_file: saves the results to csv
+    :param matches_to_binary_presence: 1 for matched nodes instead of the number of matches
+    :param workers: number of processes, None uses all CPUs
+    :param state_dir: keeps the sparse summary of all ingested files in this directory so that a rerun only reads
+    new and changed files. None reads all files
+    :return: the sparse summary with the node columns as index and compound ids as columns
+    """
+    node_key = special_masst.tree_node_key
+    params = {"node_key": node_key, "min_matches": min_matches}
+    state = load_summary_state(state_dir, params) if state_dir else None
+    if state is None:
+        state = empty_summary_state(params)
+
+    update_summary_state(state, find_tree_files(parent_directory, special_masst), special_masst, workers)
+    if state_dir:
+        save_summary_state(state, state_dir)
+
+    merged_df = summary_dataframe(state, special_masst, matches_to_binary_presence)
+    if merged_df is not None and out_file:
+        export_summary_csv(merged_df, out_file)
+    return merged_df
+
+
+def export_summary_csv(summary_df: pd.DataFrame, out_file, chunk_rows=1000):
+    """
+    Writes the sparse summary as a dense csv, only chunk_rows nodes are dense at a time
+    """
+    for start in range(0, len(summary_df), chunk_rows):
+        summary_df.iloc[start:start + chunk_rows].sparse.to_dense().to_csv(
+            out_file, mode="w" if start == 0 else "a", header=start == 0
+        )
+
+
+def find_tree_files(parent_directory, special_masst: SpecialMasst) -> list:
+    # flat and sharded output layouts
+    files = []
+    for suffix in ["", *COMPRESSION_SUFFIXES.values()]:
+        # plain and compressed trees
+        pattern = f"*{special_masst.prefix}.json" + suffix
+        files += glob.glob(parent_directory + pattern) + glob.glob(os.path.join(
+            os.path.dirname(parent_directory), "?" * SHARD_HEX_DIGITS, os.path.basename(parent_directory) + pattern
+        ))
+    return files
+
+
+def read_tree_nodes(file, special_masst: SpecialMasst, min_matches=1) -> tuple[str, list, list]:
+    """
+    Runs in the worker processes. Plain rows instead of a data frame per file keep the parsing and transfer cheap
+    :return: the compound id ("" if the file is not a compound tree, e.g., an analog tree), the node column tuples of
+    the matched nodes, and their matched_size
+    """
+    node_key = special_masst.tree_node_key
+    comp_id = re.search(r"_(\d+)_" + special_masst.prefix, file)
+    if comp_id is None:
+        return "", [], []
+    rows = []
+    try:
+        tree_root = json.loads(compressed_files.read_text(file))
+        for node in tree_root["children"]:
+            for_all_children(rows, node, min_matches, node_key=node_key)
+    except Exception as e:
+        logger.warning("Cannot read tree %s: %s", file, e)
+        return comp_id.group(1), [], []
+
+    # same order as json_to_dataframe: by rank (missing last), matched_size, and group_size, all descending
+    rows.sort(
+        key=lambda row: (row["Rank"] is not None, row["Rank"] or "", row["matched_size"], row["group_size"]),
+        reverse=True,
+    )
+    nodes, matched_sizes, seen = [], [], set()
+    for row in rows:
+        if row[node_key] in seen:
             continue
+        seen.add(row[node_key])
+        nodes.append((row[node_key], row["Name"], row["Rank"], row["group_size"], row["Level"]))
+        matched_sizes.append(row["matched_size"])
+    return comp_id.group(1), nodes, matched_sizes
 
-        df[node_id] = df[node_id].astype(str)
-        df = create_multi_index(df.drop_duplicates(node_id), special_masst)
-        # set detected to 1
-        if matches_to_binary_presence:
-            df[comp_id] = 1
-        else:
-            df[comp_id] = df["matched_size"]
 
-        df = df.drop(columns=["matched_size"])
-        if len(df) > 0:
-            dfs.append(df)
-        # if len(dfs) > 10:
-        #     break
+def summary_node_columns(special_masst: SpecialMasst) -> list:
+    return [special_masst.tree_node_key, "Name", "Rank", "group_size", "Level"]
+
+
+def empty_summary_state(params: dict) -> SummaryState:
+    return SummaryState(
+        params=params,
+        nodes=[],
+        files=pd.DataFrame({"file": [], "size": [], "mtime_ns": [], "compound": []}).astype(
+            {"file": str, "size": np.int64, "mtime_ns": np.int64, "compound": str}
+        ),
+        entries=pd.DataFrame({"file": [], "node": [], "matched_size": []}).astype(np.int32),
+    )
+
+
+def update_summary_state(state: SummaryState, files: list, special_masst: SpecialMasst, workers=None):
+    """
+    Ingests new and changed tree files and removes the entries of changed and deleted files
+    """
+    stats = []
+    for file in files:
+        try:
+            stat = os.stat(file)
+            stats.append((file, stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            pass
+    current = pd.DataFrame(stats, columns=["file", "size", "mtime_ns"])
+
+    # keep files with the same size and modification time
+    known = state.files.reset_index(drop=True)
+    merged = known.merge(current, on="file", how="left", suffixes=("", "_now"))
+    keep = ((merged["size"] == merged["size_now"]) & (merged["mtime_ns"] == merged["mtime_ns_now"])).to_numpy()
+    new_files = current[~current["file"].isin(known["file"][keep])]
+    logger.info(
+        "Summary of %s: %d files unchanged, %d new or changed, %d removed",
+        special_masst.prefix,
+        keep.sum(),
+        len(new_files),
+        (~keep).sum() - known["file"][~keep].isin(new_files["file"]).sum(),
+    )
+
+    # renumber the files that are kept
+    file_codes = np.cumsum(keep) - 1
+    entries = state.entries[keep[state.entries["file"].to_numpy()]].copy()
+    entries["file"] = file_codes[entries["file"].to_numpy()].astype(np.int32)
+    files_df = known[keep]
+
+    compounds = []
+    new_entries = [entries]
+    for file_code, (compound, nodes, matched_sizes) in enumerate(
+        tqdm(parse_tree_files(new_files["file"].tolist(), special_masst, state.params["min_matches"], workers),
+             total=len(new_files)),
+        start=len(files_df),
+    ):
+        compounds.append(compound)
+        if len(nodes) == 0:
+            continue
+        node_codes = [state.node_codes.setdefault(node, len(state.node_codes)) for node in nodes]
+        new_entries.append(
+            pd.DataFrame(
+                {
+                    "file": np.full(len(node_codes), file_code, dtype=np.int32),
+                    "node": np.array(node_codes, dtype=np.int32),
+                    "matched_size": np.array(matched_sizes, dtype=np.int32),
+                }
+            )
+        )
+
+    state.nodes = list(state.node_codes.keys())
+    state.files = pd.concat([files_df, new_files.assign(compound=compounds)], ignore_index=True)
+    state.entries = pd.concat(new_entries, ignore_index=True)
 
-    if len(dfs) == 0:
+
+def parse_tree_files(files: list, special_masst: SpecialMasst, min_matches=1, workers=None):
+    """
+    :return: iterator of compound id and matched nodes of each file in order
+    """
+    parse = partial(read_tree_nodes, special_masst=special_masst, min_matches=min_matches)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(files) < 2:
+        yield from map(parse, files)
+        return
+    with ProcessPoolExecutor(workers) as executor:
+        yield from executor.map(parse, files, chunksize=max(1, min(256, len(files) // (workers * 8))))
+
+
+def summary_dataframe(
+        state: SummaryState, special_masst: SpecialMasst, matches_to_binary_presence=True
+) -> pd.DataFrame | None:
+    """
+    :return: sparse node × compound table, None if no compound had matches
+    """
+    files = state.files
+    # a compound keeps the entries of its latest file, e.g., after the outputs were compressed
+    valid = ((files["compound"] != "") & ~files["compound"].duplicated(keep="last")).to_numpy()
+    entries = state.entries[valid[state.entries["file"].to_numpy()]]
+    if len(entries) == 0:
         return None
 
-    merged_df = pd.concat(dfs, join="outer", axis=1).fillna(0)
-    if out_file:
-        merged_df.to_csv(out_file)
-    return merged_df
+    compound_codes, compounds = pd.factorize(files["compound"].where(valid))
+    columns = compound_codes[entries["file"].to_numpy()]
+    used_nodes, rows = np.unique(entries["node"].to_numpy(), return_inverse=True)
+    values = (
+        np.ones(len(entries), dtype=np.float64)
+        if matches_to_binary_presence
+        else entries["matched_size"].to_numpy(dtype=np.float64)
+    )
+    matrix = sparse.coo_matrix((values, (rows, columns)), shape=(len(used_nodes), len(compounds))).tocsr()
+    index = pd.MultiIndex.from_tuples(
+        [state.nodes[node] for node in used_nodes], names=summary_node_columns(special_masst)
+    )
+    return pd.DataFrame.sparse.from_spmatrix(matrix, index=index, columns=list(compounds))
+
+
+def load_summary_state(state_dir, params: dict) -> SummaryState | None:
+    """
+    :return: the saved state or None if there is none or it was created with other parameters
+    """
+    try:
+        with open(os.path.join(state_dir, "manifest.json")) as file:
+            manifest = json.load(file)
+        if manifest.get("params") != params:
+            logger.info("Summary parameters changed, ingesting all files again")
+            return None
+        nodes_df = pd.read_parquet(os.path.join(state_dir, "nodes.parquet"))
+        return SummaryState(
+            params=params,
+            nodes=list(zip(*(nodes_df[c].tolist() for c in nodes_df.columns))),
+            files=pd.read_parquet(os.path.join(state_dir, "files.parquet")),
+            entries=pd.read_parquet(os.path.join(state_dir, "entries.parquet")),
+        )
+    except FileNotFoundError:
+        return None
+
+
+def save_summary_state(state: SummaryState, state_dir):
+    os.makedirs(state_dir, exist_ok=True)
+    nodes_df = pd.DataFrame(state.nodes, columns=[state.params["node_key"], "Name", "Rank", "group_size", "Level"])
+    nodes_df.to_parquet(os.path.join(state_dir, "nodes.parquet"), index=False)
+    state.files.to_parquet(os.path.join(state_dir, "files.parquet"), index=False)
+    state.entries.to_parquet(os.path.join(state_dir, "entries.parquet"), index=False)
+    # the manifest is written last and marks a complete state
+    with open(os.path.join(state_dir, "manifest.json.tmp"), "w") as file:
+        json.dump({"params": state.params, "files": len(state.files), "entries": len(state.entries)}, file)
+    os.replace(os.path.join(state_dir, "manifest.json.tmp"), os.path.join(state_dir, "manifest.json"))
 
 
 def for_all_children(rows, node, minimum_matches=1, node_key="NCBI", level=1):
@@ -131,10 +427,10 @@ def for_all_children(rows, node, minimum_matches=1, node_key="NCBI", level=1):
 
 def json_to_dataframe(file, node_key="NCBI", min_matches=1):
     rows = []
-    with open(file) as json_file:
-        treeRoot = json.load(json_file)
-        for node in treeRoot["children"]:
-            for_all_children(rows, node, min_matches, node_key=node_key)
+    # plain or compressed json
+    treeRoot = json.loads(compressed_files.read_text(file))
+    for node in treeRoot["children"]:
+        for_all_children(rows, node, min_matches, node_key=node_key)
     if len(rows) == 0:
         return None
     return pd.DataFrame(rows).sort_values(
@@ -148,42 +444,516 @@ def create_multi_index(df: pd.DataFrame, special_masst: SpecialMasst) -> pd.Data
     )
 
 
-def create_all_summary_files(special_masst:SpecialMasst, masst_directory, quant_csv, out_base_file, min_matches=1):
+def create_all_summary_files(
+        special_masst: SpecialMasst,
+        masst_directory,
+        quant_csv,
+        out_base_file,
+        min_matches=1,
+        quant_df: pd.DataFrame = None,
+        quant_out_format="csv",
+        workers=None,
+        incremental=True,
+        add_enrichment=False,
+):
+    """
+    :param quant_df: the imported quant table, None imports quant_csv
+    :param quant_out_format: csv or parquet for the sample summaries
+    :param workers: number of processes that read the tree files, None uses all CPUs
+    :param incremental: keeps the summary state next to the outputs and only reads new and changed tree files
+    :param add_enrichment: writes the enrichment of all matched nodes of all compounds to
+    {out_base_file}_{prefix}_enrichment in the quant_out_format
+    """
     out_base_file = "{}_{}".format(out_base_file, special_masst.prefix)
+    state_dir = "{}_summary_state".format(out_base_file) if incremental else None
     merged_df = create_summary_file(
         parent_directory=masst_directory,
         out_file= "{}_spectral_matches.csv".format(out_base_file),
         special_masst=special_masst,
         min_matches=min_matches,
         matches_to_binary_presence=True,
+        workers=workers,
+        state_dir=state_dir,
     )
     if merged_df is None:
         return
 
-    if quant_csv is not None:
+    if add_enrichment:
+        # the enrichment needs the number of matches, the state of the first summary is up to date
+        matches_df = create_summary_file(
+            parent_directory=masst_directory,
+            special_masst=special_masst,
+            min_matches=min_matches,
+            matches_to_binary_presence=False,
+            workers=workers,
+            state_dir=state_dir,
+        )
+        write_summary_table(
+            enrichment.summary_enrichment(matches_df, special_masst),
+            "{}_enrichment.{}".format(out_base_file, quant_out_format),
+        )
+
+    if quant_csv is not None or quant_df is not None:
+        if quant_df is None:
+            quant_df = import_quantdf(quant_csv)
         create_quant_summary(
             quant_csv=quant_csv,
             summary_df=merged_df,
-            out_file=out_base_file + "_samples_binary.csv",
+            out_file="{}_samples_binary.{}".format(out_base_file, quant_out_format),
             sum_as_binary_presence=True,
+            quant_df=quant_df,
         )
 
         create_quant_summary(
             quant_csv=quant_csv,
             summary_df=merged_df,
-            out_file=out_base_file + "_samples_row_normalized.csv",
+            out_file="{}_samples_row_normalized.{}".format(out_base_file, quant_out_format),
             sum_as_binary_presence=False,
+            quant_df=quant_df,
         )
 
-def create_all_masst_summaries(masst_directory, quant_csv, out_base_file, min_matches=1, ):
+def create_all_masst_summaries(
+        masst_directory,
+        quant_csv,
+        out_base_file,
+        min_matches=1,
+        quant_out_format="csv",
+        workers=None,
+        incremental=True,
+        add_enrichment=False,
+):
+    # the quant table is shared by all special MASSTs
+    quant_df = import_quantdf(quant_csv) if quant_csv is not None else None
     for special_masst in masst_utils.SPECIAL_MASSTS:
-        create_all_summary_files(special_masst, masst_directory, quant_csv, out_base_file, min_matches)
+        create_all_summary_files(
+            special_masst,
+            masst_directory,
+            quant_csv,
+            out_base_file,
+            min_matches,
+            quant_df,
+            quant_out_format,
+            workers,
+            incremental,
+            add_enrichment,
+        )
+
+
+def create_count_summary(
+        out_file_no_extension,
+        out_base_file,
+        min_cosine=0.0,
+        exclude_datasets=(),
+        analog=False,
+        out_format="parquet",
+        workers=None,
+        result_store=None,
+        special_massts: list[SpecialMasst] = None,
+        ranks=(),
+) -> pd.DataFrame:
+    """
+    Summarises the counts files of all compounds of a batch in one streaming pass: the number of matches of each
+    compound in each special MASST and, for each special MASST, the number of matches of each compound in each node.
+    Matches below min_cosine, from excluded datasets, and from QC or blank samples are removed
+
+    :param out_file_no_extension: the output prefix of the batch
+    :param out_base_file: writes {out_base_file}_compound_counts and {out_base_file}_{prefix}_node_counts
+    :param exclude_datasets: MassIVE datasets to exclude, e.g., the dataset of the query
+    :param analog: summarise the analog counts files instead
+    :param out_format: parquet or csv
+    :param workers: number of processes that read the counts files, None uses all CPUs
+    :param result_store: read the counts tables of this parquet result store instead of the counts files
+    :param special_massts: None for all special MASSTs
+    :param ranks: lineage ranks, e.g., phylum or genus, writes {out_base_file}_{prefix}_{rank}_rank_counts with the
+    matches and files of each compound at each rank for the special MASSTs with a lineage table
+    :return: compound × special MASST match counts
+    """
+    if special_massts is None:
+        special_massts = masst_utils.SPECIAL_MASSTS
+    rank_writers = {
+        (special_masst.prefix, rank): SummaryTableWriter(
+            "{}_{}_{}_rank_counts.{}".format(out_base_file, special_masst.prefix, rank, out_format)
+        )
+        for special_masst in special_massts
+        if lineages.lineage_index(special_masst) is not None
+        for rank in ranks
+    }
+    node_writers = {
+        special_masst.prefix: SummaryTableWriter(
+            "{}_{}_node_counts.{}".format(out_base_file, special_masst.prefix, out_format)
+        )
+        for special_masst in special_massts
+    }
+    compound_counts = []
+    try:
+        if result_store:
+            parts = iter_store_counts(
+                result_store, special_massts, min_cosine, exclude_datasets, analog, ranks
+            )
+        else:
+            parts = iter_file_counts(
+                out_file_no_extension, special_massts, min_cosine, exclude_datasets, analog, workers, ranks
+            )
+        for special_masst, matches, node_df, rank_dfs in parts:
+            compound_counts.extend(
+                (compound, special_masst.prefix, n_matches) for compound, n_matches in matches.items()
+            )
+            if node_df is not None and len(node_df) > 0:
+                node_writers[special_masst.prefix].append(node_df)
+            for rank, rank_df in rank_dfs.items():
+                if len(rank_df) > 0:
+                    rank_writers[(special_masst.prefix, rank)].append(rank_df)
+    finally:
+        for writer in [*node_writers.values(), *rank_writers.values()]:
+            writer.close()
+
+    counts_df = pd.DataFrame(compound_counts, columns=["Compound", "prefix", "matches"])
+    counts_df = counts_df.groupby(["Compound", "prefix"], sort=False)["matches"].sum().unstack("prefix")
+    counts_df = counts_df.reindex(columns=[special_masst.prefix for special_masst in special_massts])
+    counts_df = counts_df.fillna(0).astype(np.int64).add_prefix("masst_")
+    counts_df.columns.name = None
+    write_summary_table(counts_df.reset_index(), "{}_compound_counts.{}".format(out_base_file, out_format))
+    return counts_df
+
+
+def count_file_pattern(out_file_no_extension, special_massts: list[SpecialMasst]):
+    """
+    :return: regex of the counts file names of a batch with the groups compound, analog, and prefix
+    """
+    return re.compile(
+        r"^{}_(?P<compound>.+?)(?P<analog>_analog)?_counts_(?P<prefix>{})\.tsv(?:{})?$".format(
+            re.escape(Path(out_file_no_extension).name),
+            "|".join(re.escape(special_masst.prefix) for special_masst in special_massts),
+            "|".join(re.escape(suffix) for suffix in COMPRESSION_SUFFIXES.values()),
+        )
+    )
+
+
+def finished_file_compounds(out_file_no_extension) -> list:
+    """
+    :return: the sorted compounds of a batch with a match table, in the flat and sharded layout
+    """
+    pattern = re.compile(
+        r"^{}_(?P<compound>.+?)(?P<table>_analog|_unfiltered)?_matches\.tsv(?:{})?$".format(
+            re.escape(Path(out_file_no_extension).name),
+            "|".join(re.escape(suffix) for suffix in COMPRESSION_SUFFIXES.values()),
+        )
+    )
+    compounds = set()
+    for file in scan_output_files(out_file_no_extension, COUNT_FILE_SUFFIXES) | scan_output_files(
+            out_file_no_extension, COUNT_FILE_SUFFIXES, sharded=True
+    ):
+        match = pattern.match(os.path.basename(file))
+        if match is not None and match.group("table") is None:
+            compounds.add(match.group("compound"))
+    return sorted(compounds)
+
+
+def iter_file_counts(
+        out_file_no_extension, special_massts, min_cosine=0.0, exclude_datasets=(), analog=False, workers=None, ranks=()
+):
+    """
+    Finds the counts files in the flat and sharded layout in one directory sweep and reads them in parallel processes
+    :return: iterator of special MASST, dict of compound and number of matches, node counts, and dict of rank and
+    rank counts
+    """
+    # finished compounds without counts file count as 0 like in the result store
+    compounds = finished_file_compounds(out_file_no_extension)
+    for special_masst in special_massts:
+        yield special_masst, dict.fromkeys(compounds, 0), None, {}
+
+    pattern = count_file_pattern(out_file_no_extension, special_massts)
+    by_prefix = {special_masst.prefix: special_masst for special_masst in special_massts}
+    jobs = []
+    for file in sorted(
+            scan_output_files(out_file_no_extension, COUNT_FILE_SUFFIXES)
+            | scan_output_files(out_file_no_extension, COUNT_FILE_SUFFIXES, sharded=True)
+    ):
+        match = pattern.match(os.path.basename(file))
+        if match is None or (match.group("analog") is not None) != analog:
+            continue
+        jobs.append((file, by_prefix[match.group("prefix")], match.group("compound")))
+    logger.info("Summarising %d counts files", len(jobs))
+
+    read = partial(read_count_file, min_cosine=min_cosine, exclude_datasets=exclude_datasets, ranks=ranks)
+    files = [file for file, _, _ in jobs]
+    masst_list = [special_masst for _, special_masst, _ in jobs]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(jobs) < 2:
+        results = map(read, files, masst_list)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(workers)
+        results = executor.map(read, files, masst_list, chunksize=max(1, min(256, len(jobs) // (workers * 8))))
+    try:
+        for (_, special_masst, compound), (n_matches, node_df, rank_dfs) in tqdm(
+                zip(jobs, results), total=len(jobs)
+        ):
+            for df in [node_df, *rank_dfs.values()]:
+                if df is not None:
+                    df.insert(0, "Compound", compound)
+            yield special_masst, {compound: n_matches}, node_df, rank_dfs
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def read_count_file(
+        file, special_masst: SpecialMasst, min_cosine=0.0, exclude_datasets=(), ranks=()
+) -> tuple[int, pd.DataFrame | None, dict]:
+    """
+    Runs in the worker processes
+    :return: the number of filtered matches, the matches per node, and dict of rank and the matches and files per
+    rank name
+    """
+    node_key = special_masst.metadata_key
+    columns = set(COUNT_FILTER_COLUMNS + [node_key, "file_usi"])
+    try:
+        matches_df = pd.read_csv(file, sep="\t", usecols=lambda c: c in columns)
+    except Exception as e:
+        logger.warning("Cannot read counts file %s: %s", file, e)
+        return 0, None, {}
+    matches_df = matches_df[count_filter_mask(matches_df, min_cosine, exclude_datasets)]
+    if node_key not in matches_df.columns:
+        return len(matches_df), None, {}
+    return len(matches_df), node_counts(matches_df, [node_key]), rank_counts(matches_df, special_masst, ranks, ())
+
+
+def iter_store_counts(result_store, special_massts, min_cosine=0.0, exclude_datasets=(), analog=False, ranks=()):
+    """
+    Streams the counts tables of a parquet result store in record batches. The files of a compound may span batches,
+    the rank counts are aggregated once from the filtered taxa and files of all batches
+    :return: iterator of special MASST, dict of compound and number of matches, node counts, and dict of rank and
+    rank counts
+    """
+    compounds = parquet_sink.finished_compounds(result_store)
+    for special_masst in special_massts:
+        node_key = special_masst.metadata_key
+        table = "{}counts_{}".format("analog_" if analog else "", special_masst.prefix)
+        compound_parts, node_parts, rank_parts = [], [], []
+        rank_columns = ["Compound", node_key, "file_usi"]
+        collect_ranks = len(ranks) > 0 and lineages.lineage_index(special_masst) is not None
+        for batch_df in parquet_sink.iter_table_batches(result_store, table):
+            batch_df = batch_df[count_filter_mask(batch_df, min_cosine, exclude_datasets)]
+            batch_df = batch_df.assign(Compound=batch_df[parquet_sink.COMPOUND_COLUMN].astype(str))
+            compound_parts.append(batch_df.groupby("Compound").size())
+            if node_key in batch_df.columns:
+                node_parts.append(node_counts(batch_df, ["Compound", node_key]))
+                if collect_ranks:
+                    rank_parts.append(batch_df[[c for c in rank_columns if c in batch_df.columns]])
+
+        matches = pd.concat(compound_parts).groupby(level=0).sum() if compound_parts else pd.Series(dtype=int)
+        nodes_df = (
+            pd.concat(node_parts).groupby(["Compound", node_key], sort=False, as_index=False)["matches"].sum()
+            if node_parts
+            else None
+        )
+        # finished compounds without matches count as 0 like empty counts files
+        rank_dfs = rank_counts(pd.concat(rank_parts, ignore_index=True), special_masst, ranks) if rank_parts else {}
+        yield special_masst, {**dict.fromkeys(sorted(compounds), 0), **matches.to_dict()}, nodes_df, rank_dfs
+
+
+def count_filter_mask(matches_df: pd.DataFrame, min_cosine=0.0, exclude_datasets=()) -> np.ndarray:
+    """
+    :return: mask of matches with at least min_cosine that are not from excluded datasets or QC and blank samples
+    """
+    mask = np.ones(len(matches_df), dtype=bool)
+    if "Cosine" in matches_df.columns:
+        mask &= (matches_df["Cosine"] >= min_cosine).to_numpy()
+    for column in ["QC", "Blank"]:
+        if column in matches_df.columns:
+            mask &= (matches_df[column] != "Yes").to_numpy()
+    if len(exclude_datasets) > 0 and "Dataset" in matches_df.columns:
+        mask &= ~matches_df["Dataset"].isin(list(exclude_datasets)).to_numpy()
+    return mask
+
+
+def node_counts(matches_df: pd.DataFrame, keys: list) -> pd.DataFrame:
+    return (
+        matches_df.dropna(subset=[keys[-1]])
+        .astype({keys[-1]: str})
+        .groupby(keys, sort=False)
+        .size()
+        .reset_index(name="matches")
+    )
+
+
+def rank_counts(matches_df: pd.DataFrame, special_masst: SpecialMasst, ranks, group_columns=("Compound",)) -> dict:
+    """
+    :return: dict of rank and the matches and files of each rank name, empty if the special MASST has no lineage table
+    """
+    index = lineages.lineage_index(special_masst)
+    if index is None:
+        return {}
+    return {
+        rank: lineages.aggregate_ranks(
+            index, matches_df, rank, group_columns=group_columns, taxon_column=special_masst.metadata_key
+        )
+        for rank in ranks
+    }
+
+
+class SummaryTableWriter:
+    """
+    Appends data frames to a parquet or csv file in large row groups, creates the file with the first rows
+    """
+
+    def __init__(self, out_file, row_group_rows=100_000):
+        self.out_file = str(out_file)
+        self.row_group_rows = row_group_rows
+        self._pending = []
+        self._pending_rows = 0
+        self._parquet_writer = None
+        self._csv_header = True
+
+    def append(self, df: pd.DataFrame):
+        self._pending.append(df)
+        self._pending_rows += len(df)
+        if self._pending_rows >= self.row_group_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        df = pd.concat(self._pending, ignore_index=True)
+        self._pending = []
+        self._pending_rows = 0
+        Path(self.out_file).parent.mkdir(parents=True, exist_ok=True)
+        if self.out_file.endswith(".parquet"):
+            count_columns = [c for c in ["matches", "files"] if c in df.columns]
+            table = pa.Table.from_pandas(
+                df.astype(str).assign(**{c: df[c] for c in count_columns}), preserve_index=False
+            )
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.out_file, table.schema)
+            self._parquet_writer.write_table(table)
+        else:
+            df.to_csv(self.out_file, mode="w" if self._csv_header else "a", header=self._csv_header, index=False)
+            self._csv_header = False
+
+    def close(self):
+        self.flush()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+
+
+def write_summary_table(df: pd.DataFrame, out_file):
+    Path(out_file).parent.mkdir(parents=True, exist_ok=True)
+    if str(out_file).endswith(".parquet"):
+        df.to_parquet(out_file, index=False)
+    else:
+        df.to_csv(out_file, index=False)
 
 
 if __name__ == "__main__":
-    create_all_masst_summaries(
-        r"D:\git\microbe_masst\output\piper_vs_microbiome\\",
-        r"D:\git\microbe_masst\local_files\SEED_Grant_iimn_gnps_quant.csv",
-        r"D:\git\microbe_masst\output\mmasst_summary_seed_grant",
-        min_matches = 1,
-    )
\ No newline at end of file
+    # parsing the input arguments for the summaries
+    parser = argparse.ArgumentParser(description="Summarise the MASST results of all compounds of a batch")
+    parser.add_argument(
+        "--mode",
+        type=str,
+        help="counts summarises the counts files of all special MASSTs in one pass, trees summarises the tree files "
+        "and optionally a quant table",
+        default="counts",  # counts or trees
+    )
+    parser.add_argument(
+        "--in_file",
+        type=str,
+        help="output prefix of the batch, e.g., ../output/fastMASST",
+        required=True,
+    )
+    parser.add_argument(
+        "--out_file",
+        type=str,
+        help="output prefix of the summary tables",
+        required=True,
+    )
+    parser.add_argument(
+        "--min_cos",
+        type=float,
+        help="counts mode: minimum cosine of the matches",
+        default=0.0,
+    )
+    parser.add_argument(
+        "--exclude_datasets",
+        type=str,
+        help="counts mode: comma separated MassIVE datasets to exclude, e.g., the dataset of the query compounds",
+        default=None,
+    )
+    parser.add_argument(
+        "--analog",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="counts mode: summarise the analog counts",
+        default=False,
+    )
+    parser.add_argument(
+        "--result_store",
+        type=str,
+        help="counts mode: read the counts of this parquet result store instead of the counts files",
+        default=None,
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        help="parquet or csv",
+        default="parquet",
+    )
+    parser.add_argument(
+        "--ranks",
+        type=str,
+        help="counts mode: comma separated lineage ranks of the microbe and plant MASST, e.g., phylum,family,genus",
+        default=None,
+    )
+    parser.add_argument(
+        "--quant_csv",
+        type=str,
+        help="trees mode: MZmine quant table to summarise per sample",
+        default=None,
+    )
+    parser.add_argument(
+        "--min_matches",
+        type=int,
+        help="trees mode: minimum matches of a node",
+        default=1,
+    )
+    parser.add_argument(
+        "--enrichment",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="trees mode: also write the enrichment p-value, FDR, and fold enrichment of all matched nodes",
+        default=False,
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of processes that read the files. Default is one per CPU",
+        default=None,
+    )
+
+    args = parser.parse_args()
+
+    if args.mode == "counts":
+        create_count_summary(
+            args.in_file,
+            args.out_file,
+            min_cosine=args.min_cos,
+            exclude_datasets=args.exclude_datasets.split(",") if args.exclude_datasets else (),
+            analog=args.analog,
+            out_format=args.format,
+            workers=args.workers,
+            result_store=args.result_store,
+            ranks=args.ranks.split(",") if args.ranks else (),
+        )
+    elif args.mode == "trees":
+        # the tree summaries are read by prefix
+        create_all_masst_summaries(
+            args.in_file + "_",
+            args.quant_csv,
+            args.out_file,
+            min_matches=args.min_matches,
+            quant_out_format=args.format,
+            workers=args.workers,
+            add_enrichment=args.enrichment,
+        )
+    else:
+        raise ValueError("Unknown mode {}, use counts or trees".format(args.mode))
+    sys.exit(0)
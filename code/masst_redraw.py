@@ -0,0 +1,352 @@
+import argparse
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from distutils.util import strtobool
+from pathlib import Path
+
+import pandas as pd
+from tqdm import tqdm
+
+import compressed_files
+import fingerprints
+import masst_client
+import parquet_sink
+import usi_utils
+from compressed_files import COMPRESSION_SUFFIXES
+from compressed_files import check_compression
+from compressed_files import strip_compression_suffix
+from masst_utils import SPECIAL_MASSTS
+from utils import OutputOptions
+from utils import RENDER_OPTIONS
+from utils import with_render_options
+from utils import scan_output_files
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+MATCHES_SUFFIX = "_matches.tsv"
+# other match tables that also end with the matches suffix
+OTHER_MATCH_TABLES = ["_analog_matches.tsv", "_unfiltered_matches.tsv"]
+
+
+def find_batch_compounds(out_file_no_extension, shard=False) -> dict:
+    """
+    Finds all compounds of a batch by their match tables in one directory sweep
+    :return: dict of compound name and the common file of its outputs
+    """
+    suffixes = tuple(MATCHES_SUFFIX + suffix for suffix in ["", *COMPRESSION_SUFFIXES.values()])
+    prefix = Path(out_file_no_extension).name + "_"
+    compounds = {}
+    for file in scan_output_files(out_file_no_extension, suffixes, shard):
+        file = strip_compression_suffix(file)
+        if any(file.endswith(table) for table in OTHER_MATCH_TABLES):
+            continue
+        common_file = file[: -len(MATCHES_SUFFIX)]
+        compounds[Path(common_file).name[len(prefix):]] = common_file
+    return compounds
+
+
+def read_match_table(file) -> pd.DataFrame | None:
+    """
+    Reads a plain or compressed table of a compound and adds the file_usi to match tables
+    :return: the table or None if it does not exist
+    """
+    existing = compressed_files.find_file(file)
+    if existing is None:
+        return None
+    # exact floats keep the fingerprints of the matches from the original run
+    matches_df = pd.read_csv(existing, sep="\t", float_precision="round_trip")
+    if "file_usi" not in matches_df.columns and "USI" in matches_df.columns and len(matches_df) > 0:
+        matches_df["file_usi"] = usi_utils.file_usi_series(matches_df["USI"])
+    return matches_df
+
+
+def redraw_compound(
+    compound_name,
+    common_file,
+    output_options: OutputOptions,
+    special_masst_prefixes=None,
+    matches_df: pd.DataFrame = None,
+    analog_matches_df: pd.DataFrame = None,
+    force=False,
+    delta_mass_histogram_df: pd.DataFrame = None,
+    option_overrides: dict = None,
+) -> bool:
+    """
+    Renders the trees of one compound again from its stored matches with the render options of the original run.
+    Trees whose matches, labels, options, template, and special MASST data files did not change since the last
+    rendering are skipped.
+
+    :param output_options: options of outputs from before the render options were saved in the manifest
+
+    :param special_masst_prefixes: only these special MASSTs, None for all
+    :param matches_df: the filtered matches, None reads the match table of the compound
+    :param analog_matches_df: the analog matches, None reads the analog match table if it exists
+    :param force: renders all selected trees
+    :param delta_mass_histogram_df: the nominal mass shifts of the analog matches that select the mass shift trees,
+    None reads the table of the compound if it exists
+    :param option_overrides: render options that replace the options of the original run
+    :return: True if any tree was rendered
+    """
+    try:
+        if matches_df is None:
+            matches_df = read_match_table(common_file + MATCHES_SUFFIX)
+            analog_matches_df = read_match_table(common_file + "_analog_matches.tsv")
+            delta_mass_histogram_df = read_match_table(common_file + "_analog_delta_mass.tsv")
+        if matches_df is None or len(matches_df) == 0:
+            return False
+
+        manifest = fingerprints.read_manifest(common_file)
+        # outputs from before the manifest only have their compound name
+        labels = manifest.get(
+            "labels",
+            {
+                "input_label": "Descriptor: {}".format(compound_name),
+                "params_label": "",
+                "usi": None,
+                "lib_match_json": "[]",
+            },
+        )
+        # the same trees and options as the original run
+        output_options = with_render_options(output_options, manifest.get("options"))
+        output_options = with_render_options(output_options, option_overrides)
+        variants = masst_client.match_variants(
+            common_file,
+            matches_df,
+            analog_matches_df,
+            delta_mass_histogram_df,
+            output_options.top_mass_shift_trees,
+        )
+
+        special_massts = [
+            special_masst
+            for special_masst in SPECIAL_MASSTS
+            if special_masst_prefixes is None or special_masst.prefix in special_masst_prefixes
+        ]
+        try:
+            new_manifest = masst_client.render_trees(
+                variants,
+                labels,
+                output_options,
+                special_massts=special_massts,
+                # only the trees, the counts files and result store keep the tables of the original run
+                export_counts=False,
+                manifest=manifest,
+                force=force,
+            )
+        except masst_client.RenderError as e:
+            fingerprints.write_manifest(common_file, e.manifest)
+            raise
+        if new_manifest == manifest and not force:
+            return False
+        fingerprints.write_manifest(common_file, new_manifest)
+        return True
+    except Exception as e:
+        logger.exception(e)
+        return False
+
+
+def compound_groups(df: pd.DataFrame) -> dict:
+    """
+    :return: dict of compound name and its rows of a result store table
+    """
+    if len(df) == 0:
+        return {}
+    return dict(list(df.groupby(parquet_sink.COMPOUND_COLUMN, observed=True)))
+
+
+def redraw_batch(
+    out_file_no_extension,
+    special_masst_prefixes=None,
+    workers=None,
+    result_store=None,
+    output_options: OutputOptions = None,
+    force=False,
+    option_overrides: dict = None,
+) -> int:
+    """
+    Renders the trees of all compounds of a batch again without querying fastMASST, e.g., after the tree or metadata
+    of a special MASST changed. The compounds are rendered in parallel processes.
+
+    :param out_file_no_extension: the output prefix of the batch
+    :param special_masst_prefixes: only these special MASSTs, None for all
+    :param workers: number of processes, None uses all CPUs
+    :param result_store: read the matches from this parquet result store instead of the match tables
+    :param output_options: the output layout of the batch and the options of outputs from before the render options
+    were saved. Each compound is rendered with the render options of the original run
+    :param force: renders all selected trees even if their inputs did not change
+    :param option_overrides: render options that replace the options of the original run, see RENDER_OPTIONS
+    :return: the number of compounds with new trees
+    """
+    if output_options is None:
+        output_options = OutputOptions()
+
+    if result_store:
+        matches_df = parquet_sink.read_table(result_store, "matches")
+        analog_df = parquet_sink.read_table(result_store, "analog_matches")
+        analog_groups = compound_groups(analog_df)
+        histogram_groups = compound_groups(parquet_sink.read_table(result_store, "analog_delta_mass"))
+        # batches with analog search have the analog table, also compounds without analog matches
+        no_analog_df = analog_df.iloc[:0] if len(analog_df.columns) > 0 else None
+        jobs = [
+            (
+                str(compound_name),
+                masst_client.common_base_file_name(
+                    str(compound_name), out_file_no_extension, output_options.shard_outputs
+                ),
+                compound_df,
+                analog_groups.get(compound_name, no_analog_df),
+                histogram_groups.get(compound_name),
+            )
+            for compound_name, compound_df in compound_groups(matches_df).items()
+        ]
+    else:
+        compounds = find_batch_compounds(out_file_no_extension, output_options.shard_outputs)
+        jobs = [(compound_name, common_file, None, None, None) for compound_name, common_file in compounds.items()]
+
+    logger.info("Redrawing the trees of %d compounds", len(jobs))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        redrawn = [
+            redraw_compound(
+                name,
+                common_file,
+                output_options,
+                special_masst_prefixes,
+                df,
+                analog_df,
+                force,
+                histogram_df,
+                option_overrides,
+            )
+            for name, common_file, df, analog_df, histogram_df in tqdm(jobs)
+        ]
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(
+                    redraw_compound,
+                    name,
+                    common_file,
+                    output_options,
+                    special_masst_prefixes,
+                    df,
+                    analog_df,
+                    force,
+                    histogram_df,
+                    option_overrides,
+                )
+                for name, common_file, df, analog_df, histogram_df in jobs
+            ]
+            redrawn = [future.result() for future in tqdm(futures)]
+
+    n_redrawn = sum(redrawn)
+    logger.info("Redrew %d compounds, %d were unchanged", n_redrawn, len(jobs) - n_redrawn)
+    return n_redrawn
+
+
+if __name__ == "__main__":
+    # parsing the input arguments for the redraw
+    parser = argparse.ArgumentParser(
+        description="Render the trees and reports of an existing batch again without querying fastMASST"
+    )
+    parser.add_argument(
+        "--out_file",
+        type=str,
+        help="output prefix of the existing batch",
+        default="../output/fastMASST",
+    )
+    parser.add_argument(
+        "--special_massts",
+        type=str,
+        help="comma separated special MASST prefixes to redraw, e.g., microbe,plant. Default redraws all",
+        default=None,
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of processes. Default is one per CPU",
+        default=None,
+    )
+    parser.add_argument(
+        "--result_store",
+        type=str,
+        help="read the matches from this parquet result store instead of the match tables",
+        default=None,
+    )
+    parser.add_argument(
+        "--force",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="redraw all trees even if their inputs did not change",
+        default=False,
+    )
+    parser.add_argument(
+        "--shard_outputs",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="the batch was written with hashed subdirectories",
+        default=False,
+    )
+    # the render options default to the options of the original run
+    parser.add_argument(
+        "--shared_assets",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="write the JS and CSS libraries once into an assets folder next to the reports. Default is the option "
+        "of the original run",
+        default=None,
+    )
+    parser.add_argument(
+        "--prune_depth",
+        type=int,
+        help="remove subtrees without matches at this depth or deeper from the trees (root is depth 0), -1 keeps "
+        "the full trees. Default is the option of the original run",
+        default=None,
+    )
+    parser.add_argument(
+        "--compact_json",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="remove node fields from the tree json that the reports derive themselves. Default is the option of "
+        "the original run",
+        default=None,
+    )
+    parser.add_argument(
+        "--top_mass_shift_trees",
+        type=int,
+        help="render the analog matches of this many nominal mass shifts as trees of their own. Default is the "
+        "option of the original run",
+        default=None,
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        help="gzip, zstd, or none compression of the tree json, TSV, and HTML files. Default is the option of the "
+        "original run",
+        default=None,
+    )
+    parser.add_argument(
+        "--enrichment",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="add the hypergeometric enrichment p-value, FDR, and fold enrichment of the matches to each node of "
+        "the special MASST trees. Default is the option of the original run",
+        default=None,
+    )
+
+    args = parser.parse_args()
+    option_overrides = {name: getattr(args, name) for name in RENDER_OPTIONS if getattr(args, name) is not None}
+    if "prune_depth" in option_overrides and option_overrides["prune_depth"] < 0:
+        option_overrides["prune_depth"] = None
+    if "compression" in option_overrides:
+        option_overrides["compression"] = check_compression(option_overrides["compression"])
+
+    redraw_batch(
+        args.out_file,
+        special_masst_prefixes=args.special_massts.split(",") if args.special_massts else None,
+        workers=args.workers,
+        result_store=args.result_store,
+        output_options=OutputOptions(shard_outputs=args.shard_outputs),
+        force=args.force,
+        option_overrides=option_overrides,
+    )
+    sys.exit(0)
@@ -1,10 +1,22 @@
+import os
+from functools import lru_cache
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 
 from masst_utils import SpecialMasst
 from masst_utils import SPECIAL_MASSTS
+from utils import metadata_parquet_file
 from utils import prepare_paths
+from utils import PARQUET_SOURCE_HASH_KEY
 import bundle_to_html
+import compiled_masst
+import compressed_files
+import fingerprints
+from compressed_files import compressed_file_name
+from output_writer import OutputWriter
+from output_writer import write_output
 import json_ontology_extender
 import logging
 import json
@@ -12,6 +24,9 @@ import json
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# the fields of each match that are added to the tree nodes
+MATCH_RECORD_COLUMNS = ["USI", "Cosine", "Matching Peaks", "Delta Mass"]
+
 
 def create_enriched_masst_tree(
     matches_df,
@@ -24,7 +39,24 @@ def create_enriched_masst_tree(
     in_html="../code/collapsible_tree_v3.html",
     format_out_json=False,
     compress_out_html=True,
+    shared_assets=False,
+    prune_depth: int = None,
+    compact_json=False,
+    export_counts=True,
+    output_writer: OutputWriter = None,
+    compression: str | None = None,
+    enrichment=False,
+    matched_sizes=False,
 ):
+    """
+    :param export_counts: write the matches joined with the metadata to the counts file
+    :param output_writer: writes the counts file and report in the background, None writes them directly. The tree
+    json is always written directly as the report reads it
+    :param compression: gzip or zstd compresses the json, counts, and HTML files, None writes plain files
+    :param enrichment: adds the enrichment statistics of the matches to each node of the tree json
+    :param matched_sizes: return the matched_size of each metadata key (as str) of the tree as dict instead of True,
+    e.g., for the co-occurrence of a batch
+    """
     if (matches_df is None) or (len(matches_df) <= 0):
         return False
 
@@ -33,7 +65,7 @@ def create_enriched_masst_tree(
         out_json_tree = "{}_{}.json".format(common_file, special_masst.prefix)
         out_counts_file = "{}_counts_{}.tsv".format(common_file, special_masst.prefix)
         replace_dict = {
-            "PLACEHOLDER_JSON_DATA": out_json_tree,
+            "PLACEHOLDER_JSON_DATA": compressed_file_name(out_json_tree, compression),
             "LIBRARY_JSON_DATA_PLACEHOLDER": lib_match_json,
             "INPUT_LABEL_PLACEHOLDER": input_str,
             "USI_LABEL_PLACEHOLDER": usi if usi else "",
@@ -43,10 +75,17 @@ def create_enriched_masst_tree(
         prepare_paths(files=[out_counts_file, out_html, out_json_tree])
 
         # exports the counts file for all matches
-        results_df = export_metadata_matches(special_masst, matches_df, out_counts_file)
+        results_df = export_metadata_matches(
+            special_masst,
+            matches_df,
+            out_counts_file if export_counts else None,
+            output_writer,
+            compression,
+        )
+        # no match in the metadata, there is no tree to render
         if len(results_df) <= 0:
-            return None
-        
+            return False
+
         results_df = group_matches(special_masst, results_df)
         # adds them to the json ontology
         json_ontology_extender.add_data_to_ontology_file(
@@ -54,11 +93,25 @@ def create_enriched_masst_tree(
             output=out_json_tree,
             meta_matched_df=results_df,
             format_out_json=format_out_json,
+            prune_depth=prune_depth,
+            compact_json=compact_json,
+            compression=compression,
+            add_enrichment=enrichment,
         )
         # bundles the final html
-        return bundle_to_html.build_dist_html(
-            in_html, out_html, replace_dict, compress_out_html
+        result = bundle_to_html.build_dist_html(
+            in_html,
+            out_html,
+            replace_dict,
+            compress_out_html,
+            assets_dir=shared_assets_dir(out_html) if shared_assets else None,
+            output_writer=output_writer,
+            compression=compression,
         )
+        if matched_sizes:
+            key = special_masst.metadata_key
+            return dict(zip(results_df[key].astype(str), results_df["matched_size"].tolist()))
+        return result
     except Exception as e:
         # exit with error
         logger.exception(e)
@@ -76,7 +129,16 @@ def create_combined_masst_tree(
     in_html="../code/collapsible_tree_v3.html",
     format_out_json=False,
     compress_out_html=True,
+    shared_assets=False,
+    compact_json=False,
+    output_writer: OutputWriter = None,
+    compression: str | None = None,
 ):
+    """
+    :param output_writer: writes the report in the background, None writes it directly
+    :param compression: reads the compressed trees of the special MASSTs first and compresses the combined json and
+    HTML, None writes plain files
+    """
     if (matches_df is None) or (len(matches_df) <= 0):
         return False
 
@@ -84,14 +146,13 @@ def create_combined_masst_tree(
     for special_masst in SPECIAL_MASSTS:
         try:
             out_json_tree = "{}_{}.json".format(common_file, special_masst.prefix)
-            with open(out_json_tree) as json_file:
-                # load all trees, add masst_type to identify, rename root
-                treeRoot = json.load(json_file)
-                json_ontology_extender.set_field_in_all_nodes(
-                    treeRoot, "masst_type", special_masst.root
-                )
-                treeRoot["name"] = special_masst.root
-                tree_roots.append(treeRoot)
+            # load all trees, add masst_type to identify, rename root
+            treeRoot = json.loads(compressed_files.read_text(out_json_tree, compression))
+            json_ontology_extender.set_field_in_all_nodes(
+                treeRoot, "masst_type", special_masst.root
+            )
+            treeRoot["name"] = special_masst.root
+            tree_roots.append(treeRoot)
         except:
             pass
 
@@ -103,23 +164,18 @@ def create_combined_masst_tree(
 
     # add values to root
     json_ontology_extender.calc_root_stats(combined_root)
-    json_ontology_extender.add_pie_data_to_node_and_children(combined_root, False)
+    if compact_json:
+        json_ontology_extender.compact_node_fields(combined_root)
+    else:
+        json_ontology_extender.add_pie_data_to_node_and_children(combined_root, False)
 
     try:
         combined_prefix = "combined"
         out_json_tree = "{}_{}.json".format(common_file, combined_prefix)
         prepare_paths(files=[out_json_tree])
 
-        with open(out_json_tree, "w") as file:
-            if format_out_json:
-                out_tree = json.dumps(
-                    combined_root, indent=2, cls=json_ontology_extender.NpEncoder
-                )
-            else:
-                out_tree = json.dumps(
-                    combined_root, cls=json_ontology_extender.NpEncoder
-                )
-            print(out_tree, file=file)
+        out_tree = json_ontology_extender.dumps_tree(combined_root, format_out_json, compact_json)
+        out_json_tree = write_output(out_json_tree, out_tree + "\n", compression=compression)
 
         out_html = "{}_{}.html".format(common_file, combined_prefix)
         replace_dict = {
@@ -132,7 +188,13 @@ def create_combined_masst_tree(
 
         # bundles the final html
         return bundle_to_html.build_dist_html(
-            in_html, out_html, replace_dict, compress_out_html
+            in_html,
+            out_html,
+            replace_dict,
+            compress_out_html,
+            assets_dir=shared_assets_dir(out_html) if shared_assets else None,
+            output_writer=output_writer,
+            compression=compression,
         )
     except Exception as e:
         # exit with error
@@ -141,29 +203,135 @@ def create_combined_masst_tree(
     return None
 
 
-def export_metadata_matches(
-    special_masst: SpecialMasst, matches_df: pd.DataFrame, out_tsv_file
-) -> pd.DataFrame:
-    metadata_file = special_masst.metadata_file
+def shared_assets_dir(out_html) -> Path:
+    """
+    Reports that share their CSS and JS files find them in the assets folder next to them
+    """
+    return Path(out_html).parent / "assets"
+
+
+@lru_cache(maxsize=None)
+def read_metadata(metadata_file) -> pd.DataFrame:
+    """
+    The metadata table of a special MASST, read once per process. Do not modify the returned data frame. Reads the
+    parquet table of prepare_check_metadata instead if it was written from the same csv
+    """
+    if str(metadata_file).endswith(".parquet"):
+        return pd.read_parquet(metadata_file)
+    parquet_file = metadata_parquet_file(metadata_file)
+    if os.path.exists(parquet_file) and parquet_source_hash(parquet_file) == fingerprints.file_hash(metadata_file):
+        return pd.read_parquet(parquet_file)
     if str(metadata_file).endswith(".tsv"):
-        metadata_df = pd.read_csv(metadata_file, sep="\t")
+        return pd.read_csv(metadata_file, sep="\t")
     else:
-        metadata_df = pd.read_csv(metadata_file)
+        return pd.read_csv(metadata_file)
+
+
+def parquet_source_hash(parquet_file) -> str | None:
+    """
+    :return: the sha256 of the csv that the parquet table was written from, None if it is unknown
+    """
+    try:
+        metadata = pq.read_schema(parquet_file).metadata or {}
+    except Exception as e:
+        logger.warning("Cannot read the parquet table %s: %s", parquet_file, e)
+        return None
+    source_hash = metadata.get(PARQUET_SOURCE_HASH_KEY)
+    return source_hash.decode("utf-8") if source_hash is not None else None
 
+
+def metadata_matches(special_masst: SpecialMasst, matches_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    :return: the matches joined with the metadata of the special MASST on the file usi
+    """
+    compiled = compiled_masst.load_compiled(special_masst)
+    if compiled is not None and compiled.file_usis is not None:
+        results_df = indexed_metadata_matches(matches_df, read_metadata(compiled.metadata_table), compiled.file_usis)
+        if results_df is not None:
+            return results_df
+    metadata_df = read_metadata(special_masst.metadata_file)
     # join on the file usi
-    # results_df = matches_df.merge(metadata_df, on="file_usi", how="inner")
-    results_df = pd.merge(matches_df, metadata_df, on="file_usi", how="inner")
+    return pd.merge(matches_df, metadata_df, on="file_usi", how="inner")
+
+
+def indexed_metadata_matches(matches_df: pd.DataFrame, metadata_df: pd.DataFrame, file_usis) -> pd.DataFrame | None:
+    """
+    The inner merge on the file usi as binary search in the sorted file usis of the compiled metadata
+    :param metadata_df: the metadata sorted by the unique file_usi
+    :return: the same rows and columns as the merge, None if other columns than the file_usi overlap
+    """
+    if len(set(matches_df.columns) & set(metadata_df.columns)) != 1:
+        return None
+    keys = np.asarray(matches_df["file_usi"].astype(str).to_numpy(), dtype=str)
+    positions = np.minimum(np.searchsorted(file_usis, keys), max(len(file_usis) - 1, 0))
+    found = (file_usis[positions] == keys) if len(file_usis) > 0 else np.zeros(len(keys), dtype=bool)
+    # like the merge: the rows of each key together in the order of the first occurrence of the keys
+    rows = np.flatnonzero(found)
+    rows = rows[np.argsort(pd.factorize(keys[rows])[0], kind="stable")]
+    return pd.concat(
+        [
+            matches_df.iloc[rows].reset_index(drop=True),
+            metadata_df.iloc[positions[rows]].drop(columns="file_usi").reset_index(drop=True),
+        ],
+        axis=1,
+    )
+
+
+def export_metadata_matches(
+    special_masst: SpecialMasst,
+    matches_df: pd.DataFrame,
+    out_tsv_file=None,
+    output_writer: OutputWriter = None,
+    compression: str | None = None,
+) -> pd.DataFrame:
+    """
+    :param out_tsv_file: the counts file, None does not export
+    :param output_writer: writes the file in the background, None writes it directly
+    :param compression: gzip or zstd compresses the counts file
+    """
+    results_df = metadata_matches(special_masst, matches_df)
 
     # export file with ncbi, matched_size,
-    if len(results_df) > 0:
-        results_df.to_csv(out_tsv_file, index=False, sep="\t")
+    if out_tsv_file is not None and len(results_df) > 0:
+        write_output(out_tsv_file, results_df.to_csv(index=False, sep="\t"), output_writer, compression)
     return results_df
 
 
 def group_matches(special_masst: SpecialMasst, results_df) -> pd.DataFrame:
-    grouped = results_df.groupby(special_masst.metadata_key)
-    results_df = grouped.agg(matched_size=(special_masst.metadata_key, "size"))
-    results_df["matches_json"] = grouped[["USI", "Cosine", "Matching Peaks", "Delta Mass"]].apply(
-        lambda x: x.to_json(orient="records")
+    """
+    Groups the matches by the metadata key in a single pass: one stable sort, then each contiguous run of a key
+    becomes the list of match records of that group. With a compiled special MASST, the matches are grouped by their
+    first tree node from the file_usi to node index and keys that are not in the tree are dropped
+    :return: data frame with the metadata key, matched_size, and the matches as list of dicts, and the position of the
+    first tree node (node) with a compiled special MASST
+    """
+    key = special_masst.metadata_key
+    group_column = key
+    compiled = compiled_masst.load_compiled(special_masst)
+    if compiled is not None and compiled.file_nodes is not None and "file_usi" in results_df.columns:
+        results_df = results_df.assign(node=compiled.file_usi_nodes(results_df["file_usi"]))
+        results_df = results_df[results_df["node"] >= 0]
+        group_column = "node"
+    results_df = results_df[results_df[group_column].notna()].sort_values(group_column, kind="stable")
+    groups = results_df[group_column].to_numpy()
+    if len(groups) == 0:
+        return pd.DataFrame({column: [] for column in dict.fromkeys([key, "matched_size", "matches", group_column])})
+
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    ends = np.r_[starts[1:], len(groups)]
+
+    # same precision as pandas to_json, missing values become null
+    records_df = results_df[MATCH_RECORD_COLUMNS].round(10)
+    records_df = records_df.astype(object).where(records_df.notna(), None)
+    records = records_df.to_dict(orient="records")
+
+    grouped_df = pd.DataFrame(
+        {
+            key: results_df[key].to_numpy()[starts],
+            "matched_size": ends - starts,
+            "matches": [records[start:end] for start, end in zip(starts, ends)],
+        }
     )
-    return results_df.reset_index()
+    if group_column == "node":
+        grouped_df["node"] = groups[starts]
+    return grouped_df
@@ -4,9 +4,10 @@ from datetime import timedelta
 import requests_cache
 from enum import Enum, auto
 import json
+import numpy as np
 import pandas as pd
 from dataclasses import dataclass
-from typing import Optional
+from typing import List, Optional
 
 from pandas import DataFrame
 
@@ -35,6 +36,8 @@ class MasstMatchResults:
     filtered_masst_df: Optional[DataFrame] = None
     unfiltered_masst_df: Optional[DataFrame] = None
     analog_masst_df: Optional[DataFrame] = None
+    # matches, files, and datasets per nominal mass shift of the analog matches
+    delta_mass_histogram_df: Optional[DataFrame] = None
 
 
 MICROBE_MASST = SpecialMasst(
@@ -88,6 +91,10 @@ MICROBIOME_MASST = SpecialMasst(
 
 # URL = "https://fasst.gnps2.org/search" # old API
 HOST = "https://api.fasst.gnps2.org"  # new API
+
+# repeated strings in the match results that are stored as categories
+COMPACT_CATEGORY_COLUMNS = ["Dataset", "Status"]
+
 SPECIAL_MASSTS = [FOOD_MASST, MICROBE_MASST, PLANT_MASST, TISSUE_MASST, PERSONALCAREPRODUCT_MASST, MICROBIOME_MASST]
 
 
@@ -334,26 +341,94 @@ def blocking_for_results(query_parameters_dictionary, host: str = HOST):
 
 
 def filter_matches(df, precursor_mz_tol, min_matched_signals, analog):
+    return df.loc[filter_matches_mask(df, precursor_mz_tol, min_matched_signals, analog)]
+
+
+def filter_matches_mask(df, precursor_mz_tol, min_matched_signals, analog) -> np.ndarray:
+    """
+    :return: boolean array of the matches that pass the filters
+    """
     # DO NOT FILTER BY MZ FOR ANALOG
     if analog:
         if "Matching Peaks" in df.columns:
             # filter by matching peaks
-            return df.loc[df["Matching Peaks"] >= min_matched_signals]
+            return (df["Matching Peaks"] >= min_matched_signals).to_numpy()
         else:
             # no matching peaks column, return all
-            return df
+            return np.ones(len(df), dtype=bool)
     else:
         if "Delta Mass" in df.columns:
-            return df.loc[
-                (
-                    df["Delta Mass"].between(
-                        -precursor_mz_tol, precursor_mz_tol, inclusive="both"
-                    )
+            return (
+                df["Delta Mass"].between(
+                    -precursor_mz_tol, precursor_mz_tol, inclusive="both"
                 )
                 & (df["Matching Peaks"] >= min_matched_signals)
-            ]
+            ).to_numpy()
         else:
-            return df
+            return np.ones(len(df), dtype=bool)
+
+
+def compact_match_dtypes(masst_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Repeated strings become categories and integer counts int32. Changes the data frame in place
+    """
+    for col in COMPACT_CATEGORY_COLUMNS:
+        if col in masst_df.columns and masst_df[col].dtype == object:
+            masst_df[col] = masst_df[col].astype("category")
+    if "Matching Peaks" in masst_df.columns and pd.api.types.is_integer_dtype(
+        masst_df["Matching Peaks"]
+    ):
+        masst_df["Matching Peaks"] = masst_df["Matching Peaks"].astype(np.int32)
+    return masst_df
+
+
+def round_delta_mass(delta_mass: np.ndarray) -> np.ndarray:
+    """
+    Nominal mass shift, rounds half to even like the python round
+    """
+    return np.round(delta_mass, 0)
+
+
+def best_match_mask(keys_df: pd.DataFrame, mask: np.ndarray) -> np.ndarray:
+    """
+    The best match of each key group among the rows of the mask. The rows need to be sorted by score so that the first
+    row of a group is its argmax
+    :param keys_df: the key columns of all rows
+    :return: boolean array of the best rows
+    """
+    # rows outside of the mask form their own groups and never hide a row of the mask
+    return mask & ~keys_df.assign(_in_mask=mask).duplicated().to_numpy()
+
+
+def create_delta_mass_histogram(shifts_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Summarises the nominal mass shifts of analog matches
+    :param shifts_df: one row per match with rounded_delta, file_usi, and Dataset
+    :return: matches, files, and datasets per rounded_delta, most files first
+    """
+    if len(shifts_df) == 0:
+        return pd.DataFrame(columns=["rounded_delta", "matches", "files", "datasets"])
+    histogram_df = (
+        shifts_df.groupby("rounded_delta")
+        .agg(
+            matches=("file_usi", "size"),
+            files=("file_usi", "nunique"),
+            datasets=("Dataset", "nunique"),
+        )
+        .reset_index()
+    )
+    return histogram_df.sort_values(
+        ["files", "matches", "rounded_delta"], ascending=[False, False, True], kind="stable"
+    ).reset_index(drop=True)
+
+
+def top_mass_shifts(histogram_df: pd.DataFrame, n_shifts: int) -> List[float]:
+    """
+    :return: the nominal mass shifts found in most files
+    """
+    if histogram_df is None or n_shifts <= 0:
+        return []
+    return histogram_df["rounded_delta"].head(n_shifts).tolist()
 
 
 def extract_matches_from_masst_results(
@@ -365,14 +440,16 @@ def extract_matches_from_masst_results(
     add_dataset_titles=False,
 ) -> MasstMatchResults:
     """
+    All matches are sorted once by score into one shared frame. The filters, best match per file, and best match per
+    mass shift are combined as boolean masks, the filtered and analog results are each taken once from the frame.
     :param results_dict: masst results
     :param add_dataset_titles: add dataset titles to each row
-    :return: MasstMatchResults of the individual matches
+    :return: MasstMatchResults of the individual matches, all sorted by Cosine and Matching Peaks
     """
     match_results = MasstMatchResults()
 
     masst_df = pd.DataFrame(results_dict["results"])
-    
+
     if masst_df.empty:
         # fastMASST response is sometimes empty
         match_results.unfiltered_masst_df = masst_df
@@ -381,7 +458,7 @@ def extract_matches_from_masst_results(
     # drop unnecessary columns
     columns_to_drop = [
         "Unit Delta Mass",
-        "Query Scan", 
+        "Query Scan",
         "Query Filename",
         "Index UnitPM",
         "Index IdxInUnitPM",
@@ -389,7 +466,7 @@ def extract_matches_from_masst_results(
     ]
     # Only drop columns that actually exist in the DataFrame
     existing_columns_to_drop = [col for col in columns_to_drop if col in masst_df.columns]
-    
+
     if existing_columns_to_drop:
         masst_df.drop(
             columns=existing_columns_to_drop,
@@ -398,21 +475,41 @@ def extract_matches_from_masst_results(
             errors='ignore'
         )
 
-    
-    # empty 
+    # empty
     if len(masst_df) == 0:
         match_results.unfiltered_masst_df = masst_df
         match_results.filtered_masst_df = masst_df
         return match_results
 
+    compact_match_dtypes(masst_df)
+    # the only sort, stable so that ties keep the order of the fastMASST results
     # Unfiltered contains all the MASST match_results
-    unfiltered_masst_df = masst_df.copy()
-    # Filtered contains the matches that are within the precursor mass tolerance
-    filtered_masst_df = filter_matches(masst_df, precursor_mz_tol, min_matched_signals, analog)
-
+    masst_df = masst_df.sort_values(
+        by=["Cosine", "Matching Peaks"], ascending=[False, False], kind="stable"
+    )
     # create an usi column that only points to the dataset:file (not scan)
-    unfiltered_masst_df["file_usi"] = unfiltered_masst_df["USI"].apply(usi_utils.ensure_simple_file_usi)
-    filtered_masst_df["file_usi"] = filtered_masst_df["USI"].apply(usi_utils.ensure_simple_file_usi)
+    masst_df["file_usi"] = usi_utils.file_usi_series(masst_df["USI"])
+
+    # Filtered contains the matches that are within the precursor mass tolerance. The filters are combined as masks
+    # and each result frame is taken once
+    passed = filter_matches_mask(masst_df, precursor_mz_tol, min_matched_signals, analog)
+
+    if analog:
+        # for analog search we keep the best match per file and nominal mass shift
+        rounded_delta = round_delta_mass(masst_df["Delta Mass"].to_numpy())
+        shifts_df = pd.DataFrame(
+            {"file_usi": masst_df["file_usi"].to_numpy(), "rounded_delta": rounded_delta}
+        )
+        best_shift = best_match_mask(shifts_df, passed)
+        analog_masst_df = masst_df[best_shift]
+        analog_masst_df.insert(len(analog_masst_df.columns), "rounded_delta", rounded_delta[best_shift])
+        match_results.analog_masst_df = analog_masst_df
+        shifts_df["Dataset"] = masst_df["Dataset"].to_numpy()
+        match_results.delta_mass_histogram_df = create_delta_mass_histogram(shifts_df[passed])
+
+    if limit_to_best_match_in_file:
+        passed = best_match_mask(masst_df[["file_usi"]], passed)
+    filtered_masst_df = masst_df[passed]
 
     if add_dataset_titles:
         datasets = results_dict["grouped_by_dataset"]
@@ -423,33 +520,19 @@ def extract_matches_from_masst_results(
         for match in filtered_masst_df:
             match["dataset_title"] = dataset_info_dict.get(match["Dataset"], None)
 
-    if analog:
-        # for analog search we drop duplicates based on the rounded delta mass and file_usi
-        analog_masst_df = filtered_masst_df.copy()
-        analog_masst_df['rounded_delta'] = analog_masst_df['Delta Mass'].apply(lambda x: round(x, 0))
-        analog_masst_df = analog_masst_df.sort_values(
-            by=["Cosine", "Matching Peaks"], ascending=[False, False]
-        ).drop_duplicates(subset=['file_usi', 'rounded_delta'])
-        match_results.analog_masst_df = analog_masst_df
-
-    unfiltered_masst_df = unfiltered_masst_df.sort_values(
-        by=["Cosine", "Matching Peaks"], ascending=[False, False])
-
-    if limit_to_best_match_in_file:
-        filtered_masst_df = filtered_masst_df.sort_values(
-            by=["Cosine", "Matching Peaks"], ascending=[False, False]
-        ).drop_duplicates("file_usi")
-
     match_results.filtered_masst_df = filtered_masst_df
-    match_results.unfiltered_masst_df = unfiltered_masst_df
+    match_results.unfiltered_masst_df = masst_df
     return match_results
 
+
 def extract_datasets_from_masst_results(
     results_dict, matches_df: pd.DataFrame
 ) -> pd.DataFrame:
     datasets_df = pd.DataFrame(results_dict["grouped_by_dataset"])
     # recalc frequency with filtered MASST results
-    new_dataset_df = matches_df.groupby("Dataset").size().reset_index(name="Frequency")
+    new_dataset_df = (
+        matches_df.groupby("Dataset", observed=True).size().reset_index(name="Frequency")
+    )
     # transfer dataset title
     new_dataset_df.merge(datasets_df, on="Dataset", how="left")
     return new_dataset_df
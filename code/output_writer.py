@@ -0,0 +1,250 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+
+from compressed_files import compress
+from compressed_files import compressed_file_name
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# marks the end of the queue for a writer thread
+_STOP = object()
+
+
+class OutputWriter:
+    """
+    Writes finished output files from background threads so that the query threads do not wait for the storage.
+    Files are written atomically to a temp file and renamed. Each thread takes up to fsync_batch queued files,
+    writes and renames them, and then syncs their directories once for the whole batch. The queue is bounded,
+    write() blocks when the storage falls behind.
+    """
+
+    def __init__(self, threads: int = 2, max_queue: int = 256, fsync_batch: int = 32, fsync=True, report_seconds=60):
+        """
+        :param threads: number of writer threads
+        :param max_queue: number of files that may wait to be written before write() blocks
+        :param fsync_batch: maximum files that are synced together
+        :param fsync: sync the directories of each batch after the renames. With an ordered journal (the ext4
+        default) this also commits the data of the renamed files
+        :param report_seconds: interval of the throughput log, None to only report on close
+        """
+        self.fsync = fsync
+        self.fsync_batch = max(1, fsync_batch)
+        self.report_seconds = report_seconds
+        self._queue = queue.Queue(max_queue)
+        self._stats_lock = threading.Lock()
+        self._files = 0
+        self._bytes = 0
+        self._blocked_seconds = 0.0
+        # paths that could not be written, raised by flush and close
+        self._failed = []
+        self._start = time.perf_counter()
+        self._last_report = self._start
+        self._threads = [
+            threading.Thread(target=self._run, name="output-writer-{}".format(i), daemon=True)
+            for i in range(threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def write(self, path, data: str | bytes) -> Future:
+        """
+        Queues a file, blocks while the queue is full
+        :param path: the output file, parent directories are created
+        :param data: text is encoded as utf-8
+        :return: future that is done once the file was renamed to its path
+        """
+        future = Future()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        start = time.perf_counter()
+        self._queue.put((str(path), data, future))
+        blocked = time.perf_counter() - start
+        if blocked > 0.001:
+            with self._stats_lock:
+                self._blocked_seconds += blocked
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # each thread takes exactly one stop marker
+            while batch[-1] is not _STOP and len(batch) < self.fsync_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is _STOP
+            items = [item for item in batch if item is not _STOP]
+            if items:
+                self._write_batch(items)
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                return
+
+    def _write_batch(self, items):
+        # the renamed files of each directory
+        directories = {}
+        for path, data, future in items:
+            tmp_file = "{}.{}.tmp".format(path, threading.get_ident())
+            try:
+                Path(path).parent.mkdir(parents=True, exist_ok=True)
+                with open(tmp_file, "wb") as file:
+                    file.write(data)
+                os.replace(tmp_file, path)
+                directories.setdefault(os.path.dirname(os.path.abspath(path)), []).append((path, len(data), future))
+            except Exception as e:
+                try:
+                    os.unlink(tmp_file)
+                except OSError:
+                    pass
+                self._fail(path, future, e)
+
+        # one sync per directory of the batch instead of one per file
+        n_files, n_bytes = 0, 0
+        for directory, files in directories.items():
+            try:
+                if self.fsync:
+                    sync_directory(directory)
+            except Exception as e:
+                for path, _, future in files:
+                    self._fail(path, future, e)
+                continue
+            for path, size, future in files:
+                n_files += 1
+                n_bytes += size
+                future.set_result(path)
+
+        with self._stats_lock:
+            self._files += n_files
+            self._bytes += n_bytes
+            now = time.perf_counter()
+            if self.report_seconds is not None and now - self._last_report >= self.report_seconds:
+                self._last_report = now
+                self._log_throughput(now)
+
+    def _fail(self, path, future: Future, e: Exception):
+        logger.exception(e)
+        with self._stats_lock:
+            self._failed.append(path)
+        future.set_exception(e)
+
+    def _raise_failed(self):
+        with self._stats_lock:
+            failed = list(self._failed)
+        if failed:
+            raise OSError("Failed to write {} output files: {}".format(len(failed), ", ".join(failed[:10])))
+
+    def _log_throughput(self, now):
+        took = max(now - self._start, 1e-9)
+        logger.info(
+            "Wrote %d files, %.1f MB at %.1f MB/s (%.1f files/s), waited %.1f s for the writer queue",
+            self._files,
+            self._bytes / 1e6,
+            self._bytes / 1e6 / took,
+            self._files / took,
+            self._blocked_seconds,
+        )
+
+    def flush(self):
+        """
+        Waits until all queued files are written
+        :raises OSError: if any file could not be written
+        """
+        self._queue.join()
+        self._raise_failed()
+
+    def close(self):
+        """
+        Writes the queued files and stops the threads
+        :raises OSError: if any file could not be written
+        """
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        with self._stats_lock:
+            self._log_throughput(time.perf_counter())
+        self._raise_failed()
+
+    def group(self) -> "OutputGroup":
+        """
+        :return: a writer for the files of one compound that waits for only these files
+        """
+        return OutputGroup(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class OutputGroup:
+    """
+    Queues files on the output writer and keeps their futures, e.g., to mark a compound as done only after all its
+    files were written
+    """
+
+    def __init__(self, output_writer: OutputWriter):
+        self.output_writer = output_writer
+        self._futures = []
+
+    def write(self, path, data: str | bytes) -> Future:
+        future = self.output_writer.write(path, data)
+        self._futures.append(future)
+        return future
+
+    def wait(self):
+        """
+        Waits until the files of this group are written
+        :raises OSError: the error of the first file that could not be written
+        """
+        for future in self._futures:
+            future.result()
+
+
+def sync_directory(directory):
+    """
+    Syncs the entries and, with an ordered journal, the file data of a directory to disk
+    """
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError as e:
+        # e.g., directories cannot be opened on Windows
+        logger.debug("Cannot sync directory %s: %s", directory, e)
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_output(
+    path, data: str | bytes, output_writer: OutputWriter | OutputGroup = None, compression: str | None = None
+) -> str:
+    """
+    Writes the file directly or queues it on the output writer or group
+    :param compression: gzip or zstd adds the suffix .gz or .zst to the path, None writes plain files
+    :return: the path of the written file
+    """
+    if compression is not None:
+        path = compressed_file_name(path, compression)
+        data = compress(data, compression)
+    if output_writer is not None:
+        output_writer.write(path, data)
+        return str(path)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(data, str):
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(data)
+    else:
+        with open(path, "wb") as file:
+            file.write(data)
+    return str(path)
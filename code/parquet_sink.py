@@ -0,0 +1,222 @@
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Set
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# every row of the store is keyed by the compound
+COMPOUND_COLUMN = "Compound"
+# repeated strings that are dictionary encoded in the parquet files
+DICTIONARY_COLUMNS = [COMPOUND_COLUMN, "USI", "Dataset", "file_usi", "Status"]
+# one row per finished compound, marks it as done even without matches
+COMPOUNDS_TABLE = "compounds"
+
+
+class ParquetResultSink:
+    """
+    Appends the per compound tables of a batch to one parquet dataset per table instead of writing small TSV files.
+    Each table is a directory {out_dir}/{table}/ and each flush writes a closed part file so that the store stays
+    readable if a run is killed and resumed runs add to the same dataset. All rows carry the Compound column. Rows are
+    buffered and written in a background thread. Thread safe.
+    """
+
+    def __init__(self, out_dir, row_group_rows: int = 100_000, max_pending_flushes: int = 4):
+        """
+        :param out_dir: the root directory of the store
+        :param row_group_rows: rows buffered per table before they are written as one row group
+        :param max_pending_flushes: appending blocks while this many row groups wait to be written
+        """
+        self.out_dir = Path(out_dir)
+        self.row_group_rows = row_group_rows
+        self._run_id = uuid.uuid4().hex
+        self._parts = 0
+        self._buffers: Dict[str, List[pd.DataFrame]] = {}
+        self._buffered_rows: Dict[str, int] = {}
+        # the schema of the first part of each table, later parts are cast to it
+        self._schemas: Dict[str, pa.Schema] = {}
+        self._lock = threading.Lock()
+        self._pending = threading.BoundedSemaphore(max_pending_flushes)
+        # a single thread keeps the row groups of each table in order
+        self._flush_executor = ThreadPoolExecutor(1)
+        self._flush_futures = []
+
+    def append(self, table: str, compound: str, df: pd.DataFrame):
+        """
+        Adds the rows of one compound to a table
+        :param table: the table name, e.g., matches or counts_food
+        :param compound: the compound name as used in the TSV file names
+        :param df: the rows, the index is dropped
+        """
+        if df is None or len(df) == 0:
+            return
+        df = df.reset_index(drop=True)
+        df.insert(0, COMPOUND_COLUMN, compound)
+        with self._lock:
+            self._buffers.setdefault(table, []).append(df)
+            self._buffered_rows[table] = self._buffered_rows.get(table, 0) + len(df)
+            if self._buffered_rows[table] >= self.row_group_rows:
+                self._submit_flush(table)
+
+    def mark_finished(self, compound: str, n_matches: int):
+        """
+        Marks a compound as done, also when it has no matches
+        """
+        self.append(COMPOUNDS_TABLE, compound, pd.DataFrame({"matches": [n_matches]}))
+
+    def _submit_flush(self, table: str):
+        # called with the lock held
+        frames = self._buffers.pop(table, [])
+        self._buffered_rows[table] = 0
+        if not frames:
+            return
+        self._pending.acquire()
+        self._flush_futures.append(self._flush_executor.submit(self._write_row_group, table, frames))
+
+    def _write_row_group(self, table: str, frames: List[pd.DataFrame]):
+        try:
+            arrow_table = to_arrow_table(pd.concat(frames, ignore_index=True))
+            schema = self._schemas.get(table)
+            if schema is None:
+                self._schemas[table] = arrow_table.schema
+            else:
+                arrow_table = conform_to_schema(arrow_table, schema)
+            table_dir = self.out_dir / table
+            table_dir.mkdir(parents=True, exist_ok=True)
+            self._parts += 1
+            part_name = "part-{}-{:06d}.parquet".format(self._run_id, self._parts)
+            # the readers ignore files with a leading _ until the complete part is renamed
+            tmp_file = table_dir / ("_" + part_name)
+            pq.write_table(
+                arrow_table,
+                tmp_file,
+                use_dictionary=[c for c in DICTIONARY_COLUMNS if c in arrow_table.schema.names],
+            )
+            tmp_file.replace(table_dir / part_name)
+        finally:
+            self._pending.release()
+
+    def flush(self):
+        """
+        Writes all buffered rows and waits for the background writes
+        """
+        with self._lock:
+            for table in list(self._buffers.keys()):
+                self._submit_flush(table)
+            futures, self._flush_futures = self._flush_futures, []
+        for future in futures:
+            # raises errors of the background writes
+            future.result()
+
+    def close(self):
+        self.flush()
+        self._flush_executor.shutdown()
+        logger.info("Closed parquet result store %s", self.out_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def to_arrow_table(df: pd.DataFrame) -> pa.Table:
+    """
+    :return: arrow table with the repeated string columns as dictionaries
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for i, name in enumerate(table.schema.names):
+        field_type = table.schema.field(name).type
+        if name in DICTIONARY_COLUMNS and pa.types.is_dictionary(field_type):
+            # categories from pandas, unify the index type
+            table = table.set_column(i, name, table.column(name).cast(pa.dictionary(pa.int32(), pa.string())))
+        elif name in DICTIONARY_COLUMNS and (pa.types.is_string(field_type) or pa.types.is_null(field_type)):
+            table = table.set_column(
+                i, name, table.column(name).cast(pa.string()).dictionary_encode()
+            )
+        elif pa.types.is_null(field_type):
+            # all missing in the first rows, later rows may have values
+            table = table.set_column(i, name, table.column(name).cast(pa.string()))
+    return table
+
+
+def conform_to_schema(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """
+    Casts the table to the schema of the first row group, missing columns become null and new columns are dropped
+    """
+    columns = []
+    for field in schema:
+        if field.name in table.schema.names:
+            columns.append(table.column(field.name).cast(field.type))
+        else:
+            columns.append(pa.nulls(len(table), field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def table_dataset(out_dir, table: str) -> ds.Dataset | None:
+    """
+    The readable part files of a table. Parts without footer, e.g., of a run that was killed while the parts were
+    kept open, are renamed with the prefix _unreadable- so that the store can be resumed
+    :return: the dataset or None if the table has no readable parts
+    """
+    table_dir = Path(out_dir) / table
+    if not table_dir.is_dir():
+        return None
+    files = []
+    for file in sorted(table_dir.glob("*.parquet")):
+        if file.name.startswith(("_", ".")):
+            continue
+        try:
+            pq.read_metadata(file)
+            files.append(str(file))
+        except (pa.ArrowInvalid, OSError) as e:
+            logger.warning("Moving unreadable part %s aside: %s", file, e)
+            file.replace(file.with_name("_unreadable-" + file.name))
+    if len(files) == 0:
+        return None
+    return ds.dataset(files, format="parquet")
+
+
+def read_table(out_dir, table: str, compounds: List[str] = None, columns: List[str] = None) -> pd.DataFrame:
+    """
+    Reads a table of the store
+    :param compounds: only rows of these compounds, None reads all
+    :param columns: only these columns, None reads all
+    """
+    dataset = table_dataset(out_dir, table)
+    if dataset is None:
+        return pd.DataFrame()
+    filter_expression = None
+    if compounds is not None:
+        filter_expression = ds.field(COMPOUND_COLUMN).isin(list(compounds))
+    return dataset.to_table(columns=columns, filter=filter_expression).to_pandas()
+
+
+def iter_table_batches(out_dir, table: str, columns: List[str] = None, batch_rows=100_000):
+    """
+    Streams a table of the store in record batches
+    :return: iterator of data frames
+    """
+    dataset = table_dataset(out_dir, table)
+    if dataset is None:
+        return
+    for batch in dataset.to_batches(columns=columns, batch_size=batch_rows):
+        yield batch.to_pandas()
+
+
+def finished_compounds(out_dir) -> Set[str]:
+    """
+    :return: all compounds that were marked as finished in the store
+    """
+    df = read_table(out_dir, COMPOUNDS_TABLE, columns=[COMPOUND_COLUMN])
+    if len(df) == 0:
+        return set()
+    return set(df[COMPOUND_COLUMN].astype(str))
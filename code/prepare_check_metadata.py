@@ -1,50 +1,137 @@
 import sys
 import argparse
 import logging
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import fingerprints
 from usi_utils import create_file_usi_column
+from utils import metadata_parquet_file
+from utils import PARQUET_SOURCE_HASH_KEY
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+CHUNK_ROWS = 100_000
 
-def prepare_check_metadata_file(metadata_file, output_file):
-    if metadata_file.endswith(".tsv"):
-        df = pd.read_csv(metadata_file, sep="\t")
-    else:
-        df = pd.read_csv(metadata_file, sep=",")
 
-    # remove white space around values in columns
-    df = df.applymap(lambda x: x.strip() if isinstance(x, str) else x)
+def prepare_check_metadata_file(
+    metadata_file,
+    output_file,
+    parquet_file=None,
+    duplicates_file="../data/duplicates.csv",
+    chunk_rows=CHUNK_ROWS,
+):
+    """
+    Strips the values, adds the file_usi, and removes duplicated files of a metadata table. The table is read and
+    prepared in chunks, duplicates are found by the hash of the file_usi and only the duplicated rows are sorted to
+    choose the row that is kept
 
-    if "file_usi" not in df.columns:
-        create_file_usi_column(df)
+    :param output_file: the prepared table as csv or tsv, sorted by file_usi
+    :param parquet_file: also writes the validated table as parquet for the runtime loaders, see
+    masst_tree.read_metadata. None writes it next to the output_file. It records the hash of the output_file, the
+    loaders only read it while the output_file is unchanged
+    :param duplicates_file: all rows of duplicated files
+    :param chunk_rows: rows per chunk
+    """
+    sep = "\t" if metadata_file.endswith(".tsv") else ","
+    chunks = [
+        prepare_metadata_chunk(chunk) for chunk in pd.read_csv(metadata_file, sep=sep, chunksize=chunk_rows)
+    ]
+    df = concat_chunks(chunks)
+    del chunks
 
     # check uniqueness of files
     logger.info("Checking duplicated usi")
+    usi_hashes = pd.util.hash_array(df["file_usi"].to_numpy(dtype=object))
+    duplicated = pd.Series(usi_hashes).duplicated(keep=False).to_numpy()
     # microbe masst specific
-    duplicates = df[df.duplicated(subset=["file_usi"], keep=False)].sort_values(
-        by=["file_usi"],
-        ascending=[True],
-    )
-    duplicates = sort_metadata_rows(duplicates)
+    duplicates = sort_metadata_rows(df[duplicated])
 
     try:
         if len(duplicates) > 0:
             logger.info(duplicates)
-            duplicates.to_csv("../data/duplicates.csv", index=False)
+            duplicates.to_csv(duplicates_file, index=False)
         else:
             logger.info("NO DUPLICATES")
     except:
         logger.warning("Cannot export duplicates file")
 
-    df = sort_metadata_rows(df).drop_duplicates(["file_usi"])
+    # the first of the sorted duplicates is kept
+    removed = duplicates.index[duplicates["file_usi"].duplicated()]
+    df = df.drop(index=removed).sort_values(by=["file_usi"], kind="stable")
+    validate_metadata(df)
 
     # export final table
     if output_file.endswith(".tsv"):
         df.to_csv(output_file, index=False, sep="\t")
     else:
         df.to_csv(output_file, index=False)
+    if parquet_file is None:
+        parquet_file = metadata_parquet_file(output_file)
+    write_metadata_parquet(df, parquet_file, fingerprints.file_hash(output_file))
+    logger.info("Prepared %d files, removed %d duplicates", len(df), len(removed))
+    return df
+
+
+def write_metadata_parquet(df: pd.DataFrame, parquet_file, source_hash: str):
+    """
+    :param source_hash: sha256 of the csv of the same table, stored in the parquet metadata
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = {**(table.schema.metadata or {}), PARQUET_SOURCE_HASH_KEY: source_hash.encode("utf-8")}
+    pq.write_table(table.replace_schema_metadata(metadata), parquet_file)
+
+
+def prepare_metadata_chunk(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Removes white space around the values of the string columns and adds the file_usi
+    """
+    for column in df.columns[df.dtypes == object]:
+        # metadata values repeat, only the distinct values are stripped
+        codes, uniques = pd.factorize(df[column])
+        uniques = pd.Series(uniques, dtype=object)
+        stripped = uniques.str.strip()
+        if pd.api.types.infer_dtype(uniques, skipna=True) != "string":
+            # other values than strings stay as they are
+            stripped = stripped.where(uniques.map(type) == str, uniques)
+        # missing values have code -1
+        df[column] = pd.Series(np.append(stripped.to_numpy(dtype=object), np.nan)[codes], index=df.index)
+
+    if "file_usi" not in df.columns:
+        create_file_usi_column(df)
+    return df
+
+
+def concat_chunks(chunks: list) -> pd.DataFrame:
+    """
+    The types of each chunk are inferred on their own. Columns that are numeric in some chunks and strings in others
+    become strings in all chunks like in a table read at once
+    """
+    if len(chunks) == 0:
+        return pd.DataFrame({"file_usi": []})
+    for column in chunks[0].columns:
+        dtypes = {chunk[column].dtype for chunk in chunks}
+        if len(dtypes) > 1 and not all(pd.api.types.is_numeric_dtype(dtype) for dtype in dtypes):
+            for chunk in chunks:
+                values = chunk[column]
+                chunk[column] = values.astype(object).where(values.isna(), values.astype(str))
+    return pd.concat(chunks, ignore_index=True)
+
+
+def validate_metadata(df: pd.DataFrame):
+    """
+    :raises ValueError: if the file_usi is missing, not unique, or not a file usi
+    """
+    file_usis = df["file_usi"]
+    if file_usis.isna().any():
+        raise ValueError("{} rows have no file_usi".format(file_usis.isna().sum()))
+    if not file_usis.is_unique:
+        raise ValueError("The file_usi is not unique")
+    invalid = ~file_usis.astype(str).str.match(r"^mzspec:[^:]+:[^:]+$")
+    if invalid.any():
+        raise ValueError("Invalid file_usi, e.g., {}".format(file_usis[invalid].iloc[0]))
 
 
 def sort_metadata_rows(df):
@@ -95,10 +182,15 @@ if __name__ == "__main__":
     #                    default="../data/personalCareProduct_masst_table.csv")
     #parser.add_argument("--output_file", type=str, help="output masst metadata",
     #                    default="../data/personalCareProduct_masst_table2.csv")
+    parser.add_argument("--parquet_file", type=str, help="validated parquet table for the runtime loaders. "
+                        "Default writes it next to the output file", default=None)
+    parser.add_argument("--chunk_rows", type=int, help="rows per chunk", default=CHUNK_ROWS)
     args = parser.parse_args()
 
     try:
-        prepare_check_metadata_file(args.metadata_file, args.output_file)
+        prepare_check_metadata_file(
+            args.metadata_file, args.output_file, args.parquet_file, chunk_rows=args.chunk_rows
+        )
     except Exception as e:
         # exit with error
         logger.exception(e)
@@ -3,7 +3,12 @@ import argparse
 import logging
 import pandas as pd
 import json
+import time
 import numpy as np
+from distutils.util import strtobool
+
+import compiled_masst
+from masst_utils import SPECIAL_MASSTS
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -21,52 +26,121 @@ class NpEncoder(json.JSONEncoder):
             return super(NpEncoder, self).default(obj)
 
 
-def update_group_size(node, metadata_df, node_key="NCBI", data_key="Taxa_NCBI"):
-    group_size = (metadata_df[data_key].values == node[node_key]).sum()
-    # apply to all children
-    if "children" in node:
-        for child in node["children"]:
-            group_size += update_group_size(child, metadata_df, node_key, data_key)
-    node["group_size"] = group_size
-    return group_size
+def update_group_size(node, metadata_df, node_key="NCBI", data_key="Taxa_NCBI", id_counts: dict = None):
+    """
+    Sets the group_size of all nodes to the metadata rows of their id and of all their descendants in one post-order
+    pass. Nodes that occur multiple times in the tree count the rows of their id at each occurrence
+    :param id_counts: number of metadata rows of each id as string, None counts them once in metadata_df
+    :return: the group_size of the node
+    """
+    if id_counts is None:
+        id_counts = metadata_df[data_key].astype(str).value_counts().to_dict()
+    stack = [(node, False)]
+    while stack:
+        current, children_done = stack.pop()
+        children = current.get("children", [])
+        if children_done:
+            current["group_size"] = id_counts.get(str(current[node_key]), 0) + sum(
+                child["group_size"] for child in children
+            )
+        else:
+            stack.append((current, True))
+            stack.extend((child, False) for child in children)
+    return node["group_size"]
 
 
 def get_all_ids(ncbi_ids, node, node_key="NCBI"):
-    ncbi_ids.append(node[node_key])
-    # apply to all children
-    if "children" in node:
-        for child in node["children"]:
-            get_all_ids(ncbi_ids, child, node_key)
+    """
+    Appends the ids of all nodes in pre-order
+    """
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        ncbi_ids.append(current[node_key])
+        stack.extend(reversed(current.get("children", [])))
     return ncbi_ids
 
 
+def not_in_tree_report(metadata_df, tree_ids, data_key="Taxa_NCBI") -> pd.DataFrame:
+    """
+    :param tree_ids: ids of all tree nodes as strings
+    :return: the metadata rows whose id is not in the tree
+    """
+    not_in_tree_df = metadata_df[~metadata_df[data_key].isin(tree_ids)]
+    if len(not_in_tree_df) > 0:
+        id_counts = not_in_tree_df[data_key].value_counts(dropna=False)
+        logger.warning(
+            "%d metadata rows of %d ids are not in the tree, most rows: %s",
+            len(not_in_tree_df),
+            len(id_counts),
+            ", ".join("{} ({})".format(key, n) for key, n in id_counts.head(10).items()),
+        )
+    return not_in_tree_df
+
+
 def update_metadata_on_tree(
     in_ontology="../data/microbe_masst_tree.json",
     metadata_file="../data/microbe_masst_table.csv",
     node_key="NCBI",
     data_key="Taxa_NCBI",
+    not_in_tree_file="../data/not_in_tree.csv",
 ):
+    """
+    Updates the group_size of all tree nodes from the metadata table and writes the tree back to in_ontology
+    :param not_in_tree_file: the metadata rows whose id is not in the tree
+    """
     try:
+        start = time.perf_counter()
         with open(in_ontology) as json_file:
             treeRoot = json.load(json_file)
-            df = pd.read_csv(metadata_file, sep=",")
-            # ensure that the grouping columns are strings as we usually match string ids
-            df[data_key] = df[data_key].astype(str)
+        # ids are matched as strings
+        df = pd.read_csv(metadata_file, sep=",", dtype={data_key: str})
+        read_time = time.perf_counter()
+
+        id_counts = df[data_key].value_counts().to_dict()
+        update_group_size(treeRoot, df, node_key, data_key, id_counts)
+        ids = {str(node_id) for node_id in get_all_ids(list(), treeRoot, node_key)}
+        group_size_time = time.perf_counter()
 
-            update_group_size(treeRoot, df, node_key, data_key)
-            ids = get_all_ids(list(), treeRoot, node_key)
-            not_in_tree_df = df[~df[data_key].isin(ids)]
-            not_in_tree_df.to_csv("../data/not_in_tree.csv", index=False)
+        not_in_tree_report(df, ids, data_key).to_csv(not_in_tree_file, index=False)
 
         with open(in_ontology, "w") as file:
             out_tree = json.dumps(treeRoot, indent=2, cls=NpEncoder)
             print(out_tree, file=file)
+        logger.info(
+            "Updated %d tree nodes from %d metadata rows: read %.2f s, group sizes %.2f s, write %.2f s",
+            len(ids),
+            len(df),
+            read_time - start,
+            group_size_time - read_time,
+            time.perf_counter() - group_size_time,
+        )
         return True
     except Exception as e:
         logger.exception(e)
         return False
 
 
+def compile_special_massts(special_massts=None, out_dir=compiled_masst.COMPILED_DIR) -> list:
+    """
+    Compiles the tree and metadata of each special MASST into binary artefacts for a fast start of the runtime, see
+    compiled_masst. Run after each update of a tree or metadata table, stale artefacts are ignored
+    :param special_massts: None compiles all special MASSTs with a tree file
+    :return: the directories of the artefacts
+    """
+    if special_massts is None:
+        special_massts = SPECIAL_MASSTS
+    directories = []
+    for special_masst in special_massts:
+        start = time.perf_counter()
+        try:
+            directories.append(compiled_masst.compile_special_masst(special_masst, out_dir))
+            logger.info("Compiled %s in %.2f s", special_masst.prefix, time.perf_counter() - start)
+        except FileNotFoundError as e:
+            logger.warning("Cannot compile %s: %s", special_masst.prefix, e)
+    return directories
+
+
 if __name__ == "__main__":
     # parsing the arguments (all optional)
     parser = argparse.ArgumentParser(
@@ -114,14 +188,24 @@ if __name__ == "__main__":
     parser.add_argument('--data_key', type=str,
                         help='the field in the data file to be compared to the field in the ontology',
                         default="ID")
+    parser.add_argument('--compile', type=lambda x: bool(strtobool(str(x.strip()))),
+                        help='compile all special MASSTs to binary artefacts instead of updating a tree',
+                        default=False)
+    parser.add_argument('--compiled_dir', type=str, help='output directory of the compiled artefacts',
+                        default=compiled_masst.COMPILED_DIR)
+    parser.add_argument('--not_in_tree', type=str, help='output file of the metadata rows whose id is not in the tree',
+                        default="../data/not_in_tree.csv")
 
 
     args = parser.parse_args()
 
     try:
-        update_metadata_on_tree(
-            args.ontology, args.metadata_file, args.node_key, args.data_key
-        )
+        if args.compile:
+            compile_special_massts(out_dir=args.compiled_dir)
+        else:
+            update_metadata_on_tree(
+                args.ontology, args.metadata_file, args.node_key, args.data_key, args.not_in_tree
+            )
     except Exception as e:
         # exit with error
         logger.exception(e)
@@ -0,0 +1,5 @@
+const root = PLACEHOLDER_JSON_DATA;
+var library_data = LIBRARY_JSON_DATA_PLACEHOLDER;
+var inputLabel = "INPUT_LABEL_PLACEHOLDER";
+var inputUsi = "USI_LABEL_PLACEHOLDER";
+var paramsLabel = "PARAMS_PLACEHOLDER";
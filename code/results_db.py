@@ -0,0 +1,269 @@
+import argparse
+import logging
+import sqlite3
+import sys
+import threading
+from contextlib import closing
+from functools import lru_cache
+from distutils.util import strtobool
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from cooccurrence import read_tree_rollup
+from cooccurrence import tree_rollup
+from masst_utils import SpecialMasst
+from masst_utils import SPECIAL_MASSTS
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS compounds (
+    compound_id INTEGER PRIMARY KEY,
+    compound TEXT NOT NULL UNIQUE,
+    matches INTEGER
+);
+CREATE TABLE IF NOT EXISTS hits (
+    compound_id INTEGER NOT NULL REFERENCES compounds(compound_id),
+    special_masst TEXT NOT NULL,
+    node_id TEXT NOT NULL,
+    file_usi TEXT NOT NULL,
+    dataset TEXT,
+    usi TEXT,
+    cosine REAL,
+    matching_peaks INTEGER,
+    analog INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS hits_node ON hits (special_masst, node_id);
+CREATE INDEX IF NOT EXISTS hits_dataset ON hits (dataset);
+CREATE INDEX IF NOT EXISTS hits_compound ON hits (compound_id, special_masst);
+CREATE TABLE IF NOT EXISTS node_ancestors (
+    special_masst TEXT NOT NULL,
+    node_id TEXT NOT NULL,
+    ancestor_id TEXT NOT NULL,
+    PRIMARY KEY (special_masst, ancestor_id, node_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS node_ancestors_node ON node_ancestors (special_masst, node_id);
+"""
+
+
+class ResultsIndex:
+    """
+    Local SQLite database of all matches of a batch that fall into a special MASST node: compound × file_usi × node
+    with cosine and matching peaks. Indexed on node, dataset, and compound for reverse lookups across batches.
+    The ancestors of each hit node, including itself, are stored once so that a lookup of an internal node finds the
+    matches in its subtree. Thread safe, each compound is written in one transaction.
+    """
+
+    def __init__(self, db_file):
+        Path(db_file).parent.mkdir(parents=True, exist_ok=True)
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_file, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        # per special MASST: the node ids with ancestors in the database
+        self._ancestor_nodes = {}
+        self._add_missing_ancestors()
+
+    def _add_missing_ancestors(self):
+        """
+        Adds the ancestors of hits in databases from before the ancestors were stored
+        """
+        missing_df = pd.read_sql_query(
+            "SELECT DISTINCT h.special_masst, h.node_id FROM hits h LEFT JOIN node_ancestors a "
+            "ON a.special_masst = h.special_masst AND a.node_id = h.node_id WHERE a.node_id IS NULL",
+            self._connection,
+        )
+        ancestor_rows = []
+        for special_masst in SPECIAL_MASSTS:
+            node_ids = missing_df["node_id"][missing_df["special_masst"] == special_masst.prefix]
+            if len(node_ids) > 0:
+                ancestor_rows.extend(self._new_ancestor_rows(special_masst, node_ids))
+        if ancestor_rows:
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT OR IGNORE INTO node_ancestors (special_masst, node_id, ancestor_id) VALUES (?, ?, ?)",
+                    ancestor_rows,
+                )
+            logger.info("Added the ancestors of %d hit nodes", len(set(row[:2] for row in ancestor_rows)))
+
+    def add_compound(
+        self,
+        compound: str,
+        n_matches: int,
+        special_masst_hits: list[tuple[SpecialMasst, pd.DataFrame]] = (),
+        analog=False,
+    ):
+        """
+        Replaces all hits of a compound
+        :param compound: the compound name as used in the file names
+        :param n_matches: number of filtered matches
+        :param special_masst_hits: the matches joined with the metadata of each special MASST
+        :param analog: the hits are analog matches
+        """
+        rows = []
+        ancestor_rows = []
+        for special_masst, hits_df in special_masst_hits:
+            if hits_df is None or len(hits_df) == 0:
+                continue
+            hits_df = hits_df[hits_df[special_masst.metadata_key].notna()]
+            ancestor_rows.extend(self._new_ancestor_rows(special_masst, hits_df[special_masst.metadata_key]))
+            rows.extend(
+                zip(
+                    [special_masst.prefix] * len(hits_df),
+                    hits_df[special_masst.metadata_key].astype(str),
+                    hits_df["file_usi"],
+                    hits_df["Dataset"].astype(object) if "Dataset" in hits_df else [None] * len(hits_df),
+                    hits_df["USI"],
+                    hits_df["Cosine"].astype(float),
+                    hits_df["Matching Peaks"].astype(int),
+                )
+            )
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO compounds (compound, matches) VALUES (?, ?) "
+                "ON CONFLICT(compound) DO UPDATE SET matches = excluded.matches",
+                (compound, n_matches),
+            )
+            compound_id = self._connection.execute(
+                "SELECT compound_id FROM compounds WHERE compound = ?", (compound,)
+            ).fetchone()[0]
+            self._connection.execute(
+                "DELETE FROM hits WHERE compound_id = ? AND analog = ?", (compound_id, int(analog))
+            )
+            self._connection.executemany(
+                "INSERT INTO hits (compound_id, special_masst, node_id, file_usi, dataset, usi, cosine, "
+                "matching_peaks, analog) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(compound_id, *row, int(analog)) for row in rows],
+            )
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO node_ancestors (special_masst, node_id, ancestor_id) VALUES (?, ?, ?)",
+                ancestor_rows,
+            )
+            for prefix, node_id, _ in ancestor_rows:
+                self._ancestor_nodes.setdefault(prefix, set()).add(node_id)
+
+    def _new_ancestor_rows(self, special_masst: SpecialMasst, node_ids: pd.Series) -> list:
+        """
+        :return: special_masst, node_id, and ancestor_id of the node ids that have no ancestors in the database yet.
+        Node ids that are not in the tree are their own ancestor
+        """
+        with self._lock:
+            known = self._ancestor_nodes.get(special_masst.prefix, set())
+            new_ids = [node_id for node_id in node_ids.astype(str).unique() if node_id not in known]
+        if not new_ids:
+            return []
+        rollup = tree_rollup(special_masst)
+        ancestors = tree_ancestors(special_masst)
+        rows = []
+        for node_id in new_ids:
+            position = rollup.positions.get(node_id)
+            if position is None:
+                rows.append((special_masst.prefix, node_id, node_id))
+                continue
+            ancestor_positions = ancestors.indices[ancestors.indptr[position]: ancestors.indptr[position + 1]]
+            rows.extend(
+                (special_masst.prefix, node_id, rollup.node_ids[ancestor]) for ancestor in np.sort(ancestor_positions)
+            )
+        return rows
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def tree_ancestors(special_masst: SpecialMasst):
+    """
+    :return: sparse ancestor × node matrix of the tree in compressed columns, all occurrences of a node id roll up to
+    the ancestors of each occurrence
+    """
+    return read_tree_ancestors(special_masst.tree_file, special_masst.tree_node_key)
+
+
+@lru_cache(maxsize=None)
+def read_tree_ancestors(tree_file, tree_node_key):
+    return read_tree_rollup(tree_file, tree_node_key).descendants.tocsc()
+
+
+def query_compounds(
+    db_file,
+    node_id: str = None,
+    special_masst: str = None,
+    dataset: str = None,
+    compound: str = None,
+    min_cosine: float = 0,
+    analog=False,
+) -> pd.DataFrame:
+    """
+    Summarises the hits that match all given filters per compound and node
+    :param node_id: the node id in the special MASST tree, e.g., the NCBI taxon id. Includes the hits of all nodes in
+    its subtree
+    :param special_masst: the special MASST prefix, e.g., microbe
+    :param dataset: the MassIVE dataset
+    :param compound: the compound name
+    :return: compound, special_masst, node_id, files, datasets, and max_cosine
+    """
+    conditions = ["h.analog = ?", "h.cosine >= ?"]
+    params = [int(analog), min_cosine]
+    node_column = "h.node_id"
+    join = ""
+    if node_id is not None:
+        # hits of the node and its descendants
+        node_column = "a.ancestor_id"
+        join = "JOIN node_ancestors a ON a.special_masst = h.special_masst AND a.node_id = h.node_id "
+    for column, value in [
+        (node_column, node_id),
+        ("h.special_masst", special_masst),
+        ("h.dataset", dataset),
+        ("c.compound", compound),
+    ]:
+        if value is not None:
+            conditions.append("{} = ?".format(column))
+            params.append(str(value))
+
+    sql = (
+        "SELECT c.compound, h.special_masst, {node} AS node_id, COUNT(DISTINCT h.file_usi) AS files, "
+        "COUNT(DISTINCT h.dataset) AS datasets, MAX(h.cosine) AS max_cosine "
+        "FROM hits h JOIN compounds c ON c.compound_id = h.compound_id {join}"
+        "WHERE {conditions} GROUP BY c.compound, h.special_masst, {node} "
+        "ORDER BY files DESC, c.compound".format(node=node_column, join=join, conditions=" AND ".join(conditions))
+    )
+    with closing(sqlite3.connect(db_file)) as connection:
+        return pd.read_sql_query(sql, connection, params=params)
+
+
+if __name__ == "__main__":
+    # parsing the input arguments for the query
+    parser = argparse.ArgumentParser(description="Query the results database of MASST batches")
+    parser.add_argument("--db", type=str, help="the results database file", required=True)
+    parser.add_argument("--node_id", type=str, help="node id in a special MASST tree, e.g., NCBI taxon id", default=None)
+    parser.add_argument("--special_masst", type=str, help="special MASST prefix, e.g., microbe", default=None)
+    parser.add_argument("--dataset", type=str, help="MassIVE dataset, e.g., MSV000084900", default=None)
+    parser.add_argument("--compound", type=str, help="compound name", default=None)
+    parser.add_argument("--min_cos", type=float, help="minimum cosine", default=0)
+    parser.add_argument("--analog", type=lambda x: bool(strtobool(str(x.strip()))), help="query analog hits", default=False)
+    parser.add_argument("--out_file", type=str, help="output tsv file, default prints to stdout", default=None)
+
+    args = parser.parse_args()
+
+    result_df = query_compounds(
+        args.db,
+        node_id=args.node_id,
+        special_masst=args.special_masst,
+        dataset=args.dataset,
+        compound=args.compound,
+        min_cosine=args.min_cos,
+        analog=args.analog,
+    )
+    result_df.to_csv(args.out_file if args.out_file else sys.stdout, sep="\t", index=False)
@@ -0,0 +1,101 @@
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+def children_index(parent_keys) -> dict:
+    """
+    Indexes an edge or node table once instead of filtering it for the children of each node
+    :param parent_keys: the parent key of each row, missing values have no parent
+    :return: dict of parent key and the row positions of its children in table order
+    """
+    parent_keys = pd.Series(np.asarray(parent_keys, dtype=object))
+    return {
+        key: rows.tolist()
+        for key, rows in pd.Series(np.arange(len(parent_keys))).groupby(parent_keys, sort=False).indices.items()
+    }
+
+
+def group_sizes(keys, child_keys, children: dict, counts: dict, include_internal_counts=True) -> dict:
+    """
+    Sums the counts of each node and its subtree in one post-order pass. Subtrees that occur multiple times are summed
+    once
+    :param keys: the nodes to compute, e.g., all node ids
+    :param child_keys: the key of each row of the children index
+    :param children: see children_index
+    :param counts: e.g., the number of files of each node key
+    :param include_internal_counts: False only counts the leaves, nodes with children are the sum of their children
+    :return: dict of node key and group size
+    """
+    sizes = {}
+    for key in keys:
+        if key in sizes:
+            continue
+        stack = [(key, False)]
+        on_path = set()
+        while stack:
+            current, children_done = stack.pop()
+            rows = children.get(current, [])
+            if children_done:
+                on_path.discard(current)
+                size = sum(sizes[child_keys[row]] for row in rows)
+                if include_internal_counts or not rows:
+                    size += counts.get(current, 0)
+                sizes[current] = size
+            elif current not in sizes:
+                if current in on_path:
+                    raise ValueError("The tree has a cycle at node {}".format(current))
+                on_path.add(current)
+                stack.append((current, True))
+                stack.extend((child_keys[row], False) for row in rows if child_keys[row] not in sizes)
+    return sizes
+
+
+def tree_node(node_id, name, group_size, duplication="Y", node_type="node", **fields) -> dict:
+    """
+    :param fields: additional node fields, e.g., NCBI. They follow the id like in the special MASST trees
+    :return: a node of the special MASST tree json without children
+    """
+    return {
+        "ID": node_id,
+        **fields,
+        "duplication": duplication,
+        "type": node_type,
+        "name": name,
+        "group_size": int(group_size),
+    }
+
+
+def build_tree(root: dict, root_key, child_keys, children: dict, create_node) -> dict:
+    """
+    Adds the children to all nodes from the root in table order. Nodes that are children of multiple parents are
+    created below each parent
+    :param root: the root node without children
+    :param child_keys: the key of each row of the children index
+    :param children: see children_index
+    :param create_node: function of the row and the parent node that returns a node without children
+    :return: the root
+    """
+    root["children"] = []
+    stack = [(root, root_key, 0)]
+    while stack:
+        node, key, depth = stack.pop()
+        # deeper than all rows is only possible with a cycle
+        if depth > len(child_keys):
+            raise ValueError("The tree has a cycle at node {}".format(key))
+        for row in children.get(key, []):
+            child = create_node(row, node)
+            child["children"] = []
+            node["children"].append(child)
+            stack.append((child, child_keys[row], depth + 1))
+    return root
+
+
+def write_tree_json(tree: dict, out_file, indent=4):
+    with open(out_file, "w") as file:
+        json.dump(tree, file, indent=indent)
@@ -1,9 +1,21 @@
 import json
+import threading
 from pathlib import Path
+import pandas as pd
 import requests
 
 USI_URL = "https://metabolomics-usi.gnps2.org/json/"
 
+# everything from the last :scan on
+SCAN_SUFFIX_PATTERN = r":scan(?:(?!:scan).)*$"
+# the dataset is the second element of the usi
+DATASET_PATTERN = r"^[^:]*:([^:]*)"
+
+# file_usi by usi without scan, shared by all calls of file_usi_series
+_file_usi_cache = {}
+_file_usi_cache_lock = threading.Lock()
+MAX_FILE_USI_CACHE_SIZE = 1_000_000
+
 
 def create_simple_file_usi(filename, dataset):
     filename = Path(filename).stem
@@ -26,20 +38,81 @@ def ensure_simple_file_usi(usi):
     return "mzspec:{}:{}".format(elements[1], filename)
 
 
+def file_usi_series(usis: pd.Series) -> pd.Series:
+    """
+    Vectorized ensure_simple_file_usi for a whole column. Each distinct dataset:file is only parsed once and the
+    results are cached for repeated files across calls.
+    :param usis: series of USIs with or without scan
+    :return: series of file usis mzspec:dataset:filename with the same index
+    """
+    without_scan = usis.astype(str).str.replace(SCAN_SUFFIX_PATTERN, "", regex=True)
+    codes, uniques = pd.factorize(without_scan)
+    uniques = pd.Series(uniques, dtype=object)
+
+    # only looks up the distinct files of this call, the cost does not grow with the cache
+    with _file_usi_cache_lock:
+        cached = [_file_usi_cache.get(usi) for usi in uniques.to_numpy()]
+    file_usis = pd.Series(cached, dtype=object)
+    missing = file_usis.isna()
+    if missing.any():
+        parsed = _parse_file_usis(uniques[missing])
+        file_usis[missing] = parsed
+        with _file_usi_cache_lock:
+            if len(_file_usi_cache) + len(parsed) > MAX_FILE_USI_CACHE_SIZE:
+                _file_usi_cache.clear()
+            _file_usi_cache.update(zip(uniques[missing], parsed))
+
+    return pd.Series(file_usis.to_numpy()[codes], index=usis.index, dtype=object)
+
+
+def _parse_file_usis(usis_without_scan: pd.Series) -> pd.Series:
+    datasets = usis_without_scan.str.extract(DATASET_PATTERN, expand=False)
+    stems = file_stem_series(usis_without_scan)
+    return "mzspec:" + datasets + ":" + stems
+
+
+def file_stem_series(paths: pd.Series) -> pd.Series:
+    """
+    Vectorized Path(...).stem of the part after the last : or /
+    """
+    # plain string methods are several times faster than the regex patterns for each element
+    stems = [path_stem(path) for path in paths.astype(str).to_numpy(dtype=object)]
+    return pd.Series(stems, index=paths.index, dtype=object)
+
+
+def path_stem(path: str) -> str:
+    """
+    Path(...).stem of the file name after the last : or /. Only removes an extension with a name in front of it
+    """
+    name = path[max(path.rfind("/"), path.rfind(":")) + 1:]
+    dot = name.rfind(".")
+    return name[:dot] if 0 < dot < len(name) - 1 else name
+
+
+def simple_file_usi_series(filenames: pd.Series, datasets: pd.Series) -> pd.Series:
+    """
+    Vectorized create_simple_file_usi for whole columns
+    :return: series of file usis mzspec:dataset:filename
+    """
+    stems = file_stem_series(filenames)
+    if (filenames.isna() | (stems == "")).any():
+        raise ValueError("Filename is empty")
+    if (datasets.isna() | (datasets.astype(str) == "")).any():
+        raise ValueError("Dataset is empty")
+    return "mzspec:" + datasets.astype(str) + ":" + stems
+
+
 def create_file_usi_column(
     df, original_usi_col="USI", dataset_col="MassIVE", filename_col="Filename"
 ):
     if original_usi_col in df.columns:
-        df["file_usi"] = [ensure_simple_file_usi(usi) for usi in df[original_usi_col]]
+        df["file_usi"] = file_usi_series(df[original_usi_col])
     else:
         if filename_col not in df.columns:
             raise ValueError("Missing Filename column")
         if dataset_col not in df.columns:
             raise ValueError("Missing MassIVE column for datasets")
-        df["file_usi"] = [
-            create_simple_file_usi(filename, dataset)
-            for filename, dataset in zip(df[filename_col], df[dataset_col])
-        ]
+        df["file_usi"] = simple_file_usi_series(df[filename_col], df[dataset_col])
 
 
 def ensure_usi(usi_or_lib_id):
@@ -1,9 +1,65 @@
 from pathlib import Path
+from dataclasses import dataclass
+from dataclasses import replace
+import hashlib
 import logging
+import os
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# hex digits of the hash that name the shard directory, 2 digits spread the outputs over 256 directories
+SHARD_HEX_DIGITS = 2
+# key of the sha256 of the source csv in the parquet metadata of a prepared metadata table
+PARQUET_SOURCE_HASH_KEY = b"source_sha256"
+
+
+@dataclass
+class OutputOptions:
+    """
+    Options for the tree JSON and HTML reports of each compound
+    """
+
+    # write the JS and CSS libraries once to an assets folder next to the reports instead of into every report
+    shared_assets: bool = False
+    # remove subtrees without matches at this depth or deeper (root is depth 0), None keeps the full tree
+    prune_depth: int | None = None
+    # remove node fields that the report derives itself from the tree json
+    compact_json: bool = False
+    # render the analog matches of the most common nominal mass shifts as trees of their own
+    top_mass_shift_trees: int = 0
+    # write the outputs of each compound into a hashed subdirectory instead of one flat directory
+    shard_outputs: bool = False
+    # gzip or zstd compress the tree json, TSV, and HTML files of each compound, None writes plain files
+    compression: str | None = None
+    # keep trees whose inputs did not change since the last run, see the fingerprints file of each compound
+    skip_unchanged: bool = True
+    # add the fold enrichment, p-value, and FDR of the matches to each node of the special MASST trees
+    enrichment: bool = False
+
+
+# options that shape the trees and reports, saved in the manifest of each compound so that a redraw renders the same
+# trees as the original run
+RENDER_OPTIONS = ["shared_assets", "prune_depth", "compact_json", "top_mass_shift_trees", "compression", "enrichment"]
+
+
+def render_option_values(output_options: OutputOptions) -> dict:
+    """
+    :return: dict of the render options and their values
+    """
+    return {name: getattr(output_options, name) for name in RENDER_OPTIONS}
+
+
+def with_render_options(output_options: OutputOptions, render_options: dict | None) -> OutputOptions:
+    """
+    :param output_options: the options to update
+    :param render_options: saved render options, e.g., of an earlier run. Other keys are ignored
+    :return: a copy of output_options with the render options
+    """
+    if not render_options:
+        return output_options
+    return replace(output_options, **{name: render_options[name] for name in RENDER_OPTIONS if name in render_options})
+
 
 def prepare_paths(file=None, files=None):
     if files is not None:
@@ -17,3 +73,63 @@ def prepare_paths(file=None, files=None):
             Path(file).parent.mkdir(parents=True, exist_ok=True)
         except Exception as e:
             logger.exception(e)
+
+
+def output_shard(name: str) -> str:
+    """
+    :return: the shard directory name of a compound, stable across runs
+    """
+    return hashlib.md5(str(name).encode("utf-8")).hexdigest()[:SHARD_HEX_DIGITS]
+
+
+def shard_file_name(file_name, name: str) -> str:
+    """
+    Inserts the shard directory of name between the directory and the file prefix,
+    e.g., ../output/fastMASST becomes ../output/3f/fastMASST
+    """
+    file_path = Path(file_name)
+    return str(file_path.parent / output_shard(name) / file_path.name)
+
+
+def scan_output_files(file_name, suffix: str | tuple, sharded=False) -> set:
+    """
+    Lists the outputs of a batch in a single sweep over its directory and, for sharded outputs, the shard
+    directories. Much faster than a file check per compound on large directories and network storage
+    :param file_name: the output file prefix of the batch
+    :param suffix: only files that end with this suffix or one of a tuple of suffixes
+    :param sharded: the outputs are in shard directories
+    :return: normalized paths of all files that start with the prefix and end with suffix
+    """
+    directory = str(Path(file_name).parent)
+    prefix = Path(file_name).name
+    directories = [directory]
+    if sharded:
+        try:
+            with os.scandir(directory) as entries:
+                directories = [
+                    entry.path
+                    for entry in entries
+                    if len(entry.name) == SHARD_HEX_DIGITS and entry.is_dir()
+                ]
+        except FileNotFoundError:
+            return set()
+
+    files = set()
+    for scan_dir in directories:
+        try:
+            with os.scandir(scan_dir) as entries:
+                files.update(
+                    os.path.normpath(entry.path)
+                    for entry in entries
+                    if entry.name.startswith(prefix) and entry.name.endswith(suffix)
+                )
+        except FileNotFoundError:
+            pass
+    return files
+
+
+def metadata_parquet_file(metadata_file) -> str:
+    """
+    :return: the parquet table next to a csv or tsv metadata table
+    """
+    return str(Path(metadata_file).with_suffix(".parquet"))
@@ -0,0 +1,57 @@
+import bundle_to_html
+
+REPLACE_DICT = {
+    "PLACEHOLDER_JSON_DATA": '{"name":"root","children":[]}',
+    "LIBRARY_JSON_DATA_PLACEHOLDER": "[]",
+    "INPUT_LABEL_PLACEHOLDER": 'ID: x;  Descriptor: "quoted" `name`',
+    "USI_LABEL_PLACEHOLDER": "",
+    "PARAMS_PLACEHOLDER": "min cosine: 0.7",
+}
+
+
+def test_html_shell_splices_data(tmp_path):
+    out_html = tmp_path / "report.html"
+    bundle_to_html.build_dist_html(
+        "../code/collapsible_tree_v3.html", out_html, REPLACE_DICT, compress=True
+    )
+    text = out_html.read_text(encoding="utf-8")
+    for placeholder in REPLACE_DICT:
+        assert placeholder not in text
+    assert '{"name":"root","children":[]}' in text
+    assert "min cosine: 0.7" in text
+
+
+def test_html_shell_disk_cache(tmp_path):
+    placeholders = list(REPLACE_DICT.keys())
+    shell = bundle_to_html.compile_html_shell(
+        "../code/collapsible_tree_v3.html", placeholders, False, tmp_path
+    )
+    assert len(list(tmp_path.glob("html_shell_*.json"))) == 1
+    cached = bundle_to_html.compile_html_shell(
+        "../code/collapsible_tree_v3.html", placeholders, False, tmp_path
+    )
+    assert cached == shell
+    assert len(shell.segments) == len(placeholders) + 1
+
+
+def test_escape_js_string():
+    assert bundle_to_html.escape_js_string('a"b\\', '"') == 'a\\"b\\\\'
+    assert bundle_to_html.escape_js_string("${x}`", "`") == "\\${x}\\`"
+
+
+def test_shared_assets(tmp_path):
+    out_html = tmp_path / "reports" / "report.html"
+    out_html.parent.mkdir()
+    assets_dir = tmp_path / "assets"
+    bundle_to_html.build_dist_html(
+        "../code/collapsible_tree_v3.html",
+        out_html,
+        REPLACE_DICT,
+        compress=True,
+        assets_dir=assets_dir,
+    )
+    text = out_html.read_text(encoding="utf-8")
+    assert (assets_dir / "d3.v3.min.js").is_file()
+    assert "../assets/d3.v3.min.js" in text
+    assert '{"name":"root","children":[]}' in text
+    assert len(text) < 10000
@@ -0,0 +1,106 @@
+import dataclasses
+import json
+import shutil
+
+import pandas as pd
+
+import compiled_masst
+from masst_tree import indexed_metadata_matches
+from masst_tree import read_metadata
+from masst_utils import FOOD_MASST
+
+
+def test_compile_and_fall_back_when_stale(tmp_path):
+    special_masst = dataclasses.replace(
+        FOOD_MASST,
+        tree_file=str(tmp_path / "tree.json"),
+        metadata_file=str(tmp_path / "table.csv"),
+    )
+    shutil.copy(FOOD_MASST.tree_file, special_masst.tree_file)
+    shutil.copy(FOOD_MASST.metadata_file, special_masst.metadata_file)
+    out_dir = str(tmp_path / "compiled")
+
+    compiled_masst.compile_special_masst(special_masst, out_dir)
+    compiled = compiled_masst.load_compiled(special_masst, out_dir)
+    with open(FOOD_MASST.tree_file) as file:
+        tree = json.load(file)
+    assert compiled.tree_root() == tree
+
+    # the indexed join equals the merge
+    metadata_df = read_metadata(special_masst.metadata_file)
+    file_usis = metadata_df["file_usi"].tolist()
+    matches_df = pd.DataFrame({"USI": ["a", "b", "c", "d"], "file_usi": [file_usis[5], "x", file_usis[1], file_usis[5]]})
+    pd.testing.assert_frame_equal(
+        indexed_metadata_matches(matches_df, read_metadata(compiled.metadata_table), compiled.file_usis),
+        pd.merge(matches_df, metadata_df, on="file_usi"),
+    )
+
+    # a changed tree makes the artefact stale
+    tree["group_size"] = 1
+    with open(special_masst.tree_file, "w") as file:
+        json.dump(tree, file)
+    assert compiled_masst.load_compiled(special_masst, out_dir) is None
+    assert compiled_masst.load_tree(special_masst, out_dir)["group_size"] == 1
+
+
+def test_compiled_tree_equals_the_tree_walk(tmp_path, monkeypatch):
+    import json_ontology_extender
+    from masst_tree import group_matches
+    from masst_tree import metadata_matches
+
+    special_masst = dataclasses.replace(
+        FOOD_MASST,
+        tree_file=str(tmp_path / "tree.json"),
+        metadata_file=str(tmp_path / "table.csv"),
+        tree_node_key="id",
+    )
+    # a duplicate id, a node without id, and nodes without group_size
+    tree = {
+        "name": "root",
+        "id": "r",
+        "children": [
+            {"name": "a", "id": "x", "group_size": 2},
+            {"name": "b", "children": [{"name": "c", "id": "x", "group_size": 3}, {"name": "d", "id": "d"}]},
+        ],
+    }
+    with open(special_masst.tree_file, "w") as file:
+        json.dump(tree, file)
+    pd.DataFrame({"file_usi": ["f1", "f2", "f3", "f4"], "node_id": ["x", "y", "x", "d"]}).to_csv(
+        special_masst.metadata_file, index=False
+    )
+    out_dir = str(tmp_path / "compiled")
+    compiled_masst.compile_special_masst(special_masst, out_dir)
+    compiled = compiled_masst.load_compiled(special_masst, out_dir)
+    assert compiled.tree_root() == tree
+    assert compiled.node_ids.tolist() == ["r", "x", "", "x", "d"]
+    assert compiled.same_id_nodes(1) == [1, 3]
+    assert compiled.file_usi_nodes(["f3", "f2", "f9", "f4"]).tolist() == [1, -1, -1, 4]
+
+    matches_df = pd.DataFrame(
+        {
+            "USI": ["u1", "u2", "u3", "u4"],
+            "file_usi": ["f1", "f2", "f3", "f1"],
+            "Cosine": [0.9, 0.8, 0.7, 0.75],
+            "Matching Peaks": [6, 5, 4, 7],
+            "Delta Mass": [0.0, 0.0, 0.0, 0.0],
+        }
+    )
+    load_compiled = compiled_masst.load_compiled
+    outputs = []
+    # the tree walk without and the node index with the compiled artefact
+    for artefact_dir in [None, out_dir]:
+        monkeypatch.setattr(
+            compiled_masst,
+            "load_compiled",
+            lambda masst, artefact_dir=artefact_dir: load_compiled(masst, artefact_dir) if artefact_dir else None,
+        )
+        grouped_df = group_matches(special_masst, metadata_matches(special_masst, matches_df))
+        assert ("node" in grouped_df.columns) == (artefact_dir is not None)
+        out_file = str(tmp_path / "out.json")
+        json_ontology_extender.add_data_to_ontology_file(
+            special_masst=special_masst, output=out_file, meta_matched_df=grouped_df
+        )
+        with open(out_file) as file:
+            outputs.append(json.load(file))
+    assert outputs[0] == outputs[1]
+    assert [child["matched_size"] for child in outputs[1]["children"]] == [3, 3]
@@ -0,0 +1,15 @@
+import compressed_files
+from output_writer import write_output
+
+
+def test_read_compressed_output(tmp_path):
+    path = tmp_path / "tree.json"
+    written = write_output(path, '{"name": "root"}\n', compression="gzip")
+    assert written == str(path) + ".gz"
+    assert compressed_files.read_text(path) == '{"name": "root"}\n'
+
+    # the version of the current run is preferred over stale plain files
+    path.write_text("old")
+    assert compressed_files.read_text(path) == "old"
+    assert compressed_files.read_text(path, prefer_compression="gzip") == '{"name": "root"}\n'
+    assert compressed_files.strip_compression_suffix(written) == str(path)
@@ -0,0 +1,104 @@
+import pandas as pd
+
+from cooccurrence import CooccurrenceAccumulator
+from cooccurrence import read_cooccurrence
+from masst_utils import FOOD_MASST
+
+
+def test_cooccurrence_rollup_and_checkpoint(tmp_path):
+    out_dir = str(tmp_path / "cooccurrence")
+    accumulator = CooccurrenceAccumulator(out_dir, [FOOD_MASST], checkpoint_seconds=0)
+    # food tree: plant > fruit > nut
+    accumulator.add_compound("a", [(FOOD_MASST, pd.DataFrame({"node_id": ["nut", "nut", "fruit", "unknown"]}))])
+    accumulator.add_compound("b")
+
+    # a new accumulator continues from the checkpoint
+    accumulator = CooccurrenceAccumulator(out_dir, [FOOD_MASST])
+    assert accumulator.compounds() == ["a", "b"]
+    accumulator.add_compound("c", [(FOOD_MASST, pd.DataFrame({"node_id": ["sap"]}))])
+    accumulator.close()
+
+    df = read_cooccurrence(out_dir, FOOD_MASST).sparse.to_dense()
+    assert df.loc["a", ["nut", "fruit", "plant", "sap"]].tolist() == [2, 3, 3, 0]
+    assert df.loc["b"].sum() == 0
+    assert df.loc["c", ["sap", "plant", "fruit"]].tolist() == [1, 1, 0]
+
+
+def test_checkpoint_is_one_snapshot(tmp_path, monkeypatch):
+    import cooccurrence
+
+    out_dir = str(tmp_path / "cooccurrence")
+    accumulator = CooccurrenceAccumulator(out_dir, [FOOD_MASST], checkpoint_seconds=3600)
+    accumulator.add_compound("a", [(FOOD_MASST, pd.DataFrame({"node_id": ["nut"]}))])
+    save_matrix = cooccurrence.save_matrix
+
+    def add_during_checkpoint(matrix, file):
+        # a compound that finishes while the checkpoint is written
+        monkeypatch.setattr(cooccurrence, "save_matrix", save_matrix)
+        accumulator.add_compound("b", [(FOOD_MASST, pd.DataFrame({"node_id": ["sap"]}))])
+        save_matrix(matrix, file)
+
+    monkeypatch.setattr(cooccurrence, "save_matrix", add_during_checkpoint)
+    accumulator.checkpoint()
+
+    # the compound is not restored as done without counts
+    assert CooccurrenceAccumulator(out_dir, [FOOD_MASST]).compounds() == ["a"]
+
+
+def test_rollup_of_duplicate_node_ids(tmp_path):
+    import dataclasses
+    import json
+
+    special_masst = dataclasses.replace(FOOD_MASST, tree_file=str(tmp_path / "tree.json"))
+    # x is twice in the tree, each time with another subtree
+    tree = {
+        "name": "r",
+        "children": [
+            {"name": "a", "children": [{"name": "x", "children": [{"name": "y"}]}]},
+            {"name": "b", "children": [{"name": "x", "children": [{"name": "z"}, {"name": "x"}]}]},
+        ],
+    }
+    with open(special_masst.tree_file, "w") as file:
+        json.dump(tree, file)
+    accumulator = CooccurrenceAccumulator(None, [special_masst])
+    accumulator.add_compound("c", [(special_masst, pd.DataFrame({"node_id": ["x", "y", "z"]}))])
+
+    df = accumulator.to_frame(special_masst).sparse.to_dense()
+    assert df.loc["c", ["r", "a", "x", "y", "b", "z"]].tolist() == [3, 2, 3, 1, 2, 1]
+
+
+def test_cooccurrence_from_the_rendered_trees(tmp_path, monkeypatch):
+    import masst_client
+    from masst_tree import metadata_matches
+    from masst_tree import read_metadata
+    from utils import OutputOptions
+
+    file_usis = read_metadata(FOOD_MASST.metadata_file)["file_usi"].iloc[:200:7].tolist()
+    matches_df = pd.DataFrame(
+        {
+            "USI": [file_usi + ":scan:1" for file_usi in file_usis],
+            "file_usi": file_usis,
+            "Cosine": 0.9,
+            "Matching Peaks": 6,
+            "Delta Mass": 0.0,
+        }
+    )
+    expected = CooccurrenceAccumulator(None, [FOOD_MASST])
+    expected.add_compound("a", [(FOOD_MASST, metadata_matches(FOOD_MASST, matches_df))])
+
+    matched_sizes = {}
+    labels = {"input_label": "in", "params_label": "params", "usi": None, "lib_match_json": "[]"}
+    masst_client.render_trees(
+        [(matches_df, str(tmp_path / "run_a"), "")],
+        labels,
+        OutputOptions(),
+        special_massts=[FOOD_MASST],
+        matched_sizes=matched_sizes,
+    )
+    # the rendered tree has the counts, no second join with the metadata
+    monkeypatch.setattr(masst_client, "metadata_matches", None)
+    accumulator = CooccurrenceAccumulator(None, [FOOD_MASST])
+    masst_client.add_cooccurrence(accumulator, "a", matches_df, matched_sizes)
+
+    assert expected.matrix(FOOD_MASST).sum() > 0
+    assert (accumulator.matrix(FOOD_MASST) != expected.matrix(FOOD_MASST)).nnz == 0
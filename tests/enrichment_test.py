@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import false_discovery_control
+from scipy.stats import fisher_exact
+
+import enrichment
+from masst_utils import FOOD_MASST
+
+
+def test_hypergeometric_enrichment_equals_fisher():
+    matched = np.array([5, 0, 12, 3])
+    group = np.array([20, 40, 100, 3])
+    fold, p = enrichment.hypergeometric_enrichment(matched, group, 30, 1000)
+    for k, n, node_p in zip(matched, group, p):
+        expected = fisher_exact([[k, n - k], [30 - k, 1000 - n - 30 + k]], alternative="greater")[1]
+        assert np.isclose(node_p, expected, rtol=1e-9)
+    assert np.isclose(fold[0], (5 / 20) / (30 / 1000))
+
+
+def test_fdr_bh_by_group():
+    rng = np.random.default_rng(0)
+    p = rng.random(200) ** 3
+    groups = rng.integers(0, 4, 200)
+    q = enrichment.fdr_bh(p, groups)
+    for group in range(4):
+        assert np.allclose(q[groups == group], false_discovery_control(p[groups == group]))
+    # untested nodes count as p=1
+    padded = false_discovery_control(np.r_[p[:10], np.ones(20)])[:10]
+    assert np.allclose(enrichment.fdr_bh(p[:10], n_tests=30), padded)
+
+
+def test_tree_and_summary_enrichment():
+    root = {
+        "group_size": 1000,
+        "matched_size": 30,
+        "children": [
+            {"name": "plant", "group_size": 20, "matched_size": 25, "children": [{"group_size": 0}]},
+            {"name": "dairy", "group_size": 980, "matched_size": 5},
+        ],
+    }
+    enrichment.add_enrichment_to_tree(root)
+    plant, dairy = root["children"]
+    assert plant["enrichment_p"] < 1e-20 < dairy["enrichment_p"]
+    assert plant["children"][0]["enrichment_p"] is None
+
+    index = pd.MultiIndex.from_tuples(
+        [("plant", "plant", None, 20, 1), ("dairy", "dairy", None, 980, 1)],
+        names=["name", "Name", "Rank", "group_size", "Level"],
+    )
+    summary_df = pd.DataFrame({"1": [25, 5], "2": [0, 7]}, index=index).astype(pd.SparseDtype(float, 0))
+    enrichment_df = enrichment.summary_enrichment(summary_df, FOOD_MASST)
+    assert enrichment_df[["Compound", "name", "matched_size"]].values.tolist() == [
+        ["1", "plant", 25],
+        ["1", "dairy", 5],
+        ["2", "dairy", 7],
+    ]
@@ -0,0 +1,181 @@
+import os
+
+import pandas as pd
+
+import fingerprints
+from masst_redraw import read_match_table
+
+
+def test_matches_hash_survives_match_table(tmp_path):
+    matches_df = pd.DataFrame(
+        {
+            "USI": ["mzspec:MSV000084900:peak/G1.mzML:scan:1", "mzspec:MSV000084900:peak/G2.mzML:scan:2"],
+            "Cosine": [0.9994202370199035, 0.7],
+            "Matching Peaks": [4, 12],
+            "Delta Mass": [-7.111928450486183, 0.0],
+            "file_usi": ["mzspec:MSV000084900:G1", "mzspec:MSV000084900:G2"],
+        }
+    )
+    common_file = str(tmp_path / "run_cmpd")
+    matches_df.drop(columns="file_usi").to_csv(common_file + "_matches.tsv", sep="\t", index=False)
+
+    # the redraw reads the table back and must see the same matches as the original run
+    read_df = read_match_table(common_file + "_matches.tsv")
+    assert fingerprints.matches_hash(read_df) == fingerprints.matches_hash(matches_df)
+    assert fingerprints.matches_hash(read_df.iloc[:1]) != fingerprints.matches_hash(matches_df)
+
+    fingerprints.write_manifest(common_file, {"artefacts": {"food": "abc"}})
+    assert fingerprints.read_manifest(common_file)["artefacts"] == {"food": "abc"}
+    assert fingerprints.read_manifest(common_file + "_missing") == {}
+
+
+def test_render_trees_skips_unchanged(tmp_path, monkeypatch):
+    import masst_client
+    from masst_utils import FOOD_MASST
+    from utils import OutputOptions
+
+    rendered = []
+
+    def fake_render(matches_df, special_masst=None, common_file=None, **kwargs):
+        prefix = special_masst.prefix if special_masst else "combined"
+        rendered.append(prefix)
+        for extension in ["json", "html"]:
+            (tmp_path / "run_cmpd_{}.{}".format(prefix, extension)).write_text("{}")
+
+    monkeypatch.setattr(masst_client, "create_enriched_masst_tree", fake_render)
+    monkeypatch.setattr(masst_client, "create_combined_masst_tree", fake_render)
+    matches_df = pd.DataFrame(
+        {"USI": ["mzspec:MSV000084900:peak/G1.mzML:scan:1"], "Cosine": [0.9], "Matching Peaks": [6]}
+    )
+    labels = {"input_label": "in", "params_label": "params", "usi": None, "lib_match_json": "[]"}
+
+    def render(manifest, df=matches_df, force=False):
+        return masst_client.render_trees(
+            [(df, str(tmp_path / "run_cmpd"), "")],
+            labels,
+            OutputOptions(),
+            special_massts=[FOOD_MASST],
+            manifest=manifest,
+            force=force,
+        )
+
+    manifest = render({})
+    assert rendered == ["food", "combined"]
+    assert render(manifest) == manifest
+    assert rendered == ["food", "combined"]
+
+    # missing outputs, changed matches, and force render again
+    (tmp_path / "run_cmpd_food.html").unlink()
+    render(manifest)
+    assert rendered[2:] == ["food", "combined"]
+    render(manifest, matches_df.assign(Cosine=0.8))
+    assert rendered[4:] == ["food", "combined"]
+    render(manifest, force=True)
+    assert rendered[6:] == ["food", "combined"]
+
+
+def test_render_trees_retries_failed_renders(tmp_path, monkeypatch):
+    import pytest
+
+    import masst_client
+    from masst_utils import FOOD_MASST
+    from masst_utils import PLANT_MASST
+    from utils import OutputOptions
+
+    rendered = []
+
+    def render_food_only(matches_df, special_masst=None, **kwargs):
+        rendered.append(special_masst.prefix if special_masst else "combined")
+        if special_masst is None or special_masst.prefix != "food":
+            # no match in the metadata
+            return False
+        raise ValueError("render failed")
+
+    monkeypatch.setattr(masst_client, "create_enriched_masst_tree", render_food_only)
+    monkeypatch.setattr(masst_client, "create_combined_masst_tree", render_food_only)
+    matches_df = pd.DataFrame(
+        {"USI": ["mzspec:MSV000084900:peak/G1.mzML:scan:1"], "Cosine": [0.9], "Matching Peaks": [6]}
+    )
+    labels = {"input_label": "in", "params_label": "params", "usi": None, "lib_match_json": "[]"}
+
+    def render(manifest):
+        return masst_client.render_trees(
+            [(matches_df, str(tmp_path / "run_cmpd"), "")],
+            labels,
+            OutputOptions(),
+            special_massts=[FOOD_MASST, PLANT_MASST],
+            manifest=manifest,
+        )
+
+    with pytest.raises(masst_client.RenderError) as error:
+        render({})
+    manifest = error.value.manifest
+    assert isinstance(error.value.__cause__, ValueError)
+    assert manifest["empty"] == ["combined", "plant"]
+    assert "food" not in manifest["artefacts"] and "plant" in manifest["artefacts"]
+
+    # only the failed tree and the combined tree are rendered again
+    with pytest.raises(masst_client.RenderError):
+        render(manifest)
+    assert rendered[3:] == ["food", "combined"]
+
+
+def test_redraw_renders_the_variants_of_the_run(tmp_path, monkeypatch):
+    import masst_client
+    from masst_redraw import redraw_compound
+    from utils import OutputOptions
+    from utils import render_option_values
+
+    calls = []
+
+    def fake_render_trees(variants, labels, output_options, **kwargs):
+        calls.append(([variant_key for _, _, variant_key in variants], kwargs["export_counts"]))
+        return {"labels": labels, "options": render_option_values(output_options), "artefacts": {}, "empty": []}
+
+    monkeypatch.setattr(masst_client, "render_trees", fake_render_trees)
+    common_file = str(tmp_path / "run_cmpd")
+    usis = ["mzspec:MSV000084900:peak/G1.mzML:scan:1", "mzspec:MSV000084900:peak/G2.mzML:scan:2"]
+    pd.DataFrame({"USI": usis[:1], "Cosine": [0.9], "Matching Peaks": [6]}).to_csv(
+        common_file + "_matches.tsv", sep="\t", index=False
+    )
+    pd.DataFrame({"USI": usis, "Cosine": [0.9, 0.8], "Matching Peaks": [6, 5], "rounded_delta": [0.0, 16.0]}).to_csv(
+        common_file + "_analog_matches.tsv", sep="\t", index=False
+    )
+    pd.DataFrame({"rounded_delta": [16.0, 0.0], "matches": [1, 1], "files": [1, 1], "datasets": [1, 1]}).to_csv(
+        common_file + "_analog_delta_mass.tsv", sep="\t", index=False
+    )
+
+    # the original run rendered one mass shift tree
+    fingerprints.write_manifest(common_file, {"labels": {}, "options": {"top_mass_shift_trees": 1}, "artefacts": {}})
+
+    assert redraw_compound("cmpd", common_file, OutputOptions())
+    assert redraw_compound("cmpd", common_file, OutputOptions(), option_overrides={"top_mass_shift_trees": 0})
+    assert calls == [(["", "analog_", "analog_shift_+16_"], False), (["", "analog_"], False)]
+
+
+def test_empty_results_remove_the_analog_outputs_of_an_earlier_run(tmp_path):
+    from masst_client import common_base_file_name
+    from masst_client import export_empty_masst_results
+
+    file_name = str(tmp_path / "run")
+    common_file = common_base_file_name("cmpd", file_name, False)
+    stale = [
+        common_file + "_analog_matches.tsv",
+        common_file + "_analog_delta_mass.tsv",
+        common_file + "_analog_food.json.gz",
+        common_file + "_analog_counts_food.tsv",
+        common_file + "_analog_shift_+16_food.html",
+    ]
+    for file in stale + [common_file + "_food.json"]:
+        with open(file, "w") as f:
+            f.write("stale")
+    fingerprints.write_manifest(
+        common_file,
+        {"labels": {}, "artefacts": {"food": "a", "analog_food": "b", "analog_shift_+16_food": "c"}, "empty": []},
+    )
+
+    export_empty_masst_results("cmpd", file_name)
+
+    assert not any(os.path.exists(file) for file in stale)
+    assert fingerprints.read_manifest(common_file)["artefacts"] == {"food": "a"}
+    assert pd.read_csv(common_file + "_matches.tsv", sep="\t").empty
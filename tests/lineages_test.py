@@ -0,0 +1,55 @@
+import pandas as pd
+
+import lineages
+from cooccurrence import CooccurrenceAccumulator
+from masst_dataset_summary import create_count_summary
+from masst_utils import MICROBE_MASST
+
+
+def test_aggregate_ranks():
+    index = lineages.lineage_index(MICROBE_MASST)
+    hits_df = pd.DataFrame(
+        {
+            "Compound": ["a", "a", "a", "b", "b"],
+            "Taxa_NCBI": [562, 562, 1280, 1280, -1],
+            "file_usi": ["f1", "f2", "f1", "f3", "f4"],
+        }
+    )
+    rank_df = lineages.aggregate_ranks(index, hits_df, "domain")
+    assert rank_df.to_dict("records") == [
+        {"Compound": "a", "domain": "Bacteria", "matches": 3, "files": 2},
+        {"Compound": "b", "domain": "Bacteria", "matches": 1, "files": 1},
+    ]
+
+    matrix_df = lineages.rank_matrix(lineages.aggregate_ranks(index, hits_df, "genus"), "genus")
+    assert matrix_df.sparse.to_dense().to_dict() == {
+        "Escherichia": {"a": 2.0, "b": 0.0},
+        "Staphylococcus": {"a": 1.0, "b": 1.0},
+    }
+
+    accumulator = CooccurrenceAccumulator(special_massts=[MICROBE_MASST])
+    for compound, compound_df in hits_df.groupby("Compound"):
+        accumulator.add_compound(compound, [(MICROBE_MASST, compound_df)])
+    family_df = accumulator.rank_frame(MICROBE_MASST, "family").sparse.to_dense()
+    assert family_df["Enterobacteriaceae"].to_dict() == {"a": 2, "b": 0}
+    assert family_df["Staphylococcaceae"].to_dict() == {"a": 1, "b": 1}
+
+
+def test_count_summary_ranks(tmp_path):
+    counts_df = pd.DataFrame(
+        {
+            "Cosine": [0.9, 0.9, 0.9, 0.5],
+            "Taxa_NCBI": [562, 1280, 1280, 562],
+            "file_usi": ["f1", "f1", "f2", "f3"],
+        }
+    )
+    counts_df.to_csv(tmp_path / "run_cmpd_1_counts_microbe.tsv", sep="\t", index=False)
+
+    create_count_summary(
+        str(tmp_path / "run"), str(tmp_path / "summary"), min_cosine=0.7, workers=1, ranks=["phylum"]
+    )
+    rank_df = pd.read_parquet(tmp_path / "summary_microbe_phylum_rank_counts.parquet")
+    assert rank_df.sort_values("phylum").to_dict("records") == [
+        {"Compound": "cmpd_1", "phylum": "Bacillota", "matches": 2, "files": 2},
+        {"Compound": "cmpd_1", "phylum": "Pseudomonadota", "matches": 1, "files": 1},
+    ]
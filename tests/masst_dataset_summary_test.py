@@ -0,0 +1,114 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from masst_dataset_summary import create_count_summary
+from masst_dataset_summary import create_quant_summary
+from masst_dataset_summary import create_summary_file
+from masst_dataset_summary import import_quantdf
+from masst_utils import FOOD_MASST
+
+
+def loop_quant_summary(quant_df, summary_df, binary):
+    # the former per feature and sample loop as reference
+    if binary:
+        quant_df = quant_df.ge(0.01)
+    final_df = pd.DataFrame(0.0, index=summary_df.index, columns=quant_df.columns)
+    for f in summary_df.columns:
+        quant_row = quant_df[quant_df.index.get_level_values("row ID") == f].iloc[0]
+        for sample in quant_df.columns:
+            final_df[sample] += summary_df[f] * quant_row[sample]
+    return final_df
+
+
+def test_quant_summary_matches_loop(tmp_path):
+    rng = np.random.default_rng(0)
+    n_features, n_samples = 40, 7
+    areas = rng.uniform(0, 1000, (n_features, n_samples)) * (rng.uniform(size=(n_features, n_samples)) > 0.5)
+    quant = pd.DataFrame(areas, columns=["S{}.mzML Peak area".format(i) for i in range(n_samples)])
+    quant.insert(0, "row ID", np.arange(1, n_features + 1))
+    quant.insert(1, "row m/z", rng.uniform(100, 900, n_features))
+    quant.insert(2, "row retention time", rng.uniform(0, 10, n_features))
+    quant_csv = tmp_path / "quant.csv"
+    quant.to_csv(quant_csv, index=False)
+
+    index = pd.MultiIndex.from_tuples([(str(i), "node{}".format(i)) for i in range(5)], names=["NCBI", "Name"])
+    features = ["3", "7", "12", "25", "40"]
+    summary_df = pd.DataFrame((rng.uniform(size=(5, len(features))) > 0.4).astype(float), index, features)
+
+    quant_df = import_quantdf(quant_csv)
+    reference_summary_df = summary_df.copy()
+    reference_summary_df.columns = pd.to_numeric(reference_summary_df.columns)
+    for binary in [True, False]:
+        expected = loop_quant_summary(quant_df, reference_summary_df, binary)
+        result = create_quant_summary(quant_csv, summary_df, sum_as_binary_presence=binary)
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+    out_file = tmp_path / "summary.parquet"
+    create_quant_summary(quant_csv, summary_df, out_file=out_file)
+    assert len(pd.read_parquet(out_file)) == 5
+
+
+def write_tree(file, matched):
+    children = [
+        {"name": name, "Rank": None, "group_size": 10, "matched_size": size}
+        for name, size in matched.items()
+    ]
+    file.write_text(json.dumps({"name": "root", "children": children}))
+
+
+def test_incremental_summary(tmp_path):
+    state_dir = tmp_path / "state"
+    write_tree(tmp_path / "run_1_food.json", {"plant": 2, "fruit": 1})
+    write_tree(tmp_path / "run_2_food.json", {"plant": 3})
+    # analog trees are not part of the summary
+    write_tree(tmp_path / "run_2_analog_food.json", {"dairy": 1})
+
+    summary_df = create_summary_file(str(tmp_path / "run"), FOOD_MASST, workers=1, state_dir=state_dir)
+    summary_df = summary_df.sparse.to_dense().droplevel(["Name", "Rank", "group_size", "Level"])
+    assert summary_df.to_dict() == {"1": {"plant": 1.0, "fruit": 1.0}, "2": {"plant": 1.0, "fruit": 0.0}}
+
+    # a rerun only reads the new and changed trees
+    write_tree(tmp_path / "run_3_food.json", {"dairy": 4})
+    os.remove(tmp_path / "run_1_food.json")
+    summary_df = create_summary_file(
+        str(tmp_path / "run"), FOOD_MASST, matches_to_binary_presence=False, workers=1, state_dir=state_dir
+    )
+    assert list(summary_df.columns) == ["2", "3"]
+    assert summary_df.sparse.to_dense().sum().to_dict() == {"2": 3.0, "3": 4.0}
+
+
+def test_count_summary(tmp_path):
+    counts_df = pd.DataFrame(
+        {
+            "Cosine": [0.9, 0.95, 0.5, 0.99],
+            "Dataset": ["MSV1", "MSV2", "MSV1", "MSV3"],
+            "QC": ["No", "No", "No", "Yes"],
+            "Blank": ["No", "No", "No", "No"],
+            "Taxa_NCBI": [562, 562, 1280, 1280],
+        }
+    )
+    counts_df.to_csv(tmp_path / "run_cmpd_1_counts_microbe.tsv", sep="\t", index=False)
+    counts_df.to_csv(tmp_path / "run_cmpd_2_counts_microbe.tsv.gz", sep="\t", index=False)
+    counts_df.to_csv(tmp_path / "run_cmpd_2_analog_counts_microbe.tsv", sep="\t", index=False)
+    # the match tables mark the finished compounds, cmpd_3 has no match in a special MASST
+    for compound in ["cmpd_1", "cmpd_3", "cmpd_3_analog"]:
+        (tmp_path / "run_{}_matches.tsv".format(compound)).write_text("USI\n")
+
+    summary_df = create_count_summary(
+        str(tmp_path / "run"),
+        str(tmp_path / "summary"),
+        min_cosine=0.7,
+        exclude_datasets=["MSV2"],
+        workers=1,
+        out_format="csv",
+    )
+    assert summary_df["masst_microbe"].to_dict() == {"cmpd_1": 1, "cmpd_3": 0, "cmpd_2": 1}
+    assert summary_df["masst_food"].sum() == 0
+    node_df = pd.read_csv(tmp_path / "summary_microbe_node_counts.csv")
+    assert node_df.to_dict("records") == [
+        {"Compound": "cmpd_1", "Taxa_NCBI": 562, "matches": 1},
+        {"Compound": "cmpd_2", "Taxa_NCBI": 562, "matches": 1},
+    ]
@@ -0,0 +1,46 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+import masst_tree
+import masst_utils
+
+
+def test_group_matches():
+    results_df = pd.DataFrame(
+        {
+            "node_id": ["b", "a", "b", None, "a", "c"],
+            "USI": ["u1", "u2", "u3", "u4", "u5", "u6"],
+            "Cosine": [0.9, 0.8, 0.71234567891234, 0.7, 0.95, 0.75],
+            "Matching Peaks": [5, 6, 7, 8, 9, 10],
+            "Delta Mass": [0.0, np.nan, 0.01, 0.0, 0.02, 0.0],
+        }
+    )
+    grouped = masst_tree.group_matches(masst_utils.FOOD_MASST, results_df)
+
+    assert list(grouped["node_id"]) == ["a", "b", "c"]
+    assert list(grouped["matched_size"]) == [2, 2, 1]
+    # same records as pandas to_json within each group, in the original order
+    for node_id, matches in zip(grouped["node_id"], grouped["matches"]):
+        expected = results_df[results_df["node_id"] == node_id][
+            masst_tree.MATCH_RECORD_COLUMNS
+        ].to_json(orient="records")
+        assert matches == json.loads(expected)
+
+
+def test_dumps_tree(monkeypatch):
+    import json_ontology_extender
+
+    tree = {
+        "name": "root",
+        "occurrence_fraction": np.float64("nan"),
+        "children": [{"name": "a", "group_size": np.int64(3), "fold": float("inf"), "matched_size": 0.25}],
+    }
+    # the json of the baseline unless compact json is requested
+    assert json_ontology_extender.dumps_tree(tree) == json.dumps(tree, cls=json_ontology_extender.NpEncoder)
+    compact = json_ontology_extender.dumps_tree(tree, compact_json=True)
+    assert '"occurrence_fraction":null' in compact and '"fold":null' in compact
+    # the same without orjson
+    monkeypatch.setattr(json_ontology_extender, "orjson", None)
+    assert json_ontology_extender.dumps_tree(tree, compact_json=True) == compact
@@ -0,0 +1,28 @@
+import masst_utils
+from benchmark_extraction import create_analog_payload, extract_matches_with_copies
+
+
+def test_extract_matches_shared_frame():
+    payload = create_analog_payload(5000, 300, n_datasets=20)
+    filtered_df, unfiltered_df, analog_df = extract_matches_with_copies(payload, 0.05, 3, True)
+    results = masst_utils.extract_matches_from_masst_results(payload, 0.05, 3, True, True)
+
+    assert list(results.unfiltered_masst_df["USI"]) == list(unfiltered_df["USI"])
+    assert set(results.filtered_masst_df["USI"]) == set(filtered_df["USI"])
+    assert set(results.analog_masst_df["USI"]) == set(analog_df["USI"])
+    assert results.filtered_masst_df["file_usi"].is_unique
+    # views are taken by position and do not write into the shared frame
+    assert "rounded_delta" not in results.unfiltered_masst_df.columns
+
+
+def test_delta_mass_histogram():
+    payload = create_analog_payload(5000, 300, n_datasets=20)
+    results = masst_utils.extract_matches_from_masst_results(payload, 0.05, 3, True, True)
+    analog_df = results.analog_masst_df
+    histogram_df = results.delta_mass_histogram_df
+
+    assert not analog_df.duplicated(["file_usi", "rounded_delta"]).any()
+    top = histogram_df.iloc[0]
+    assert top["files"] == analog_df["rounded_delta"].eq(top["rounded_delta"]).sum()
+    assert histogram_df["matches"].sum() == len(masst_utils.filter_matches(results.unfiltered_masst_df, 0.05, 3, True))
+    assert masst_utils.top_mass_shifts(histogram_df, 2) == histogram_df["rounded_delta"].head(2).tolist()
@@ -0,0 +1,53 @@
+from output_writer import OutputWriter
+
+
+def test_output_writer(tmp_path):
+    with OutputWriter(threads=2, max_queue=2, fsync_batch=3) as writer:
+        futures = [writer.write(tmp_path / "sub" / "{}.tsv".format(i), "a\tb\n{}".format(i)) for i in range(10)]
+    assert all(future.done() for future in futures)
+    assert (tmp_path / "sub" / "7.tsv").read_text() == "a\tb\n7"
+    # only renamed files remain
+    assert len(list((tmp_path / "sub").iterdir())) == 10
+
+
+def test_output_writer_raises_failed_writes(tmp_path):
+    import pytest
+
+    (tmp_path / "file").write_text("")
+    writer = OutputWriter(threads=1)
+    group = writer.group()
+    group.write(tmp_path / "ok.tsv", "a")
+    # the parent directory is a file
+    group.write(tmp_path / "file" / "failed.tsv", "b")
+    with pytest.raises(OSError):
+        group.wait()
+    with pytest.raises(OSError, match="failed.tsv"):
+        writer.flush()
+    with pytest.raises(OSError):
+        writer.close()
+    assert (tmp_path / "ok.tsv").read_text() == "a"
+
+
+def test_output_writer_syncs_each_batch_once(tmp_path, monkeypatch):
+    import os
+    from concurrent.futures import Future
+
+    import pytest
+
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(fd) or fsync(fd))
+    # renaming onto a directory fails after the temp file was written
+    (tmp_path / "directory").mkdir()
+    items = [(str(tmp_path / "{}.tsv".format(i)), b"a", Future()) for i in range(5)]
+    items.append((str(tmp_path / "directory"), b"b", Future()))
+
+    writer = OutputWriter(threads=1)
+    writer._write_batch(items)
+    with pytest.raises(OSError, match="directory"):
+        writer.close()
+
+    assert len(synced) == 1
+    assert [future.result() for _, _, future in items[:5]] == [path for path, _, _ in items[:5]]
+    assert items[5][2].exception() is not None
+    assert not list(tmp_path.glob("*.tmp"))
@@ -0,0 +1,40 @@
+import pandas as pd
+
+import parquet_sink
+
+
+def test_parquet_result_sink(tmp_path):
+    with parquet_sink.ParquetResultSink(tmp_path, row_group_rows=3) as sink:
+        for i in range(4):
+            sink.append(
+                "matches",
+                "compound{}".format(i),
+                pd.DataFrame({"USI": ["a", "b"], "Cosine": [0.9, 0.8], "Dataset": ["MSV1", None]}),
+            )
+            sink.mark_finished("compound{}".format(i), 2)
+        sink.mark_finished("empty", 0)
+
+    df = parquet_sink.read_table(tmp_path, "matches", compounds=["compound2"])
+    assert list(df["USI"]) == ["a", "b"]
+    assert len(parquet_sink.read_table(tmp_path, "matches")) == 8
+    assert parquet_sink.finished_compounds(tmp_path) == {"compound0", "compound1", "compound2", "compound3", "empty"}
+
+
+def test_resume_after_killed_run(tmp_path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # a killed run: rows that were flushed but the sink was never closed
+    sink = parquet_sink.ParquetResultSink(tmp_path, row_group_rows=1)
+    sink.mark_finished("compound0", 1)
+    sink.flush()
+    # a part without footer of a writer that was kept open
+    (tmp_path / "compounds").mkdir(exist_ok=True)
+    writer = pq.ParquetWriter(tmp_path / "compounds" / "part-open.parquet", pa.schema([("Compound", pa.string())]))
+    writer.write_table(pa.table({"Compound": ["lost"]}))
+
+    assert parquet_sink.finished_compounds(tmp_path) == {"compound0"}
+    with parquet_sink.ParquetResultSink(tmp_path) as sink:
+        sink.mark_finished("compound1", 0)
+    assert parquet_sink.finished_compounds(tmp_path) == {"compound0", "compound1"}
+    assert (tmp_path / "compounds" / "_unreadable-part-open.parquet").exists()
@@ -0,0 +1,39 @@
+import pandas as pd
+
+from masst_tree import read_metadata
+from prepare_check_metadata import prepare_check_metadata_file
+
+
+def test_prepare_check_metadata_file(tmp_path):
+    pd.DataFrame(
+        {
+            "MassIVE": ["MSV2", "MSV1", "MSV1", "MSV1"],
+            "Filename": ["b.mzML", " a.mzML ", "a.mzXML", "c.mzML"],
+            "Taxa_NCBI": [562, 10, 1280, 562],
+            # numbers in the first chunk, strings in the second
+            "Note": [1, 2, " x ", None],
+        }
+    ).to_csv(tmp_path / "table_full.csv", index=False)
+
+    out_file = str(tmp_path / "table.csv")
+    prepare_check_metadata_file(
+        str(tmp_path / "table_full.csv"), out_file, duplicates_file=str(tmp_path / "dups.csv"), chunk_rows=2
+    )
+    df = pd.read_csv(out_file)
+    # the duplicate with the highest Taxa_NCBI is kept
+    assert df[["file_usi", "Taxa_NCBI"]].values.tolist() == [
+        ["mzspec:MSV1:a", 1280],
+        ["mzspec:MSV1:c", 562],
+        ["mzspec:MSV2:b", 562],
+    ]
+    assert df["Note"].tolist()[0] == "x"
+    assert len(pd.read_csv(tmp_path / "dups.csv")) == 2
+
+    # the runtime loader reads the parquet table
+    pd.testing.assert_frame_equal(read_metadata(out_file), pd.read_parquet(tmp_path / "table.parquet"))
+    assert read_metadata(out_file)["file_usi"].tolist() == df["file_usi"].tolist()
+
+    # a changed csv is read instead of the parquet table written from the old csv
+    df.iloc[:2].to_csv(out_file, index=False)
+    read_metadata.cache_clear()
+    assert len(read_metadata(out_file)) == 2
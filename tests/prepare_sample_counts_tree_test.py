@@ -0,0 +1,27 @@
+import json
+
+import pandas as pd
+
+from prepare_sample_counts_tree import update_metadata_on_tree
+
+
+def test_update_metadata_on_tree(tmp_path):
+    tree = {
+        "NCBI": "1",
+        "children": [
+            {"NCBI": "2", "children": [{"NCBI": "562"}, {"NCBI": "1280"}]},
+            # duplicated nodes count at each occurrence
+            {"NCBI": "3", "children": [{"NCBI": "562"}]},
+        ],
+    }
+    tree_file = tmp_path / "tree.json"
+    tree_file.write_text(json.dumps(tree))
+    pd.DataFrame({"Taxa_NCBI": [562, 562, 1280, 9606]}).to_csv(tmp_path / "table.csv", index=False)
+
+    assert update_metadata_on_tree(
+        str(tree_file), str(tmp_path / "table.csv"), not_in_tree_file=str(tmp_path / "not_in_tree.csv")
+    )
+    root = json.loads(tree_file.read_text())
+    assert root["group_size"] == 5
+    assert [child["group_size"] for child in root["children"]] == [3, 2]
+    assert pd.read_csv(tmp_path / "not_in_tree.csv")["Taxa_NCBI"].tolist() == [9606]
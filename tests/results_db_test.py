@@ -0,0 +1,34 @@
+import pandas as pd
+
+import masst_utils
+import results_db
+
+
+def test_results_index(tmp_path):
+    db_file = tmp_path / "results.db"
+    hits_df = pd.DataFrame(
+        {
+            "node_id": ["apple", "apple", "nut"],
+            "file_usi": ["mzspec:MSV1:a", "mzspec:MSV2:b", "mzspec:MSV1:c"],
+            "Dataset": ["MSV1", "MSV2", "MSV1"],
+            "USI": ["u1", "u2", "u3"],
+            "Cosine": [0.9, 0.8, 0.75],
+            "Matching Peaks": [5, 6, 7],
+        }
+    )
+    with results_db.ResultsIndex(db_file) as index:
+        index.add_compound("c1", 3, [(masst_utils.FOOD_MASST, hits_df)])
+        index.add_compound("c2", 1, [(masst_utils.FOOD_MASST, hits_df.iloc[2:])])
+        # reruns replace the hits of a compound
+        index.add_compound("c2", 1, [(masst_utils.FOOD_MASST, hits_df.iloc[2:])])
+
+    apple_df = results_db.query_compounds(db_file, node_id="apple")
+    assert list(apple_df["compound"]) == ["c1"]
+    assert apple_df["files"].iloc[0] == 2
+    assert list(results_db.query_compounds(db_file, node_id="nut")["files"]) == [1, 1]
+    assert len(results_db.query_compounds(db_file, dataset="MSV2")) == 1
+
+    # an internal node finds the matches of its subtree
+    fruit_df = results_db.query_compounds(db_file, node_id="fruit", special_masst="food")
+    assert fruit_df[["compound", "node_id", "files"]].values.tolist() == [["c1", "fruit", 3], ["c2", "fruit", 1]]
+    assert list(results_db.query_compounds(db_file, node_id="pome")["compound"]) == ["c1"]
@@ -0,0 +1,31 @@
+import pytest
+
+import tree_builder
+
+
+def test_group_sizes_and_tree():
+    # rows of a node table: id and parent id
+    ids = ["root", "a", "b", "a1", "a2"]
+    parents = ["-1", "root", "root", "a", "a"]
+    children = tree_builder.children_index(parents)
+    counts = {"a": 1, "b": 2, "a1": 3, "a2": 4}
+
+    assert tree_builder.group_sizes(ids, ids, children, counts) == {"root": 10, "a": 8, "b": 2, "a1": 3, "a2": 4}
+    leaf_sizes = tree_builder.group_sizes(ids, ids, children, counts, include_internal_counts=False)
+    assert leaf_sizes["a"] == 7 and leaf_sizes["root"] == 9
+
+    def create_node(row, parent=None):
+        return tree_builder.tree_node(ids[row], ids[row].upper(), leaf_sizes[ids[row]], NCBI=None)
+
+    tree = tree_builder.build_tree(create_node(0), "root", ids, children, create_node)
+    assert list(tree) == ["ID", "NCBI", "duplication", "type", "name", "group_size", "children"]
+    assert [child["ID"] for child in tree["children"]] == ["a", "b"]
+    assert [child["group_size"] for child in tree["children"][0]["children"]] == [3, 4]
+    assert tree["children"][1]["children"] == []
+
+
+def test_cycle():
+    ids = ["a", "b"]
+    children = tree_builder.children_index(["b", "a"])
+    with pytest.raises(ValueError):
+        tree_builder.group_sizes(ids, ids, children, {})
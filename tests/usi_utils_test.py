@@ -0,0 +1,34 @@
+import pandas as pd
+import pytest
+
+import usi_utils
+
+USIS = [
+    "mzspec:MSV000095331:peak/mzML_3/Full_syncom_T72_drug_mix_2_2.mzML:scan:2176",
+    "mzspec:MSV000095331:peak/mzML_3/Full_syncom_T72_drug_mix_2_2.mzML:scan:99",
+    "mzspec:GNPS:GNPS-LIBRARY:accession:CCMSLIB00005883950",
+    "mzspec:MSV000090162:a.b.c.mzXML:scan:1",
+    "mzspec:MSV000090162:.hidden:scan:3",
+    "mzspec:MSV000090162:f:scan:1:scan:2",
+]
+
+
+def test_file_usi_series_matches_scalar():
+    usis = pd.Series(USIS, index=range(10, 10 + len(USIS)))
+    file_usis = usi_utils.file_usi_series(usis)
+    assert list(file_usis.index) == list(usis.index)
+    assert list(file_usis) == [usi_utils.ensure_simple_file_usi(usi) for usi in USIS]
+    # second call is served from the cache
+    assert list(usi_utils.file_usi_series(usis)) == list(file_usis)
+
+
+def test_create_file_usi_column_from_filename():
+    df = pd.DataFrame(
+        {"Filename": ["peak/a/b.mzML", "c.mzXML"], "MassIVE": ["MSV1", "MSV2"]}
+    )
+    usi_utils.create_file_usi_column(df)
+    assert list(df["file_usi"]) == ["mzspec:MSV1:b", "mzspec:MSV2:c"]
+
+    df = pd.DataFrame({"Filename": ["b.mzML"], "MassIVE": [None]})
+    with pytest.raises(ValueError):
+        usi_utils.create_file_usi_column(df)
@@ -0,0 +1,17 @@
+import os
+
+import utils
+
+
+def test_scan_sharded_output_files(tmp_path):
+    prefix = str(tmp_path / "fastMASST")
+    for name in ["a", "b", "c"]:
+        file = utils.shard_file_name(prefix, name) + "_{}_matches.tsv".format(name)
+        utils.prepare_paths(file=file)
+        open(file, "w").close()
+
+    assert utils.scan_output_files(prefix, "_matches.tsv", sharded=False) == set()
+    files = utils.scan_output_files(prefix, "_matches.tsv", sharded=True)
+    expected = os.path.join(tmp_path, utils.output_shard("b"), "fastMASST_b_matches.tsv")
+    assert len(files) == 3
+    assert os.path.normpath(expected) in files
@@ -1,9 +1,11 @@
 import pandas as pd
-import json
 from collections import defaultdict
 import requests
 import io
 
+# tree_builder is in the code directory, run with it on the path: PYTHONPATH=../../code python personalCareProduct_tree_generator.py
+import tree_builder
+
 #make metadata table for masst 
 ############################################
 
@@ -98,44 +100,25 @@ for category in df_unique_mri['Category']:
 edge_table = pd.DataFrame(edges, columns=['Source', 'Target']).drop_duplicates()
 
 
-def build_tree(node_table, edge_table, parent_name=None, parent_id=""):
-    if parent_name is None:
-        # Find the root node
-        root_node = node_table.iloc[0]
-        node = {
-            "ID": root_node['Node'],
-            "duplication": "Y",
-            "type": "node",
-            "name": root_node['Node'],
-            "group_size": int(root_node['Count']),
-            "children": build_tree(node_table, edge_table, root_node['Node'], root_node['Node'])
-        }
-        return [node]
-    else:
-        children = edge_table[edge_table['Source'] == parent_name]
-        if children.empty:
-            return []
-        result = []
-        for _, child in children.iterrows():
-            child_node_name = child['Target']
-            child_count = node_table[node_table['Node'] == child_node_name]['Count'].values[0]
-            child_node = {
-                "ID": f"{parent_id}_{child_node_name}",
-                "duplication": "Y",
-                "type": "node",
-                "name": child_node_name,
-                "group_size": int(child_count),
-                "children": build_tree(node_table, edge_table, child_node_name, f"{parent_id}_{child_node_name}")
-            }
-            result.append(child_node)
-        return result
-
-# Build the tree
-tree = build_tree(node_table, edge_table)
-
-
-
-with open('../../data/personalCareProduct_masst_tree.json', 'w') as file:
-    json.dump(tree[0], file, indent=4)
+# Build the tree from the first node, children follow the edge table order
+# the count of the first row of each node, like looking it up by filtering the node table
+unique_nodes = node_table.drop_duplicates('Node', keep='first')
+count_by_node = dict(zip(unique_nodes['Node'], unique_nodes['Count']))
+targets = edge_table['Target'].to_numpy(dtype=object)
+root_name = node_table['Node'].iloc[0]
+
+
+def create_node(row, parent):
+    child_node_name = targets[row]
+    return tree_builder.tree_node(f"{parent['ID']}_{child_node_name}", child_node_name, count_by_node[child_node_name])
+
 
+tree = tree_builder.build_tree(
+    tree_builder.tree_node(root_name, root_name, count_by_node[root_name]),
+    root_name,
+    targets,
+    tree_builder.children_index(edge_table['Source']),
+    create_node,
+)
 
+tree_builder.write_tree_json(tree, '../../data/personalCareProduct_masst_tree.json', indent=4)